@@ -0,0 +1,153 @@
+#==============================================================================
+# aliascache.py
+# Thread-safe cache of alias to RID resolutions.
+#==============================================================================
+#
+# An AliasCache may be shared by any number of OnepV1 and Datastore
+# instances and threads. Entries expire after ttl seconds, and failed
+# lookups are remembered for negative_ttl seconds so that a missing alias
+# isn't looked up on every call.
+#
+# Copyright (c) 2014, Exosite LLC
+# All rights reserved.
+#
+import threading
+import time
+
+
+def _authkey(auth):
+    '''Convert auth to str so that it can be hashed. A CIK and
+    {'cik': CIK} get the same key, so that Datastore (which passes CIKs)
+    and OnepV1 (which passes auth dicts) share entries.'''
+    if type(auth) is not dict:
+        auth = {'cik': auth}
+    return '{' + ','.join(["{0}:{1}".format(k, auth[k])
+                           for k in sorted(auth.keys())]) + '}'
+
+
+class AliasCache():
+    '''Cache of (auth, alias) -> RID. auth is a CIK or an auth dict as
+    for OnepV1.
+
+        ttl: seconds a resolved alias is cached. None caches forever.
+        negative_ttl: seconds a failed lookup is cached. 0 doesn't cache
+                      failures.'''
+    def __init__(self, ttl=300, negative_ttl=30):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._lock = threading.Lock()
+        # (authkey, alias) -> (rid or False, status, expiry time or None)
+        self._entries = {}
+
+    def get(self, auth, alias):
+        '''Returns the cached RID for alias, False if the lookup is cached
+        as failed, or None if nothing is cached.'''
+        entry = self._get(auth, alias)
+        if entry is None:
+            return None
+        return entry[0]
+
+    def _get(self, auth, alias):
+        key = (_authkey(auth), alias)
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[2] is not None and entry[2] < time.time():
+                del self._entries[key]
+                return None
+            return entry
+        finally:
+            self._lock.release()
+
+    def set(self, auth, alias, rid, status=None):
+        '''Caches rid for alias. If rid is False, caches a failed lookup
+        with the status the platform returned.'''
+        ttl = self.ttl if rid is not False else self.negative_ttl
+        if ttl is not None and ttl <= 0:
+            return
+        expiry = None if ttl is None else time.time() + ttl
+        self._lock.acquire()
+        try:
+            self._entries[(_authkey(auth), alias)] = (rid, status, expiry)
+        finally:
+            self._lock.release()
+
+    def invalidate(self, auth=None, alias=None):
+        '''Removes alias from the cache. If alias is None, removes every
+        alias for auth. If auth is None too, clears the cache.'''
+        self._lock.acquire()
+        try:
+            if auth is None:
+                self._entries.clear()
+            elif alias is None:
+                authkey = _authkey(auth)
+                for key in list(self._entries.keys()):
+                    if key[0] == authkey:
+                        del self._entries[key]
+            else:
+                self._entries.pop((_authkey(auth), alias), None)
+        finally:
+            self._lock.release()
+
+    def resolve(self, onep, auth, alias, forcequery=False):
+        '''Looks up alias with onep unless it's cached. Returns
+        (status, rid) if successful or (status, message) if not, like
+        OnepV1.lookup().'''
+        if not forcequery:
+            entry = self._get(auth, alias)
+            if entry is not None:
+                if entry[0] is False:
+                    return False, entry[1]
+                return True, entry[0]
+        status, res = onep._call('lookup', auth, ['alias', alias], False)
+        if status:
+            self.set(auth, alias, res)
+        else:
+            self.set(auth, alias, False, res)
+        return status, res
+
+    def warmup(self, onep, auth, aliases, max_calls=None):
+        '''Resolves aliases that aren't cached with a single batch of
+        lookup calls (split by max_calls, see OnepV1.send_deferred()).
+        Returns a dict of alias -> RID, or False for aliases that failed.'''
+        resolved = {}
+        missing = []
+        for alias in aliases:
+            rid = self.get(auth, alias)
+            if rid is None:
+                missing.append(alias)
+            else:
+                resolved[alias] = rid
+        if missing:
+            calls = onep._composeCalls([('lookup', ['alias', alias])
+                                        for alias in missing])
+            for request, status, res in onep._sendCalls(auth,
+                                                        calls,
+                                                        max_calls=max_calls):
+                alias = request['arguments'][1]
+                if status:
+                    self.set(auth, alias, res)
+                    resolved[alias] = res
+                else:
+                    if not isinstance(res, Exception):
+                        # the alias doesn't exist, rather than the
+                        # request failing
+                        self.set(auth, alias, False, res)
+                    resolved[alias] = False
+        return resolved
+
+    def warmup_from_info(self, onep, auth, rid={'alias': ''}):
+        '''Caches every alias of the client rid (by default, the client
+        identified by auth) with a single info call. Returns a dict of
+        alias -> RID.'''
+        status, res = onep._call('info', auth, [rid, {'aliases': True}],
+                                 False)
+        resolved = {}
+        if status:
+            for aliasrid, aliaslist in res.get('aliases', {}).items():
+                for alias in aliaslist:
+                    self.set(auth, alias, aliasrid)
+                    resolved[alias] = aliasrid
+        return resolved
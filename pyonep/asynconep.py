@@ -0,0 +1,447 @@
+#==============================================================================
+# asynconep.py
+# asyncio version of the One Platform RPC client, for making many calls
+# concurrently from a single thread.
+#==============================================================================
+#
+# Requires Python 3.5 or later. The rest of pyonep does not import this
+# module, so it remains usable on older versions.
+#
+# Copyright (c) 2014, Exosite LLC
+# All rights reserved.
+#
+import asyncio
+import logging
+import ssl
+import sys
+import time
+
+from .onep import OnepV1
+from .onephttp import body_for_log
+from .columnar import to_columns
+from .exceptions import JsonRPCRequestException, JsonRPCResponseException
+from .exceptions import OneException, OnePlatformException
+
+log = logging.getLogger(__name__)
+
+# log errors stderr, don't log anything else
+h = logging.StreamHandler()
+h.setLevel(logging.ERROR)
+log.addHandler(h)
+
+
+class AsyncHTTPResponse:
+    '''Status line and headers of a response read by AsyncOnePHTTP.'''
+    def __init__(self, version, status, reason, headers):
+        self.version = version
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.will_close = False
+
+    def getheader(self, name, default=None):
+        return self.headers.get(name.lower(), default)
+
+    def getheaders(self):
+        return list(self.headers.items())
+
+
+class AsyncOnePHTTP:
+    '''Non-blocking HTTP/1.1 client for One Platform. Keeps idle keep-alive
+    connections for reuse and limits the number of requests in flight.
+
+          host: the host and port to connect to, joined by a colon
+          https: boolean indicating whether to use HTTPS
+          httptimeout: seconds to wait for a whole request/response
+          maxconcurrency: maximum number of requests in flight at once.
+                          This also bounds the number of open connections.
+          idle_timeout: seconds an idle connection is kept for reuse
+          log_body_bytes, log_body_rate: as for OnePHTTP. Nothing is
+                                         formatted unless log is enabled
+                                         for debug.'''
+    def __init__(self,
+                 host,
+                 https=True,
+                 httptimeout=5,
+                 headers={},
+                 maxconcurrency=100,
+                 idle_timeout=60,
+                 log=log,
+                 log_body_bytes=1024,
+                 log_body_rate=1):
+        self.host = host
+        self.https = https
+        self.httptimeout = httptimeout
+        self.headers = headers
+        self.maxconcurrency = maxconcurrency
+        self.idle_timeout = idle_timeout
+        self.log = log
+        self.log_body_bytes = log_body_bytes
+        self.log_body_rate = log_body_rate
+        if ':' in host:
+            self._hostname, port = host.rsplit(':', 1)
+            self._port = int(port)
+        else:
+            self._hostname = host
+            self._port = 443 if https else 80
+        # list of (reader, writer, time returned)
+        self._idle = []
+        # created on first use so that it belongs to the running loop
+        self._semaphore = None
+
+    def _get_semaphore(self):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.maxconcurrency)
+        return self._semaphore
+
+    async def _connect(self):
+        '''Returns (reader, writer, reused), reusing an idle connection if
+        there's one that the server hasn't closed.'''
+        now = time.time()
+        while self._idle:
+            reader, writer, returned = self._idle.pop()
+            if (now - returned > self.idle_timeout
+                    or reader.at_eof()
+                    or writer.is_closing()):
+                writer.close()
+                continue
+            return reader, writer, True
+        sslcontext = ssl.create_default_context() if self.https else None
+        reader, writer = await asyncio.open_connection(
+            self._hostname, self._port, ssl=sslcontext)
+        return reader, writer, False
+
+    def _release(self, reader, writer, reusable):
+        if reusable and not writer.is_closing():
+            self._idle.append((reader, writer, time.time()))
+        else:
+            writer.close()
+
+    def _encode_request(self, method, path, body, allheaders):
+        if body is None:
+            body = b''
+        elif not isinstance(body, bytes):
+            body = body.encode('utf_8')
+        lines = ['%s %s HTTP/1.1' % (method, path), 'Host: %s' % self.host]
+        for name in allheaders:
+            lines.append('%s: %s' % (name, allheaders[name]))
+        lines.append('Content-Length: %d' % len(body))
+        return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin_1') + body
+
+    async def _read_response(self, reader):
+        statusline = await reader.readline()
+        if not statusline:
+            raise ConnectionResetError('Connection closed by server')
+        parts = statusline.decode('latin_1').rstrip('\r\n').split(' ', 2)
+        version = parts[0]
+        status = int(parts[1])
+        reason = parts[2] if len(parts) > 2 else ''
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin_1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        response = AsyncHTTPResponse(version, status, reason, headers)
+        connection = headers.get('connection', '').lower()
+        response.will_close = (connection == 'close'
+                               or (version == 'HTTP/1.0'
+                                   and connection != 'keep-alive'))
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                if size == 0:
+                    # skip trailers
+                    while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                        pass
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readline()
+            body = b''.join(chunks)
+        elif 'content-length' in headers:
+            body = await reader.readexactly(int(headers['content-length']))
+        else:
+            body = await reader.read()
+            response.will_close = True
+        return body, response
+
+    async def _exchange(self, data):
+        reader, writer, reused = await self._connect()
+        try:
+            writer.write(data)
+            await writer.drain()
+            body, response = await self._read_response(reader)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            writer.close()
+            if not reused:
+                raise
+            # the server closed an idle connection, try a new one
+            reader, writer, reused = await self._connect()
+            try:
+                writer.write(data)
+                await writer.drain()
+                body, response = await self._read_response(reader)
+            except BaseException:
+                writer.close()
+                raise
+        except BaseException:
+            # includes cancellation by wait_for
+            writer.close()
+            raise
+        self._release(reader, writer, not response.will_close)
+        return body, response
+
+    async def request(self, method, path, body=None, headers={},
+                      notimeout=False, decode=True):
+        '''Makes a request and returns (body, AsyncHTTPResponse). If
+        notimeout is True, httptimeout is not applied. If decode is False,
+        the body is returned as bytes.'''
+        allheaders = {}
+        allheaders.update(self.headers)
+        allheaders.update(headers)
+        debug = self.log.isEnabledFor(logging.DEBUG)
+        if debug:
+            self.log.debug("%s %s\nHost: %s\nHeaders: %s",
+                           method, path, self.host, allheaders)
+            logbody = body_for_log(body, self.log_body_bytes,
+                                   self.log_body_rate)
+            if logbody is not None:
+                self.log.debug("Body: %s", logbody)
+        data = self._encode_request(method, path, body, allheaders)
+        async with self._get_semaphore():
+            if notimeout:
+                body, response = await self._exchange(data)
+            else:
+                body, response = await asyncio.wait_for(
+                    self._exchange(data), self.httptimeout)
+        if debug:
+            self.log.debug("%s %s %s\nHeaders: %s",
+                           response.version,
+                           response.status,
+                           response.reason,
+                           response.getheaders())
+        if (decode and
+                response.getheader('Content-Type', '').endswith('charset=utf-8')):
+            body = body.decode('utf_8')
+        if debug:
+            logbody = body_for_log(body, self.log_body_bytes,
+                                   self.log_body_rate)
+            if logbody is not None:
+                self.log.debug("Body: %s", logbody)
+        return body, response
+
+    def close(self):
+        '''Closes idle connections.'''
+        while self._idle:
+            reader, writer, returned = self._idle.pop()
+            writer.close()
+
+
+class AsyncPointIterator:
+    '''Asynchronous iterator of the points AsyncOnepV1.iter_read() reads,
+    a page at a time.'''
+    def __init__(self, onep, fetch, starttime, page_size, prefetch):
+        self._onep = onep
+        self._fetch = fetch
+        self._page_size = page_size
+        self._prefetch = prefetch
+        # (start, limit, skip) of the next page, None after the last
+        self._following = (starttime, page_size, 0)
+        self._pending = None
+        self._page = []
+        self._index = 0
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while self._index >= len(self._page):
+            if self._following is None:
+                raise StopAsyncIteration
+            start, limit, skip = self._following
+            if self._pending is not None:
+                pending, self._pending = self._pending, None
+                points = await pending
+            else:
+                points = await self._fetch(start, limit)
+            self._page, self._following = self._onep._nextPage(
+                points, start, limit, skip, self._page_size)
+            self._index = 0
+            if self._prefetch and self._following is not None:
+                self._pending = asyncio.ensure_future(
+                    self._fetch(self._following[0], self._following[1]))
+        point = self._page[self._index]
+        self._index += 1
+        return point
+
+
+class AsyncOnepV1(OnepV1):
+    '''OnepV1 with every RPC method (read, write, record, info, listing,
+    wait, ...) returning a coroutine. For example:
+
+        o = AsyncOnepV1(maxconcurrency=500)
+        results = await asyncio.gather(
+            *[o.read(cik, {'alias': 'temp'}, {'limit': 1}) for cik in ciks])
+
+    Calls made with defer=True are queued as in OnepV1 and return True
+    immediately. Send them with await send_deferred(auth).
+
+    iter_read() returns an asynchronous iterator. read_stream() and
+    send_deferred_stream() aren't supported, since responses are read
+    whole; use read() and send_deferred().'''
+    def __init__(self,
+                 host='m2.exosite.com',
+                 port='80',
+                 url='/onep:v1/rpc/process',
+                 https=False,
+                 httptimeout=10,
+                 agent=None,
+                 logrequests=False,
+                 maxconcurrency=100,
+                 idle_timeout=60,
+                 codec=None,
+                 retry=None,
+                 circuitbreaker=None):
+        OnepV1.__init__(self,
+                        host=host,
+                        port=port,
+                        url=url,
+                        https=https,
+                        httptimeout=httptimeout,
+                        agent=agent,
+                        logrequests=logrequests,
+                        codec=codec,
+                        retry=retry,
+                        circuitbreaker=circuitbreaker)
+        self.onephttp = AsyncOnePHTTP(host + ':' + str(port),
+                                      https=https,
+                                      httptimeout=int(httptimeout),
+                                      headers=self.headers,
+                                      maxconcurrency=maxconcurrency,
+                                      idle_timeout=idle_timeout,
+                                      log=log)
+
+    async def _callJsonRPC(self, auth, callrequests, returnreq=False,
+                           notimeout=False):
+        '''Coroutine version of OnepV1._callJsonRPC.'''
+        body = self._composeBody(auth, callrequests)
+        attempt = 0
+        while True:
+            self._checkCircuit()
+            try:
+                resbody, response = await self._post(body, notimeout)
+            except (JsonRPCRequestException, JsonRPCResponseException):
+                delay = self._retryDelay(callrequests, attempt, None)
+                if delay is None:
+                    raise
+            else:
+                delay = self._retryDelay(callrequests, attempt,
+                                         response.status)
+                if delay is None:
+                    return self._parseResponse(resbody, callrequests,
+                                               returnreq)
+            log.debug("Retrying request in %.3f seconds" % delay)
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def _post(self, body, notimeout=False):
+        '''Coroutine version of OnepV1._post.'''
+        try:
+            return await self.onephttp.request(
+                'POST',
+                self.url,
+                body,
+                self.headers,
+                notimeout=notimeout,
+                decode=False)
+        except asyncio.TimeoutError:
+            raise JsonRPCResponseException(
+                "Failed to get response for request: timed out")
+        except (OSError, asyncio.IncompleteReadError, ValueError):
+            ex = sys.exc_info()[1]
+            raise JsonRPCRequestException(
+                "Failed to make http request: %s" % str(ex))
+
+    def read(self, auth, rid, options, defer=False, columnar=False):
+        '''Coroutine version of OnepV1.read(). Like the other methods,
+        it returns True without a coroutine if defer is True.'''
+        result = OnepV1.read(self, auth, rid, options, defer)
+        if defer or not columnar:
+            return result
+        return self._columnar(result)
+
+    def iter_read(self, auth, rid, starttime, endtime, page_size=1000,
+                  options=None, prefetch=False):
+        '''Version of OnepV1.iter_read() for async for. If prefetch is
+        True, the next page is read while the caller processes the
+        current one.'''
+        readoptions = {}
+        if options is not None:
+            readoptions.update(options)
+        readoptions.update({'endtime': endtime, 'sort': 'asc'})
+
+        async def fetch(start, limit):
+            opts = dict(readoptions)
+            opts.update({'starttime': start, 'limit': limit})
+            status, points = await self.read(auth, rid, opts)
+            if not status:
+                raise OnePlatformException(
+                    "Error message from one platform (read): %s" % points)
+            return points
+        return AsyncPointIterator(self, fetch, starttime, page_size, prefetch)
+
+    def read_stream(self, auth, rid, options, chunk_size=65536):
+        raise OneException(
+            "AsyncOnepV1 reads responses whole, use read() instead of "
+            "read_stream()")
+
+    def send_deferred_stream(self, auth, chunk_size=65536):
+        raise OneException(
+            "AsyncOnepV1 reads responses whole, use send_deferred() "
+            "instead of send_deferred_stream()")
+
+    async def _columnar(self, call):
+        isok, response = await call
+        if isok:
+            return True, to_columns(response)
+        return isok, response
+
+    async def send_deferred(self, auth, max_calls=None, max_bytes=None):
+        '''Send all deferred requests for a particular CIK/auth. If the
+        calls are split by max_calls or max_bytes as described for
+        OnepV1.send_deferred(), the requests are sent concurrently, up to
+        maxconcurrency at once, and the calls of a failed request are
+        returned as (request, False, exception).'''
+        if self.deferred.has_requests(auth):
+            method_arg_pairs = self.deferred.get_method_args_pairs(auth)
+            calls = self._composeCalls(method_arg_pairs)
+            notimeout = self.deferred.get_notimeout(auth)
+            # remove deferred calls before yielding to other tasks, so
+            # calls deferred meanwhile go in the next batch
+            self.deferred.reset(auth)
+            batches = self._splitCalls(auth, calls, max_calls, max_bytes)
+            try:
+                if len(batches) == 1:
+                    return await self._callJsonRPC(auth, calls,
+                                                   returnreq=True,
+                                                   notimeout=notimeout)
+                batchresults = await asyncio.gather(
+                    *[self._callJsonRPC(auth, batch, returnreq=True,
+                                        notimeout=notimeout)
+                      for batch in batches],
+                    return_exceptions=True)
+            finally:
+                self._invalidateAliases(auth, calls)
+            for results in batchresults:
+                if (isinstance(results, BaseException)
+                        and not isinstance(results, Exception)):
+                    # e.g. cancelled
+                    raise results
+            batchresults = [
+                self._failedBatch(batch, results)
+                if isinstance(results, Exception) else results
+                for batch, results in zip(batches, batchresults)]
+            return self._mergeResults(calls, batchresults)
+        raise JsonRPCRequestException('No deferred requests to send.')
@@ -0,0 +1,102 @@
+#==============================================================================
+# columnar.py
+# Compact column storage for read results.
+#==============================================================================
+#
+# A read result is a list of [timestamp, value] lists, which costs an
+# object per point and per value. ColumnarPoints keeps the timestamps
+# and values in two arrays instead, NumPy arrays if NumPy is installed.
+#
+# Copyright (c) 2014, Exosite LLC
+# All rights reserved.
+#
+import array
+import sys
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+if sys.version_info < (3, 0):
+    integer_types = (int, long)
+else:
+    integer_types = (int,)
+
+# 'q' (signed 64 bit) was added to the array module in Python 3.3
+try:
+    array.array('q')
+    INT64 = 'q'
+except ValueError:
+    INT64 = 'l'
+FLOAT64 = 'd'
+
+
+class ColumnarPoints():
+    '''Points of a read result as parallel columns.
+
+        timestamps: int64 array of timestamps
+        values: int64 array if every value is an integer, float64 array if
+                every value is a number, otherwise a list
+
+    Indexing and iterating return [timestamp, value] lists, as in a read
+    result.'''
+    def __init__(self, timestamps, values):
+        self.timestamps = timestamps
+        self.values = values
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def __getitem__(self, i):
+        return [self.timestamps[i], self.values[i]]
+
+    def __iter__(self):
+        for i in range(len(self.timestamps)):
+            yield [self.timestamps[i], self.values[i]]
+
+    def __repr__(self):
+        return 'ColumnarPoints(%r, %r)' % (self.timestamps, self.values)
+
+
+def _valuetype(points):
+    '''Returns the typecode that can hold every value, or None.'''
+    typecode = INT64
+    for point in points:
+        value = point[1]
+        if isinstance(value, bool):
+            return None
+        if isinstance(value, integer_types):
+            continue
+        if isinstance(value, float):
+            typecode = FLOAT64
+        else:
+            return None
+    return typecode
+
+
+def to_columns(points, use_numpy=None):
+    '''Converts a list of [timestamp, value] points to ColumnarPoints.
+
+        use_numpy: True to return NumPy arrays, False for array.array. The
+                   default is NumPy if it's installed.'''
+    if use_numpy is None:
+        use_numpy = numpy is not None
+    n = len(points)
+    typecode = _valuetype(points)
+    if use_numpy:
+        timestamps = numpy.fromiter((p[0] for p in points),
+                                    dtype=numpy.int64, count=n)
+        if typecode is None:
+            values = [p[1] for p in points]
+        else:
+            dtype = numpy.int64 if typecode == INT64 else numpy.float64
+            values = numpy.fromiter((p[1] for p in points),
+                                    dtype=dtype, count=n)
+    else:
+        timestamps = array.array(INT64, [p[0] for p in points])
+        if typecode is None:
+            values = [p[1] for p in points]
+        else:
+            values = array.array(typecode, [p[1] for p in points])
+    return ColumnarPoints(timestamps, values)
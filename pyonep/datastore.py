@@ -12,12 +12,25 @@
 # All rights reserved.
 #
 
+import heapq
 import threading
 import time
 import sys
 import logging
-from onep import OnepV1
-from exceptions import OneException
+try:
+    import Queue as queue
+except ImportError:
+    # python 3
+    import queue
+from .onep import OnepV1
+from .onephttp import ConnectionPool
+from .columnar import to_columns
+from .aliascache import AliasCache
+from .readcache import ReadCache
+from .ratelimit import bucket_for
+from .singleflight import SingleFlight
+from .workerpool import WorkerPool
+from .exceptions import OneException
 
 # setup default configurations
 transport_config = {'host': 'm2.exosite.com',
@@ -28,10 +41,147 @@ transport_config = {'host': 'm2.exosite.com',
 datastore_config = {'write_buffer_size': 1024,
                     'read_cache_size': 1024,
                     'read_cache_expire_time': 5,
+                    # calls per second per CIK, None for no limit
+                    'read_rate': 10,
+                    'read_burst': 10,
+                    'write_rate': None,
+                    'write_burst': 1,
+                    # seconds to wait for other threads' cache misses to
+                    # read them in one batch, 0 to read each one at once
+                    'read_coalesce_window': 0,
+                    # flush early once this many points are buffered
+                    # (default: half of write_buffer_size)
+                    'flush_high_water': None,
+                    # longest wait between flushes while the platform fails
+                    'flush_max_backoff': 300,
+                    # keep every write() with its own timestamp rather
+                    # than only the last value per flush. The platform
+                    # keeps one point per second, so a later write() to
+                    # an alias in the same second replaces the earlier
+                    # one and returns False, as for a buffered write.
+                    'lossless': False,
+                    # historical records are sent as multi-call requests
+                    # of at most this many bytes, up to record_workers at
+                    # once (on the threads of transport's 'workerpool')
+                    'batch_max_bytes': 262144,
+                    'record_workers': 4,
+                    'buffer_shards': 16,
                     'log_level': 'debug'}
 
 log = logging.getLogger(__name__)
-lock = threading.Lock()
+
+# alias resolutions to share between Datastores, by passing it as aliascache
+shared_aliascache = AliasCache()
+
+
+class BufferShard():
+    '''Write buffers for a subset of a Datastore's aliases. Each shard has
+    its own lock so that writers to different aliases don't contend, and
+    the lock is never held during network I/O.'''
+    def __init__(self):
+        self.lock = threading.Lock()
+        # alias -> value
+        self.liveBuffer = dict()
+        # alias -> list of [timestamp, value, offset]
+        self.recordBuffer = dict()
+        self.recordCount = 0
+        # alias -> list of [timestamp, value], for lossless writes
+        self.sampleBuffer = dict()
+        self.sampleCount = 0
+        # alias -> timestamp of its last lossless write
+        self.lastSample = dict()
+
+    def take(self):
+        '''Removes and returns everything buffered, as
+        (liveBuffer, recordBuffer, sampleBuffer).'''
+        self.lock.acquire()
+        try:
+            live, self.liveBuffer = self.liveBuffer, dict()
+            records, self.recordBuffer = self.recordBuffer, dict()
+            samples, self.sampleBuffer = self.sampleBuffer, dict()
+            self.recordCount = 0
+            self.sampleCount = 0
+        finally:
+            self.lock.release()
+        return live, records, samples
+
+    def addSample(self, alias, timestamp, value):
+        '''Buffers a sample. If alias already has one at timestamp (or
+        later, if the clock went back), the latest value replaces it and
+        False is returned.'''
+        self.lock.acquire()
+        try:
+            last = self.lastSample.get(alias)
+            samples = self.sampleBuffer.setdefault(alias, list())
+            if last is not None and timestamp <= last:
+                if samples and samples[-1][0] == last:
+                    samples[-1][1] = value
+                else:
+                    # already flushed. The platform replaces the point at
+                    # that timestamp.
+                    samples.append([last, value])
+                    self.sampleCount += 1
+                return False
+            self.lastSample[alias] = timestamp
+            samples.append([timestamp, value])
+            self.sampleCount += 1
+            return True
+        finally:
+            self.lock.release()
+
+    def addRecords(self, alias, entries, first=False):
+        '''Appends record entries for alias, or puts them before the
+        buffered ones if first is True (e.g. to retry them).'''
+        self.lock.acquire()
+        try:
+            buffered = self.recordBuffer.setdefault(alias, list())
+            if first:
+                buffered[0:0] = entries
+            else:
+                buffered.extend(entries)
+            self.recordCount += len(entries)
+        finally:
+            self.lock.release()
+
+
+class ReadCoalescer():
+    '''Collects the reads requested by concurrent threads within window
+    seconds and fetches them with one call to fetch, which takes a list of
+    (alias, count) and returns a dict of (alias, count) -> data.'''
+    def __init__(self, window, fetch):
+        self.window = window
+        self.fetch = fetch
+        self._lock = threading.Lock()
+        self._batch = None
+
+    def read(self, alias, count):
+        self._lock.acquire()
+        try:
+            batch = self._batch
+            leader = batch is None
+            if leader:
+                batch = {'requests': list(),
+                         'results': dict(),
+                         'done': threading.Event()}
+                self._batch = batch
+            if (alias, count) not in batch['requests']:
+                batch['requests'].append((alias, count))
+        finally:
+            self._lock.release()
+        if leader:
+            time.sleep(self.window)
+            self._lock.acquire()
+            try:
+                self._batch = None
+            finally:
+                self._lock.release()
+            try:
+                batch['results'] = self.fetch(batch['requests'])
+            finally:
+                batch['done'].set()
+        else:
+            batch['done'].wait()
+        return batch['results'].get((alias, count), False)
 
 
 class Datastore():
@@ -40,59 +190,136 @@ class Datastore():
                  interval,
                  autocreate=False,
                  config=datastore_config,
-                 transport=transport_config):
-        self._liveBuffer = dict()
-        self._recordBuffer = dict()
-        self._aliasDict = dict()
-        self._cache = dict()
-        self._cacheCount = 0
-        self._recordCount = 0
+                 transport=transport_config,
+                 aliascache=None,
+                 spool=None,
+                 hub=None):
+        '''aliascache: aliascache.AliasCache to resolve aliases with, which
+                        may be shared with other Datastores and OnepV1
+                        instances (e.g. shared_aliascache). By default
+                        each Datastore caches its own aliases until it's
+                        discarded.
+           spool: if not None, a spool.SqliteSpool that write() and record()
+                  append to instead of buffering in memory. The flush
+                  thread sends spooled points in batches of
+                  'spool_batch_size' (config) and removes them once the
+                  platform acknowledges them.
+           hub: the DatastoreHub that flushes this Datastore instead of a
+                thread of its own. Use DatastoreHub.add() rather than
+                passing it.'''
+        self._shards = [BufferShard()
+                        for i in range(config.get('buffer_shards', 16))]
+        if aliascache is None:
+            aliascache = AliasCache(ttl=None, negative_ttl=None)
+        self._aliases = aliascache
+        self._spool = spool
+        self._cache = ReadCache(config['read_cache_size'],
+                                config['read_cache_expire_time'])
+        # concurrent cache misses for the same read share one call
+        self._flights = SingleFlight()
+        self._coalescer = None
+        if config.get('read_coalesce_window'):
+            self._coalescer = ReadCoalescer(config['read_coalesce_window'],
+                                            self.__fetchMany)
         self._auto = autocreate
         self._config = config
         if 'https' in transport:
             transport['https'] = False
+        # the flush thread and callers of read() and write() make calls at
+        # the same time, so each thread needs its own connection.
+        pool = transport.get('pool')
+        if pool is None:
+            pool = ConnectionPool()
         self._conn = OnepV1(transport['host'],
                             transport['port'],
                             transport['url'],
                             transport['https'],
-                            transport['timeout'])
+                            transport['timeout'],
+                            pool=pool,
+                            codec=transport.get('codec'),
+                            retry=transport.get('retry'),
+                            circuitbreaker=transport.get('circuitbreaker'),
+                            compression=transport.get('compression', True),
+                            compress_min_bytes=transport.get(
+                                'compress_min_bytes'),
+                            listeners=transport.get('listeners'),
+                            workerpool=transport.get('workerpool'))
         self._cik = cik
+        # rate limits are shared by every Datastore for this CIK with the
+        # same limits
+        self._buckets = dict()
+        for kind in ('read', 'write'):
+            rate = config.get(kind + '_rate')
+            if rate:
+                self._buckets[kind] = bucket_for(
+                    (cik, kind), rate, config.get(kind + '_burst', 1))
         if interval < 1:
             interval = 1
         self._interval = interval
+        self._highwater = config.get('flush_high_water') or \
+            config['write_buffer_size'] // 2
+        # wakes the flush thread early
+        self._wake = threading.Condition(threading.Lock())
+        self._flushRequested = False
+        self._flushesStarted = 0
+        self._flushesDone = 0
+        self._backoff = 0
+        self._nextFlush = None
+        # True from start() until the last flush after stop()
+        self._running = False
+        self._killed = False
+        self._forceterminate = False
+        self._thread = None
+        self._hub = hub
+
+    def __shard(self, alias):
+        return self._shards[hash(alias) % len(self._shards)]
 
     def __bufferCount(self):
-        return len(self._liveBuffer) + self._recordCount
+        # read without locking, an approximate count is good enough
+        return sum([len(shard.liveBuffer) + shard.recordCount +
+                    shard.sampleCount for shard in self._shards])
 
     def __isBufferFull(self):
         return self.__bufferCount() >= self._config['write_buffer_size']
 
     def __isLiveBufferEmpty(self):
-        if self._liveBuffer:
-            return False
-        else:
-            return True
+        for shard in self._shards:
+            if shard.liveBuffer:
+                return False
+        return True
 
     def __forceTerminate(self):
         if self._killed and self._forceterminate:
-            self._liveBuffer.clear()
+            for shard in self._shards:
+                shard.lock.acquire()
+                try:
+                    shard.liveBuffer.clear()
+                finally:
+                    shard.lock.release()
             return True
         else:
             return False
 
+    def __throttle(self, kind):
+        '''Waits if a call now would exceed the read or write rate.'''
+        bucket = self._buckets.get(kind)
+        if bucket is not None:
+            waited = bucket.acquire()
+            if waited:
+                log.debug("Rate limited %s for %.3fs" % (kind, waited))
+
     # One platform queries below
 
     def __lookup(self, alias, forcequery=False):
-        if (not forcequery) and alias in self._aliasDict:
-            return self._aliasDict[alias]
+        status, res = self._aliases.resolve(self._conn,
+                                            self._cik,
+                                            alias,
+                                            forcequery)
+        if not status:
+            return False
         else:
-            status, res = self._conn.lookup(self._cik, 'alias', alias)
-            if not status:
-                self._aliasDict[alias] = False
-                return False
-            else:
-                self._aliasDict[alias] = res
-                return res
+            return res
 
     def __read(self,
                alias,
@@ -102,6 +329,7 @@ class Datastore():
                starttime=None,
                endtime=None):
         rid = self.__lookup(alias, forcequery)
+        self.__throttle('read')
         if None != starttime and None != endtime:
             status, res = self._conn.read(
                 self._cik,
@@ -120,21 +348,143 @@ class Datastore():
                 "Error message from one platform (read): %s" % res)
         return res
 
-    def __record(self, alias, entries):
-        rid = self.__lookup(alias)
-        record_status, record_message = self._conn.record(self._cik,
-                                                          rid,
-                                                          entries)
-        if not (True == record_status and 'ok' == record_message):
-            msg = "Error message from one platform (record): %s"
-            raise OneException(msg % record_message)
-        return True
+    def __fetchMany(self, requests):
+        '''Reads the newest points for a list of (alias, count) with one
+        batched call and caches them. Aliases whose RIDs aren't cached are
+        read by alias, with a lookup in the same batch to cache their RIDs,
+        so a cold cache still takes one round trip. Returns a dict of
+        (alias, count) -> data, or False where the read failed.'''
+        results = dict()
+        pairs = list()
+        # call index -> (alias, count) read, or alias looked up
+        reads = list()
+        lookups = set()
+        for alias, count in requests:
+            rid = self._aliases.get(self._cik, alias)
+            if rid is False:
+                # cached as not existing
+                results[(alias, count)] = False
+                continue
+            if rid is None:
+                rid = {'alias': alias}
+                if alias not in lookups:
+                    lookups.add(alias)
+                    pairs.append(('lookup', ['alias', alias]))
+                    reads.append(alias)
+            pairs.append(('read', [rid, {'limit': count, 'sort': 'desc'}]))
+            reads.append((alias, count))
+        if not pairs:
+            return results
+        try:
+            calls = self._conn._composeCalls(pairs)
+            byid = dict((call['id'], read) for call, read in zip(calls, reads))
+            self.__throttle('read')
+            for request, status, res in self._conn._sendCalls(
+                    self._cik,
+                    calls,
+                    max_calls=self._config.get('batch_max_calls')):
+                read = byid[request['id']]
+                if request['procedure'] == 'lookup':
+                    if status:
+                        self._aliases.set(self._cik, read, res)
+                    elif not isinstance(res, Exception):
+                        self._aliases.set(self._cik, read, False, res)
+                elif status:
+                    self._cache.put(read[0], read[1], res)
+                    results[read] = res
+                else:
+                    log.error("Error message from one platform (read): %s"
+                              % res)
+                    results[read] = False
+        except OneException:
+            e = sys.exc_info()[1]
+            log.error(str(e))
+        return results
+
+    def __fetchOne(self, alias, count, forcequery):
+        if self._coalescer is not None and not forcequery:
+            return self._coalescer.read(alias, count)
+        return self.__refreshData(alias, count, forcequery)
+
+    def __recordMany(self, records):
+        '''Records a list of (alias, entries) with one record call per
+        alias, packed into multi-call requests of at most 'batch_max_calls'
+        calls and 'batch_max_bytes' bytes, which up to 'record_workers'
+        threads send at once. A failure only affects the aliases it
+        belongs to. Returns a dict of alias -> None if its entries were
+        written, or else the error message. Aliases that the platform says
+        don't exist (and that can't be created) are left out.'''
+        results = dict()
+        try:
+            self._aliases.warmup(self._conn,
+                                 self._cik,
+                                 [alias for (alias, entries) in records],
+                                 max_calls=self._config.get('batch_max_calls'))
+        except OneException:
+            # resolved one at a time below
+            e = sys.exc_info()[1]
+            log.error(str(e))
+        pairs = list()
+        for alias, entries in records:
+            try:
+                if self.__checkDataportExist(alias):
+                    pairs.append(
+                        (alias, ('record', [self.__lookup(alias), entries, {}])))
+                else:
+                    # cached, so this makes no request
+                    status, res = self._aliases.resolve(self._conn,
+                                                        self._cik,
+                                                        alias)
+                    if res != 'invalid':
+                        # not a definite "doesn't exist". Look it up
+                        # again next time.
+                        self._aliases.invalidate(self._cik, alias)
+                        results[alias] = "Failed to look up %s: %s" % (
+                            alias, res)
+            except OneException:
+                e = sys.exc_info()[1]
+                results[alias] = str(e)
+        if not pairs:
+            return results
+        calls = self._conn._composeCalls([pair for (alias, pair) in pairs])
+        aliasById = dict((call['id'], alias)
+                         for call, (alias, pair) in zip(calls, pairs))
+        batches = self._conn._splitCalls(
+            self._cik,
+            calls,
+            self._config.get('batch_max_calls'),
+            self._config.get('batch_max_bytes'))
+
+        def send(batch):
+            self.__throttle('write')
+            try:
+                for request, status, res in self._conn._callJsonRPC(
+                        self._cik, batch, returnreq=True):
+                    msg = None
+                    if not (status and 'ok' == res):
+                        msg = ("Error message from one platform "
+                               "(record): %s" % res)
+                    results[aliasById[request['id']]] = msg
+            except Exception:
+                # only this request's aliases failed
+                e = sys.exc_info()[1]
+                for call in batch:
+                    results[aliasById[call['id']]] = str(e)
+
+        workers = min(self._config.get('record_workers', 4), len(batches))
+        if workers <= 1:
+            for batch in batches:
+                send(batch)
+        else:
+            self._conn._workerPool(workers).map(send, batches, workers)
+        return results
 
     def __writegroup(self, entries):
         data = list()
         for (alias, value) in entries:
             rid = self.__lookup(alias)
             data.append([rid, value])
+        self.__throttle('write')
         write_status, write_message = self._conn.writegroup(self._cik, data)
         if not (True == write_status and 'ok' == write_message):
             msg = "Error message from one platform (write): %s,%s"
@@ -161,7 +511,7 @@ class Datastore():
         if create_status:
             map_status, map_message = self._conn.map(self._cik, rid, alias)
             if map_status:
-                self._aliasDict[alias] = rid
+                self._aliases.set(self._cik, alias, rid)
                 return True
             else:
                 self._conn.drop(self._cik, rid)
@@ -193,150 +543,349 @@ class Datastore():
     # Write buffer processing below
 
     def __processJsonRPC(self):
-        while not self.__forceTerminate():
-            time.sleep(self._interval)
-            livedata = list()
-            lock.acquire()
+        '''Flushes when the interval elapses, when the buffers reach the
+        high-water mark, or when flush() or stop() is called, whichever is
+        first. While flushes fail, the wait doubles up to
+        'flush_max_backoff' seconds.'''
+        while True:
+            self._wake.acquire()
             try:
-                timestamp = int(time.time())
-                aliases = self._liveBuffer.keys()
-                for alias in aliases:
-                    value = self._liveBuffer[alias]
-                    try:
-                        # create datasource if necessary
-                        if self.__checkDataportExist(alias):
-                            # Move to live data
-                            livedata.append([alias, value])
-                            msg = "Data to be written (alias,value): ('%s',%s)"
-                            log.debug(msg % (alias, value))
-                    except OneException:
-                        # catch exception, add to recordBuffer
-                        if not alias in self._recordBuffer:
-                            self._recordBuffer[alias] = list()
-                        self._recordBuffer[alias].append(
-                            [timestamp, value, True])
-                        self._recordCount += 1
-                    finally:
-                        del self._liveBuffer[alias]
+                remaining = self.__dueIn()
+                while remaining is not None and remaining > 0:
+                    self._wake.wait(remaining)
+                    remaining = self.__dueIn()
             finally:
-                self._liveBuffer.clear()
-                lock.release()
-            # write live data
-            if livedata:
-                timestamp = int(time.time())
-                try:
-                    self.__writegroup(livedata)
-                    log.info("[Live] Written to 1p:" + str(livedata))
-                except OneException:
-                    # go to historical data when write live data failure
-                    e = sys.exc_info()[1]
-                    msg = "Exception While Writing Live Data: {0}"
-                    log.error(msg.format(e.message))
-                    log.debug("Previous Exception For: {0}".format(livedata))
-                    lock.acquire()
-                    try:
-                        for (alias, value) in livedata:
-                            if not alias in self._recordBuffer:
-                                self._recordBuffer[alias] = list()
-                            offset = True
-                            self._recordBuffer[alias].append(
-                                [timestamp, value, offset])
-                            self._recordCount += 1
-                    finally:
-                        lock.release()
-                except Exception:
-                    e = sys.exc_info()[1]
-                    log.exception("Unknown Exception While Writing Data")
-            ## write historical data
-            lock.acquire()
-            try:
-                aliases = self._recordBuffer.keys()
-                curtime = int(time.time())
-                for alias in aliases:
-                    entries = self._recordBuffer[alias]
-                    try:
-                        if self.__checkDataportExist(alias):
-                            recentry = list()
-                            for entry in entries:
-                                if True == entry[2]:  # offset mode
-                                    offset = entry[0] - curtime
-                                    if offset == 0:
-                                        # Must be a negative number.
-                                        offset = -1
-                                    recentry.append([offset, entry[1]])
-                                else:
-                                    recentry.append([entry[0], entry[1]])
-                            if recentry:
-                                try:
-                                    self.__record(alias, recentry)
-                                    log.info("[Historical] Written to 1p: "
-                                             + alias + ", " + str(recentry))
-                                    self._recordCount -= len(entries)
-                                    del self._recordBuffer[alias]
-                                except OneException:
-                                    e = sys.exc_info()[1]
-                                    if e.message.find("datapoint") != -1:
-                                        log.excption(e.message)
-                                        self._recordCount -= len(entries)
-                                        del self._recordBuffer[alias]
-                        else:
-                            del self._recordBuffer[alias]
-                    except OneException:
-                        e = sys.exc_info()[1]
-                        log.error(e.message)
-                        continue
-            finally:
-                lock.release()
-            if self._killed and not self._recordBuffer:
-                self._forceterminate = True
+                self._wake.release()
+            if remaining is None or not self._flushOnce():
+                break
 
-    # Read cache routines below
+    def __dueIn(self):
+        '''Returns the number of seconds until the next flush is due (0 or
+        less if it's due now), or None if the Datastore isn't running.
+        Must be called with self._wake held.'''
+        if not self._running:
+            return None
+        # once stopped, flush without waiting until the buffers are
+        # empty, unless the platform is failing
+        if (self._flushRequested
+                or self._forceterminate
+                or (self._killed and not self._backoff)):
+            return 0
+        return self._nextFlush - time.time()
 
-    def __addCacheData(self, alias, count, forcequery=False):
-        if self.__isCacheFull():
-            self.__clearCache()
-        self._cache[alias] = dict()
-        data = self.__refreshData(alias, count, forcequery)
-        if data:
-            self._cacheCount += 1
-        return data
+    def _dueIn(self):
+        '''As __dueIn(), for the DatastoreHub that runs this Datastore.'''
+        self._wake.acquire()
+        try:
+            return self.__dueIn()
+        finally:
+            self._wake.release()
 
-    def __isExpired(self, alias):
+    def _flushOnce(self):
+        '''Flushes and schedules the next flush. Returns False once the
+        Datastore has stopped and there is nothing more to flush. Called by
+        the flush thread, or by the DatastoreHub that runs this Datastore.'''
+        if self.__forceTerminate():
+            self.__finish()
+            return False
+        self._wake.acquire()
         try:
-            expire = self._config['read_cache_expire_time']
-            return int(time.time()) - self._cache[alias]['time'] > expire
-        except:
-            return True
+            self._flushRequested = False
+            self._flushesStarted += 1
+        finally:
+            self._wake.release()
+        if self.__flushAll():
+            self._backoff = 0
+        else:
+            self._backoff = min(max(self._backoff * 2, self._interval),
+                                self._config.get('flush_max_backoff', 300))
+            log.warning("Flush failed, next in %s seconds" % self._backoff)
+        self._nextFlush = time.time() + (self._backoff or self._interval)
+        if self._killed and self.__bufferCount() == 0 and (
+                self._spool is None or self._spool.count() == 0):
+            self._forceterminate = True
+            self.__finish()
+            return False
+        return True
+
+    def _pending(self):
+        '''Returns the number of points buffered, for DatastoreHub.'''
+        return self.__bufferCount()
+
+    def __finish(self):
+        '''Marks the Datastore as stopped and wakes threads waiting in
+        flush() or stop().'''
+        self._wake.acquire()
+        try:
+            self._running = False
+            self._flushesDone = self._flushesStarted
+            self._wake.notify_all()
+        finally:
+            self._wake.release()
+
+    def __flushAll(self):
+        '''Flushes buffers and spool. Returns False if anything failed and
+        is to be retried.'''
+        ok = True
+        try:
+            ok = self.__flush()
+            if self._spool is not None:
+                ok = self.__drainSpool() and ok
+        except Exception:
+            log.exception("Unknown Exception While Flushing")
+            ok = False
+        self.__flushFinished()
+        return ok
+
+    def __flushFinished(self):
+        '''Wakes threads waiting in flush(wait=True).'''
+        self._wake.acquire()
+        try:
+            self._flushesDone = self._flushesStarted
+            self._wake.notify_all()
+        finally:
+            self._wake.release()
+
+    def __wakeFlusher(self):
+        self._wake.acquire()
+        try:
+            self._flushRequested = True
+            self._wake.notify_all()
+        finally:
+            self._wake.release()
+        if self._hub is not None:
+            self._hub._wakeup(self._cik)
+
+    def __waitUntil(self, done, timeout):
+        '''Waits until done() is True, up to timeout seconds (None for no
+        limit). Returns done().'''
+        deadline = None if timeout is None else time.time() + timeout
+        self._wake.acquire()
+        try:
+            while not done():
+                if deadline is None:
+                    self._wake.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self._wake.wait(remaining)
+            return done()
+        finally:
+            self._wake.release()
+
+    def __drainSpool(self):
+        '''Records spooled points in batches, removing each alias's points
+        from the spool once the platform has accepted them. An alias whose
+        record fails is skipped for the rest of this flush, so that it
+        doesn't hold back the others, and its points are retried on the
+        next flush. Returns False if any alias failed.'''
+        batchsize = self._config.get('spool_batch_size', 1000)
+        # aliases that failed, to leave in the spool
+        skip = set()
+        while not self.__forceTerminate():
+            rows = self._spool.peek(batchsize, exclude=skip)
+            if not rows:
+                return not skip
+            aliases = list()
+            byalias = dict()
+            for rowid, alias, t, value in rows:
+                if alias not in byalias:
+                    aliases.append(alias)
+                    byalias[alias] = (list(), list())
+                byalias[alias][0].append(rowid)
+                byalias[alias][1].append([t, value])
+            acked = list()
+            results = self.__recordMany(
+                [(alias, byalias[alias][1]) for alias in aliases])
+            for alias in aliases:
+                ids, entries = byalias[alias]
+                error = results.get(alias)
+                if error is None:
+                    if alias in results:
+                        log.info("[Spool] Written to 1p: %s, %d points" % (
+                            alias, len(entries)))
+                    # else the alias doesn't exist, drop them
+                    acked.extend(ids)
+                    continue
+                log.error(error)
+                if error.find("datapoint") != -1:
+                    # the platform rejected the points, drop them
+                    acked.extend(ids)
+                else:
+                    skip.add(alias)
+            if acked:
+                self._spool.ack(acked)
+            if len(rows) < batchsize:
+                return not skip
+        return not skip
+
+    def __flush(self):
+        '''Writes buffered live data and records to the platform. Each
+        shard's buffers are swapped out under its lock, and all network
+        I/O happens with no lock held. Data that fails to be written is
+        put back in the record buffers to be retried, and False is
+        returned.'''
+        ok = True
+        livebuffer = dict()
+        recordbuffer = dict()
+        samplebuffer = dict()
+        for shard in self._shards:
+            live, records, samples = shard.take()
+            livebuffer.update(live)
+            recordbuffer.update(records)
+            samplebuffer.update(samples)
+        if samplebuffer:
+            ok = self.__flushSamples(samplebuffer) and ok
+
+        timestamp = int(time.time())
+        livedata = list()
+        for alias, value in livebuffer.items():
+            try:
+                # create datasource if necessary
+                if self.__checkDataportExist(alias):
+                    # Move to live data
+                    livedata.append([alias, value])
+                    log.debug("Data to be written (alias,value): ('%s',%s)",
+                              alias, value)
+            except OneException:
+                # catch exception, add to record buffer
+                self.__shard(alias).addRecords(alias, [[timestamp, value, True]])
+                ok = False
+        # write live data
+        if livedata:
+            timestamp = int(time.time())
+            try:
+                self.__writegroup(livedata)
+                log.info("[Live] Written to 1p:%s", livedata)
+            except OneException:
+                # go to historical data when write live data failure
+                e = sys.exc_info()[1]
+                msg = "Exception While Writing Live Data: {0}"
+                log.error(msg.format(e))
+                log.debug("Previous Exception For: %s", livedata)
+                for (alias, value) in livedata:
+                    self.__shard(alias).addRecords(
+                        alias, [[timestamp, value, True]])
+                ok = False
+            except Exception:
+                log.exception("Unknown Exception While Writing Data")
+        ## write historical data
+        curtime = int(time.time())
+        records = list()
+        for alias, entries in recordbuffer.items():
+            recentry = list()
+            for entry in entries:
+                if True == entry[2]:  # offset mode
+                    offset = entry[0] - curtime
+                    if offset == 0:
+                        # Must be a negative number.
+                        offset = -1
+                    recentry.append([offset, entry[1]])
+                else:
+                    recentry.append([entry[0], entry[1]])
+            if recentry:
+                records.append((alias, recentry))
+        if records:
+            for alias, error in self.__recordMany(records).items():
+                if error is None:
+                    log.info("[Historical] Written to 1p: %s, %d points" % (
+                        alias, len(recordbuffer[alias])))
+                    continue
+                log.error(error)
+                if error.find("datapoint") == -1:
+                    self.__shard(alias).addRecords(alias,
+                                                   recordbuffer[alias],
+                                                   first=True)
+                    ok = False
+                # else the platform rejected the points, drop them
+        return ok
 
-    def __isCacheFull(self):
-        return self._cacheCount >= self._config['read_cache_size']
+    def __flushSamples(self, samplebuffer):
+        '''Sends lossless writes as one record call per alias, with each
+        sample's own timestamp, in a single multi-call request (split by
+        'batch_max_calls'). Samples that fail are moved to the record
+        buffer to be retried. Returns False if any failed.'''
+        ok = True
+        pairs = list()
+        for alias, samples in samplebuffer.items():
+            try:
+                if not self.__checkDataportExist(alias):
+                    continue
+                rid = self.__lookup(alias)
+            except OneException:
+                e = sys.exc_info()[1]
+                log.error(str(e))
+                self.__shard(alias).addRecords(
+                    alias, [[t, value, False] for (t, value) in samples])
+                ok = False
+                continue
+            pairs.append((alias, ('record', [rid, samples, {}])))
+        if not pairs:
+            return ok
+        calls = self._conn._composeCalls([pair for (alias, pair) in pairs])
+        recordAliases = dict((call['id'], alias)
+                             for call, (alias, pair) in zip(calls, pairs))
+        # alias -> samples to retry
+        failed = dict()
+        self.__throttle('write')
+        try:
+            results = self._conn._sendCalls(
+                self._cik,
+                calls,
+                max_calls=self._config.get('batch_max_calls'))
+            for request, status, res in results:
+                if status:
+                    continue
+                log.error("Error message from one platform (record): %s"
+                          % res)
+                alias = recordAliases[request['id']]
+                failed[alias] = samplebuffer[alias]
+            log.info("[Lossless] Written to 1p: %d aliases" % len(pairs))
+        except OneException:
+            e = sys.exc_info()[1]
+            log.error(str(e))
+            for alias, pair in pairs:
+                failed[alias] = samplebuffer[alias]
+        for alias, samples in failed.items():
+            # retry with each sample's own timestamp
+            self.__shard(alias).addRecords(
+                alias,
+                [[t, value, False] for (t, value) in samples],
+                first=True)
+            ok = False
+        return ok
 
-    def __clearCache(self):
-        self._cache.clear()
-        self._cache = dict()
-        self._cacheCount = 0
+    # Read cache routines below
 
     def __refreshData(self, alias, count, forcequery=False):
         try:
-            time.sleep(1)
             data = self.__read(alias,
                                count,
                                forcequery)
-            self._cache[alias]['data'] = data
-            self._cache[alias]['time'] = int(time.time())
+            self._cache.put(alias, count, data)
             return data
         except OneException:
             e = sys.exc_info()[1]
-            log.error(e.message)
+            log.error(str(e))
         except Exception:
-            e = sys.exc_info()[1]
-            log.excpetion("Unknown Exception While Refreshing Data")
+            log.exception("Unknown Exception While Refreshing Data")
         return False
 
     # Public methods below
 
+    def warmup_aliases(self, aliases=None):
+        '''Resolves aliases with one batch of lookup calls so that later
+        reads and writes don't look them up one at a time. If aliases is
+        None, every alias of the client is resolved with one info call.'''
+        if aliases is None:
+            return self._aliases.warmup_from_info(self._conn, self._cik)
+        return self._aliases.warmup(self._conn, self._cik, aliases)
+
     def isThreadAlive(self):
-        return self._thread.isAlive()
+        if self._hub is not None:
+            return self._running and self._hub.isThreadAlive()
+        return self._thread is not None and self._thread.is_alive()
 
     def comment(self,
                 alias,
@@ -375,59 +924,434 @@ class Datastore():
             else:
                 return False, "Failed to create Dataport."
 
-    def read(self, alias, count=1, forcequery=False):
-        if alias in self._cache:  # has cache data
-            if self.__isExpired(alias) or count != len(self._cache[alias]['data']):
-                return self.__refreshData(alias, count, forcequery)
+    def read(self, alias, count=1, forcequery=False, columnar=False):
+        data = self._cache.get(alias, count)
+        if data is None:  # no cache data, or it's expired
+            data = self._flights.do((alias, count, forcequery),
+                                    self.__fetchOne,
+                                    alias, count, forcequery)
+        if columnar and isinstance(data, list):
+            # compact columns, see columnar.ColumnarPoints
+            return to_columns(data)
+        return data
+
+    def read_many(self, aliases, count=1, columnar=False):
+        '''Reads the newest count points of each alias. Aliases that aren't
+        cached are resolved and read with a single batched call (split by
+        the 'batch_max_calls' config, if set). Returns a dict of alias ->
+        data, with False for aliases that couldn't be read.'''
+        results = dict()
+        missing = list()
+        for alias in aliases:
+            data = self._cache.get(alias, count)
+            if data is None:
+                missing.append((alias, count))
             else:
-                return self._cache[alias]['data']
-        else:  # no cache data
-            return self.__addCacheData(alias, count, forcequery)
+                results[alias] = data
+        if missing:
+            fetched = self.__fetchMany(missing)
+            for alias, count in missing:
+                results[alias] = fetched.get((alias, count), False)
+        if columnar:
+            for alias in results:
+                if isinstance(results[alias], list):
+                    results[alias] = to_columns(results[alias])
+        return results
+
+    def watch(self, manager, alias):
+        '''Subscribes to alias with manager, a subscribe.SubscriptionManager,
+        so that cached reads of it are dropped as soon as a point is
+        written to it rather than after 'read_cache_expire_time'. Returns
+        the Subscription, or False if alias doesn't exist.'''
+        rid = self.__lookup(alias)
+        if not rid:
+            return False
+
+        def invalidate(rid, point):
+            self._cache.invalidate(alias)
+        return manager.subscribe(self._cik, rid, callback=invalidate)
+
+    def cache_stats(self):
+        '''Returns the read cache's size and hit, miss, eviction and
+        expiration counts.'''
+        return self._cache.stats()
+
+    def invalidate(self, alias=None):
+        '''Drops alias (or every alias) from the read cache, so the next
+        read() gets it from the platform.'''
+        self._cache.invalidate(alias)
 
     def record(self, alias, entries):
+        if self._spool is not None:
+            if not (self._auto or self.__lookup(alias)):
+                return False
+            self._spool.append(alias, entries)
+            return True
         if self.__isBufferFull() or not (self._auto or self.__lookup(alias)):
             return False
-        lock.acquire()
+        self.__shard(alias).addRecords(
+            alias, [[t, value, False] for (t, value) in entries])
+        if self.__bufferCount() >= self._highwater:
+            self.__wakeFlusher()
+        return True
+
+    def flush(self, wait=False, timeout=None):
+        '''Asks the flush thread to flush now rather than at the end of the
+        interval. If wait is True, waits up to timeout seconds (None for
+        no limit) for the flush to finish and returns True if it did. If
+        the flush thread isn't running, flushes in the calling thread.'''
+        if not self.isThreadAlive():
+            return self.__flushAll()
+        self._wake.acquire()
         try:
-            if not alias in self._recordBuffer:
-                self._recordBuffer[alias] = list()
-            for (t, value) in entries:
-                recentry = [t, value, False]
-                self._recordBuffer[alias].append(recentry)
+            target = self._flushesStarted + 1
+            self._flushRequested = True
+            self._wake.notify_all()
         finally:
-            lock.release()
+            self._wake.release()
+        if self._hub is not None:
+            self._hub._wakeup(self._cik)
+        if not wait:
+            return True
+        return self.__waitUntil(
+            lambda: self._flushesDone >= target or not self._running,
+            timeout)
 
     def restart(self):
-        self.stop(force=True)
+        self.stop(force=True, wait=True)
         self.start()
 
     def start(self, daemon=False):
-        time.sleep(1)
-        self._killed = False
-        self._forceterminate = False
+        '''Starts the flush thread, or if the Datastore belongs to a
+        DatastoreHub, starts flushing with the hub's threads.'''
+        self._wake.acquire()
+        try:
+            self._killed = False
+            self._forceterminate = False
+            self._backoff = 0
+            self._nextFlush = time.time() + self._interval
+            self._running = True
+        finally:
+            self._wake.release()
+        if self._hub is not None:
+            self._hub._wakeup(self._cik)
+            return
         self._thread = threading.Thread(target=self.__processJsonRPC)
-        self._thread.setDaemon(daemon)
+        self._thread.daemon = daemon
         self._thread.start()
 
-    def stop(self, force=False):
-        self._killed = True
-        self._forceterminate = force
+    def stop(self, force=False, wait=False, timeout=None):
+        '''Stops the flush thread. Unless force is True, the thread first
+        flushes until the buffers are empty. If wait is True, waits up to
+        timeout seconds (None for no limit) for the thread to finish. If it
+        hasn't by then, it's forced to stop once its current request
+        returns, and False is returned without waiting any longer, since
+        the request may be stuck. Otherwise returns True if nothing was
+        left unflushed.'''
+        self._wake.acquire()
+        try:
+            self._killed = True
+            self._forceterminate = force
+            self._wake.notify_all()
+        finally:
+            self._wake.release()
+        if self._hub is not None:
+            self._hub._wakeup(self._cik)
+            if wait and not self.__waitUntil(lambda: not self._running,
+                                             timeout):
+                self.stop(force=True)
+                return False
+        elif wait and self._thread is not None:
+            self._thread.join(timeout)
+            if self._thread.is_alive():
+                self.stop(force=True)
+                return False
+        return self.__bufferCount() == 0
 
     def write(self, alias, value):
+        if self._spool is not None:
+            # spooled writes are recorded with the time of the write
+            if not (self._auto or self.__lookup(alias)):
+                return False
+            self._spool.append(alias, [[int(time.time()), value]])
+            return True
         if self.__isBufferFull() or not (self._auto or self.__lookup(alias)):
             return False
+        elif self._config.get('lossless'):
+            # keep every sample with the time it was written, the latest
+            # one per second since that's all the platform keeps
+            if not self.__shard(alias).addSample(alias, int(time.time()),
+                                                 value):
+                log.debug("Replaced the sample of %s this second", alias)
+                return False
+            if self.__bufferCount() >= self._highwater:
+                self.__wakeFlusher()
+            return True
         else:
-            lock.acquire()
+            shard = self.__shard(alias)
+            shard.lock.acquire()
             try:
-                if alias in self._liveBuffer:
-                    self._liveBuffer[alias] = value
-                    msg = "Update the (alias,value) in buffer:%s,%s"
-                    log.debug(msg % (alias, value))
+                if alias in shard.liveBuffer:
+                    shard.liveBuffer[alias] = value
+                    log.debug("Update the (alias,value) in buffer:%s,%s",
+                              alias, value)
                     return False
                 else:
-                    self._liveBuffer[alias] = value
+                    shard.liveBuffer[alias] = value
             finally:
-                lock.release()
-            log.debug("Current buffer count: %s" % self.__bufferCount())
-            log.debug("Add to buffer:%s,%s" % (alias, value))
+                shard.lock.release()
+            if self.__bufferCount() >= self._highwater:
+                self.__wakeFlusher()
+            if log.isEnabledFor(logging.DEBUG):
+                # counting walks every shard, so only when it's logged
+                log.debug("Current buffer count: %s", self.__bufferCount())
+                log.debug("Add to buffer:%s,%s", alias, value)
             return True
+
+
+class DatastoreHub():
+    '''Runs the Datastores of many devices (CIKs) with one scheduler thread
+    and a few worker threads, over one shared connection pool, so that
+    the number of threads and connections doesn't grow with the number of
+    devices. Each device keeps its own buffers and caches, and its data is
+    flushed in batched requests for its CIK.
+
+        interval: seconds between each device's flushes
+        workers: number of devices flushed at once
+        shards: buffer shards per device. A device is rarely written by
+                many threads at once, and fewer shards keep its memory small.
+        pool: onephttp.ConnectionPool to share. By default the hub creates
+              one.
+        workerpool: workerpool.WorkerPool whose threads send the record
+                    requests of a flush concurrently (see 'record_workers').
+                    By default the hub creates one with workers threads.
+
+    autocreate, config, transport and aliascache are as for Datastore, and
+    apply to every device. Use add() to get the Datastore for a CIK.'''
+    def __init__(self,
+                 interval,
+                 autocreate=False,
+                 config=datastore_config,
+                 transport=transport_config,
+                 aliascache=None,
+                 workers=4,
+                 shards=1,
+                 pool=None,
+                 workerpool=None):
+        if pool is None:
+            pool = ConnectionPool(maxsize=max(workers, 10))
+        if workerpool is None:
+            workerpool = WorkerPool(workers)
+        self._interval = max(interval, 1)
+        self._auto = autocreate
+        self._config = dict(config, buffer_shards=shards)
+        self._transport = dict(transport, pool=pool, workerpool=workerpool)
+        self._aliases = aliascache
+        self._workers = workers
+        # cik -> Datastore
+        self._datastores = dict()
+        # CIKs queued for or being flushed by a worker
+        self._busy = set()
+        # heap of (time, cik) when each Datastore is next checked, and
+        # cik -> that time. Entries of the heap that don't match
+        # _scheduled are stale and skipped.
+        self._heap = list()
+        self._scheduled = dict()
+        self._queue = queue.Queue()
+        self._wake = threading.Condition(threading.Lock())
+        self._running = False
+        self._killed = False
+        self._threads = list()
+
+    def add(self, cik, autocreate=None, spool=None):
+        '''Returns the Datastore for cik, creating it if needed. It's
+        started if the hub is running.'''
+        self._wake.acquire()
+        try:
+            datastore = self._datastores.get(cik)
+            if datastore is not None:
+                return datastore
+            if autocreate is None:
+                autocreate = self._auto
+            datastore = Datastore(cik,
+                                  self._interval,
+                                  autocreate,
+                                  self._config,
+                                  self._transport,
+                                  aliascache=self._aliases,
+                                  spool=spool,
+                                  hub=self)
+            self._datastores[cik] = datastore
+            running = self._running and not self._killed
+        finally:
+            self._wake.release()
+        if running:
+            datastore.start()
+        return datastore
+
+    def get(self, cik):
+        '''Returns the Datastore for cik, or None.'''
+        return self._datastores.get(cik)
+
+    def remove(self, cik, force=False, timeout=None):
+        '''Stops the Datastore for cik, flushing it unless force is True,
+        and removes it from the hub. Returns the Datastore, or None.'''
+        datastore = self._datastores.get(cik)
+        if datastore is None:
+            return None
+        # the scheduler only flushes Datastores in the hub, so remove it
+        # once it has stopped
+        if datastore._running:
+            datastore.stop(force=force, wait=self.isThreadAlive(),
+                           timeout=timeout)
+        self._wake.acquire()
+        try:
+            if self._datastores.get(cik) is datastore:
+                del self._datastores[cik]
+        finally:
+            self._wake.release()
+        return datastore
+
+    def isThreadAlive(self):
+        return bool(self._threads) and self._threads[0].is_alive()
+
+    def start(self, daemon=False):
+        '''Starts the scheduler and worker threads, and every Datastore.'''
+        self._running = True
+        self._killed = False
+        self._threads = [threading.Thread(target=self.__schedule)]
+        for n in range(self._workers):
+            self._threads.append(threading.Thread(target=self.__work))
+        for thread in self._threads:
+            thread.daemon = daemon
+            thread.start()
+        for datastore in list(self._datastores.values()):
+            datastore.start()
+
+    def stop(self, force=False, wait=False, timeout=None):
+        '''Stops every Datastore as Datastore.stop() does, then the hub's
+        threads. If wait is True and they haven't finished after timeout
+        seconds, the Datastores are forced to stop and False is returned
+        without waiting longer. Otherwise returns True if nothing was left
+        unflushed.'''
+        self._wake.acquire()
+        try:
+            self._killed = True
+            datastores = list(self._datastores.values())
+        finally:
+            self._wake.release()
+        for datastore in datastores:
+            datastore.stop(force=force)
+        if wait:
+            deadline = None if timeout is None else time.time() + timeout
+            for thread in self._threads:
+                if deadline is None:
+                    thread.join()
+                else:
+                    thread.join(max(deadline - time.time(), 0))
+            if any([thread.is_alive() for thread in self._threads]):
+                for datastore in datastores:
+                    datastore.stop(force=True)
+                return False
+        return all([datastore._pending() == 0 for datastore in datastores])
+
+    def flush(self, wait=False, timeout=None):
+        '''Flushes every Datastore as Datastore.flush() does. Returns True
+        if all of them did.'''
+        deadline = None if timeout is None else time.time() + timeout
+        ok = True
+        for datastore in list(self._datastores.values()):
+            if deadline is not None:
+                timeout = max(deadline - time.time(), 0)
+            ok = datastore.flush(wait, timeout) and ok
+        return ok
+
+    def _wakeup(self, cik):
+        '''Makes the scheduler check now whether cik is due for a flush.'''
+        self._wake.acquire()
+        try:
+            self.__push(cik, time.time())
+        finally:
+            self._wake.release()
+
+    def __push(self, cik, when):
+        '''Schedules a check of cik at time when, unless one is scheduled
+        sooner. Must be called with self._wake held.'''
+        scheduled = self._scheduled.get(cik)
+        if scheduled is not None and scheduled <= when:
+            return
+        self._scheduled[cik] = when
+        heapq.heappush(self._heap, (when, cik))
+        if len(self._heap) > 2 * len(self._scheduled) + 16:
+            self._heap = [(w, c) for (w, c) in self._heap
+                          if self._scheduled.get(c) == w]
+            heapq.heapify(self._heap)
+        self._wake.notify_all()
+
+    def __schedule(self):
+        '''Hands each Datastore that is due for a flush to the workers,
+        then sleeps until the next one is due or a Datastore asks to flush
+        early. Only the Datastores whose time has come are checked, so a
+        wake-up doesn't cost a walk over every Datastore. Exits once the
+        hub is stopped and every Datastore is done.'''
+        while True:
+            self._wake.acquire()
+            try:
+                checks = list()
+                now = time.time()
+                while self._heap and self._heap[0][0] <= now:
+                    when, cik = heapq.heappop(self._heap)
+                    if self._scheduled.get(cik) != when:
+                        # superseded by a sooner check
+                        continue
+                    del self._scheduled[cik]
+                    datastore = self._datastores.get(cik)
+                    # a busy Datastore is checked again once flushed
+                    if datastore is not None and cik not in self._busy:
+                        checks.append((cik, datastore))
+                if self._killed and not (checks or self._scheduled
+                                         or self._busy):
+                    break
+                if not checks:
+                    wait = self._interval
+                    if self._heap:
+                        wait = min(wait, self._heap[0][0] - now)
+                    self._wake.wait(wait)
+            finally:
+                self._wake.release()
+            for cik, datastore in checks:
+                remaining = datastore._dueIn()
+                self._wake.acquire()
+                try:
+                    if remaining is None:
+                        # stopped
+                        pass
+                    elif remaining > 0:
+                        self.__push(cik, time.time() + remaining)
+                    else:
+                        self._busy.add(cik)
+                        self._queue.put(datastore)
+                finally:
+                    self._wake.release()
+        self._running = False
+        for n in range(self._workers):
+            self._queue.put(None)
+
+    def __work(self):
+        while True:
+            datastore = self._queue.get()
+            if datastore is None:
+                return
+            try:
+                datastore._flushOnce()
+            except Exception:
+                log.exception("Unknown Exception While Flushing")
+            remaining = datastore._dueIn()
+            self._wake.acquire()
+            try:
+                self._busy.discard(datastore._cik)
+                if remaining is not None:
+                    self.__push(datastore._cik, time.time() + remaining)
+                self._wake.notify_all()
+            finally:
+                self._wake.release()
@@ -25,6 +25,12 @@ class JsonRPCResponseException(OneException):
 class JsonStringException(OneException):
     pass
 
+class ConnectionPoolException(OneException):
+    pass
+
+class CircuitOpenException(OneException):
+    pass
+
 class ProvisionException(OneException):
     def __init__(self, provision_response):
         self.response = provision_response
@@ -0,0 +1,710 @@
+#==============================================================================
+# fakeserver.py
+# In-process stand-in for the One Platform, for tests and benchmarks.
+#==============================================================================
+#
+# FakeOnePlatform serves the JSON RPC API at /onep:v1/rpc/process and the
+# /provision interface from memory, on a local port, so that the client can
+# be tested and measured without a portal or a network connection:
+#
+#     server = FakeOnePlatform(latency=0.05, error_rate=0.01)
+#     server.start()
+#     cik = server.create_client()
+#     o = onep.OnepV1(server.host, server.port)
+#     ...
+#     server.stop()
+#
+# Latency, errors and rate limits can be injected, with a seed so that runs
+# are reproducible. Only the parts of the platform this library uses are
+# implemented, and they are not a reference for the platform's behavior.
+#
+# Copyright (c) 2014, Exosite LLC
+# All rights reserved.
+#
+import json
+import random
+import sys
+import threading
+import time
+import zlib
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+except ImportError:
+    # python 3
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+
+RPC_PATH = '/onep:v1/rpc/process'
+
+
+class RPCError(Exception):
+    '''Fails a single call with status.'''
+    def __init__(self, status):
+        Exception.__init__(self, status)
+        self.status = status
+
+
+class ProvisionError(Exception):
+    '''Fails a provision request with an HTTP status.'''
+    def __init__(self, code, body=''):
+        Exception.__init__(self, code)
+        self.code = code
+        self.body = body
+
+
+class Resource():
+    def __init__(self, rid, type, desc, parent):
+        self.rid = rid
+        self.type = type
+        self.desc = desc
+        self.parent = parent
+        self.children = []
+        # clients only
+        self.key = None
+        # alias -> rid
+        self.aliases = {}
+        # list of [timestamp, value], oldest first
+        self.data = []
+
+
+class FakeOnePlatform():
+    '''In-memory One Platform served over HTTP on host:port.
+
+        port: port to listen on, 0 for any free port
+        latency: seconds added to each request, or (min, max) for a random
+                 delay in that range
+        error_rate: fraction of requests that fail with HTTP 500
+        rate_limit: requests per second allowed per CIK (or provision key).
+                    Requests over the limit fail with HTTP 429.
+        seed: seed for the random latency and errors
+        compress_min_bytes: responses at least this long are gzipped for
+                            clients that accept it. None never compresses.
+                            Gzipped request bodies are always accepted.
+
+    Settings can be changed while the server runs. Counters of requests,
+    calls and injected failures are returned by stats().'''
+    def __init__(self,
+                 host='127.0.0.1',
+                 port=0,
+                 latency=0,
+                 error_rate=0,
+                 rate_limit=None,
+                 seed=None,
+                 compress_min_bytes=1024):
+        self.host = host
+        self.compress_min_bytes = compress_min_bytes
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        # notified whenever a point is written, for wait
+        self._written = threading.Condition(self._lock)
+        self._resources = {}
+        self._ciks = {}
+        # CIK -> (second, number of requests in it)
+        self._windows = {}
+        # vendor key (CIK or token) -> vendor name
+        self._vendorkeys = {}
+        # vendor name -> {'token', 'models', 'content'}
+        self._vendors = {}
+        self._counters = {'requests': 0,
+                          'calls': 0,
+                          'errors_injected': 0,
+                          'rate_limited': 0,
+                          'requests_compressed': 0,
+                          'responses_compressed': 0}
+        self.root = self._newResource('client', {'name': 'root'}, None)
+        self.root.key = self._newKey()
+        self._ciks[self.root.key] = self.root.rid
+        self._httpd = _HTTPServer((host, port), _Handler)
+        self._httpd.platform = self
+        self.port = self._httpd.server_address[1]
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        self._thread.join()
+
+    def create_client(self, name='client', parent=None):
+        '''Creates a client under parent (a CIK, by default the root
+        client) and returns its CIK.'''
+        self._lock.acquire()
+        try:
+            if parent is None:
+                owner = self.root
+            else:
+                owner = self._resources[self._ciks[parent]]
+            client = self._newClient({'name': name}, owner)
+            return client.key
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        self._lock.acquire()
+        try:
+            return dict(self._counters)
+        finally:
+            self._lock.release()
+
+    # request handling below, called from the server's threads
+
+    def _count(self, name):
+        self._lock.acquire()
+        try:
+            self._counters[name] += 1
+        finally:
+            self._lock.release()
+
+    def _inject(self, key):
+        '''Applies the injected latency, rate limit and errors to a request
+        made with key. Returns an HTTP status to fail it with, or None.'''
+        self._lock.acquire()
+        try:
+            self._counters['requests'] += 1
+            latency = self.latency
+            if isinstance(latency, (tuple, list)):
+                latency = self._random.uniform(latency[0], latency[1])
+            failed = self._random.random() < self.error_rate
+            limited = False
+            if self.rate_limit is not None:
+                second = int(time.time())
+                window, count = self._windows.get(key, (second, 0))
+                if window != second:
+                    count = 0
+                count += 1
+                self._windows[key] = (second, count)
+                limited = count > self.rate_limit
+            if limited:
+                self._counters['rate_limited'] += 1
+            elif failed:
+                self._counters['errors_injected'] += 1
+        finally:
+            self._lock.release()
+        if latency:
+            time.sleep(latency)
+        if limited:
+            return 429
+        if failed:
+            return 500
+        return None
+
+    def _rpc(self, body):
+        '''Handles a JSON RPC request body. Returns (HTTP status, response).'''
+        try:
+            req = json.loads(body.decode('utf-8'))
+            auth = req['auth']
+            calls = req['calls']
+        except Exception:
+            return 400, {'error': {'code': 400, 'message': 'Bad Request'}}
+        code = self._inject(auth.get('cik'))
+        if code is not None:
+            return code, {'error': {'code': code,
+                                    'message': 'Injected failure'}}
+        self._lock.acquire()
+        try:
+            client = self._authenticate(auth)
+            if client is None:
+                return 200, {'error': {'code': 401,
+                                       'message': 'Invalid',
+                                       'context': 'auth'}}
+            self._counters['calls'] += len(calls)
+        finally:
+            self._lock.release()
+        response = []
+        for call in calls:
+            result = {'id': call.get('id')}
+            try:
+                procedure = getattr(self, '_rpc_' + call['procedure'], None)
+                if procedure is None:
+                    raise RPCError('invalid')
+                if call['procedure'] == 'wait':
+                    # waits without holding the lock
+                    res = procedure(client, *call['arguments'])
+                else:
+                    self._lock.acquire()
+                    try:
+                        res = procedure(client, *call['arguments'])
+                    finally:
+                        self._lock.release()
+                result['status'] = 'ok'
+                if res is not None:
+                    result['result'] = res
+            except RPCError:
+                e = sys.exc_info()[1]
+                result['status'] = e.status
+            except (TypeError, ValueError, KeyError, IndexError):
+                result['status'] = 'invalid'
+            response.append(result)
+        return 200, response
+
+    def _newKey(self):
+        return '%040x' % self._random.getrandbits(160)
+
+    def _newResource(self, type, desc, parent):
+        resource = Resource(self._newKey(), type, desc, parent)
+        self._resources[resource.rid] = resource
+        if parent is not None:
+            parent.children.append(resource.rid)
+        return resource
+
+    def _newClient(self, desc, parent):
+        client = self._newResource('client', desc, parent)
+        client.key = self._newKey()
+        self._ciks[client.key] = client.rid
+        return client
+
+    def _authenticate(self, auth):
+        '''Returns the client that auth identifies, or None.'''
+        rid = self._ciks.get(auth.get('cik'))
+        if rid is None:
+            return None
+        client = self._resources[rid]
+        target = auth.get('client_id') or auth.get('resource_id')
+        if target is not None:
+            if not self._isOwner(client, target):
+                return None
+            client = self._resources[target]
+        return client
+
+    def _isOwner(self, client, rid):
+        resource = self._resources.get(rid)
+        while resource is not None:
+            if resource is client:
+                return True
+            resource = resource.parent
+        return False
+
+    def _resolve(self, client, rid):
+        '''Returns the resource for a call argument, which is an RID or
+        {'alias': alias}, with '' meaning the client itself.'''
+        if isinstance(rid, dict):
+            alias = rid.get('alias')
+            if alias == '':
+                return client
+            rid = client.aliases.get(alias)
+        resource = self._resources.get(rid)
+        if resource is None or not self._isOwner(client, rid):
+            raise RPCError('invalid')
+        return resource
+
+    def _drop(self, resource):
+        for rid in list(resource.children):
+            self._drop(self._resources[rid])
+        del self._resources[resource.rid]
+        if resource.key is not None:
+            del self._ciks[resource.key]
+        if resource.parent is not None:
+            parent = resource.parent
+            parent.children.remove(resource.rid)
+            for alias, rid in list(parent.aliases.items()):
+                if rid == resource.rid:
+                    del parent.aliases[alias]
+
+    def _append(self, resource, points):
+        if resource.type not in ('dataport', 'datarule'):
+            raise RPCError('invalid')
+        # the platform keeps one point per timestamp, so a point at the
+        # timestamp of another replaces it
+        data = dict((p[0], p) for p in resource.data)
+        for point in points:
+            data[point[0]] = list(point)
+        resource.data = sorted(data.values(), key=lambda p: p[0])
+        self._written.notify_all()
+
+    # RPC procedures, called with self._lock held (except wait)
+
+    def _rpc_create(self, client, type, desc):
+        if type == 'client':
+            resource = self._newClient(desc, client)
+        else:
+            resource = self._newResource(type, desc, client)
+        return resource.rid
+
+    def _rpc_drop(self, client, rid):
+        resource = self._resolve(client, rid)
+        if resource is client:
+            raise RPCError('restricted')
+        self._drop(resource)
+
+    def _rpc_map(self, client, type, rid, alias):
+        resource = self._resolve(client, rid)
+        if alias in client.aliases:
+            raise RPCError('invalid')
+        client.aliases[alias] = resource.rid
+
+    def _rpc_unmap(self, client, type, alias):
+        if alias not in client.aliases:
+            raise RPCError('invalid')
+        del client.aliases[alias]
+
+    def _rpc_lookup(self, client, type, mapping):
+        if type == 'alias':
+            return self._resolve(client, {'alias': mapping}).rid
+        if type == 'owner':
+            resource = self._resolve(client, mapping)
+            if resource.parent is None:
+                raise RPCError('invalid')
+            return resource.parent.rid
+        raise RPCError('invalid')
+
+    def _rpc_info(self, client, rid, options={}):
+        resource = self._resolve(client, rid)
+        info = {'basic': {'type': resource.type},
+                'description': resource.desc,
+                'key': resource.key,
+                'aliases': {},
+                'subscribers': [],
+                'tags': []}
+        aliases = info['aliases']
+        for alias, aliasrid in resource.aliases.items():
+            aliases.setdefault(aliasrid, []).append(alias)
+        if options:
+            info = dict((k, v) for k, v in info.items() if options.get(k))
+        return info
+
+    def _rpc_listing(self, client, *args):
+        if len(args) == 1:
+            # deprecated, a list of lists in the order of types
+            return [[rid for rid in client.children
+                     if self._resources[rid].type == type]
+                    for type in args[0]]
+        if len(args) == 3:
+            client = self._resolve(client, args[0])
+            args = args[1:]
+        return dict((type, [rid for rid in client.children
+                            if self._resources[rid].type == type])
+                    for type in args[0])
+
+    def _rpc_read(self, client, rid, options):
+        resource = self._resolve(client, rid)
+        starttime = options.get('starttime', 0)
+        endtime = options.get('endtime', time.time() + 1)
+        points = [p for p in resource.data if starttime <= p[0] <= endtime]
+        if options.get('sort', 'desc') == 'desc':
+            points.reverse()
+        return points[:options.get('limit', 1)]
+
+    def _rpc_write(self, client, rid, value, options={}):
+        self._append(self._resolve(client, rid), [[int(time.time()), value]])
+
+    def _rpc_writegroup(self, client, entries):
+        now = int(time.time())
+        resources = [(self._resolve(client, rid), value)
+                     for rid, value in entries]
+        for resource, value in resources:
+            self._append(resource, [[now, value]])
+
+    def _rpc_record(self, client, rid, entries, options={}):
+        now = int(time.time())
+        points = []
+        for t, value in entries:
+            if t <= 0:
+                # offset from now
+                t = now + t
+            points.append([t, value])
+        self._append(self._resolve(client, rid), points)
+
+    def _rpc_wait(self, client, rid, options={}):
+        deadline = time.time() + options.get('timeout', 30000) / 1000.0
+        self._lock.acquire()
+        try:
+            resource = self._resolve(client, rid)
+            since = options.get('since')
+            if since is None:
+                since = resource.data[-1][0] if resource.data else 0
+            while True:
+                if resource.rid not in self._resources:
+                    raise RPCError('invalid')
+                if resource.data and resource.data[-1][0] > since:
+                    return resource.data[-1]
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise RPCError('expire')
+                self._written.wait(remaining)
+        finally:
+            self._lock.release()
+
+    # provision interface below
+
+    def _provision(self, method, path, query, body, headers):
+        '''Handles a /provision request. Returns (HTTP status, body).'''
+        key = headers.get('X-Exosite-CIK') or headers.get('X-Exosite-Token')
+        code = self._inject(key)
+        if code is not None:
+            return code, ''
+        params = parse_qs(query, keep_blank_values=True)
+        if method in ('POST', 'PUT', 'DELETE') and body and not \
+                headers.get('Content-Type', '').startswith(
+                    'application/x-www-form-urlencoded'):
+            form = {}
+        else:
+            form = parse_qs(body.decode('utf-8'), keep_blank_values=True)
+        self._lock.acquire()
+        try:
+            try:
+                return 200, self._provisionRoute(
+                    method, path.split('/')[2:], key, params, form, body,
+                    headers)
+            except ProvisionError:
+                e = sys.exc_info()[1]
+                return e.code, e.body
+        finally:
+            self._lock.release()
+
+    def _vendor(self, key):
+        name = self._vendorkeys.get(key)
+        if name is None:
+            raise ProvisionError(401, 'Unauthorized')
+        return self._vendors[name]
+
+    def _provisionRoute(self, method, parts, key, params, form, body,
+                        headers):
+        def one(params, name):
+            return params.get(name, [''])[0]
+        if parts == ['register']:
+            if method == 'GET':
+                name = self._vendorkeys.get(key)
+                if name is None:
+                    raise ProvisionError(401, 'Unauthorized')
+                return 'vendor=' + name
+            name = one(form, 'vendor')
+            if one(form, 'delete') == 'true':
+                self._vendor(key)
+                for k in [k for k, n in self._vendorkeys.items()
+                          if n == name]:
+                    del self._vendorkeys[k]
+                del self._vendors[name]
+                return ''
+            if not name or name in self._vendors:
+                raise ProvisionError(409, 'Conflict')
+            token = self._newKey()
+            self._vendors[name] = {'name': name,
+                                   'token': token,
+                                   'models': {},
+                                   'content': {}}
+            self._vendorkeys[key] = name
+            self._vendorkeys[token] = name
+            return 'token=' + token
+        if parts == ['activate']:
+            return self._activate(one(form, 'vendor'), one(form, 'model'),
+                                  one(form, 'sn'))
+        if parts == ['download']:
+            vendor = self._vendors.get(one(params, 'vendor'))
+            if vendor is None:
+                raise ProvisionError(404, 'Not Found')
+            content = vendor['content'].get(one(params, 'model'), {}).get(
+                one(params, 'id'))
+            if content is None:
+                raise ProvisionError(404, 'Not Found')
+            if one(params, 'info') == 'true':
+                return self._contentInfo(content)
+            return content['data']
+        if parts[:2] == ['manage', 'model']:
+            return self._manageModel(method, parts[2:], self._vendor(key),
+                                     params, form)
+        if parts[:2] == ['manage', 'content']:
+            return self._manageContent(method, parts[2:], self._vendor(key),
+                                       form, body, headers)
+        raise ProvisionError(404, 'Not Found')
+
+    def _model(self, vendor, name):
+        model = vendor['models'].get(name)
+        if model is None:
+            raise ProvisionError(404, 'Not Found')
+        return model
+
+    def _manageModel(self, method, parts, vendor, params, form):
+        def one(params, name):
+            return params.get(name, [''])[0]
+        models = vendor['models']
+        if parts in ([], ['']):
+            if method == 'GET':
+                return '\r\n'.join(sorted(models.keys()))
+            name = one(form, 'model')
+            if not name or name in models:
+                raise ProvisionError(409, 'Conflict')
+            models[name] = {'rid': one(form, 'rid') or one(form, 'code'),
+                            'options': form.get('options[]', []),
+                            'serials': {}}
+            return ''
+        model = self._model(vendor, parts[0])
+        serials = model['serials']
+        if len(parts) == 1:
+            if method == 'GET':
+                return 'rid=%s' % model['rid']
+            if method == 'PUT':
+                model['rid'] = one(form, 'rid')
+                return ''
+            if method == 'DELETE':
+                del models[parts[0]]
+                return ''
+        elif parts[1] == '':
+            if method == 'GET':
+                offset = int(one(params, 'offset') or 0)
+                limit = int(one(params, 'limit') or 1000)
+                return '\r\n'.join(sorted(serials.keys())[offset:offset + limit])
+            if one(form, 'add') == 'true':
+                sns = form.get('sn[]', []) + form.get('sn', [])
+                for sn in sns:
+                    serials.setdefault(sn, {'status': 'notactivated',
+                                            'rid': '',
+                                            'cik': None})
+                return ''
+            if one(form, 'remove') == 'true':
+                for sn in form.get('sn[]', []):
+                    serials.pop(sn, None)
+                return ''
+        else:
+            sn = parts[1]
+            serial = serials.get(sn)
+            if serial is None:
+                raise ProvisionError(404, 'Not Found')
+            if method == 'GET':
+                return ','.join([serial['status'], serial['rid'], ''])
+            if method == 'DELETE':
+                del serials[sn]
+                return ''
+            if one(form, 'disable') == 'true':
+                serial['status'] = 'expired'
+                return ''
+            if one(form, 'enable') == 'true':
+                oldsn = one(form, 'oldsn')
+                if oldsn:
+                    old = serials.pop(oldsn, None)
+                    if old is None:
+                        raise ProvisionError(404, 'Not Found')
+                    serial.update(old)
+                else:
+                    serial['status'] = 'notactivated'
+                return ''
+        raise ProvisionError(400, 'Bad Request')
+
+    def _activate(self, vendorname, modelname, sn):
+        vendor = self._vendors.get(vendorname)
+        if vendor is None:
+            raise ProvisionError(404, 'Not Found')
+        serial = self._model(vendor, modelname)['serials'].get(sn)
+        if serial is None:
+            raise ProvisionError(404, 'Not Found')
+        if serial['status'] != 'notactivated':
+            raise ProvisionError(409, 'Conflict')
+        client = self._newClient({'name': sn}, self.root)
+        serial.update(status='activated', rid=client.rid, cik=client.key)
+        return client.key
+
+    def _contentInfo(self, content):
+        return ','.join([content['type'],
+                         str(len(content['data'])),
+                         str(content['updated']),
+                         content['meta'],
+                         'true' if content['protected'] else 'false'])
+
+    def _manageContent(self, method, parts, vendor, form, body, headers):
+        def one(params, name):
+            return params.get(name, [''])[0]
+        if not parts:
+            raise ProvisionError(404, 'Not Found')
+        contents = vendor['content'].setdefault(parts[0], {})
+        if len(parts) == 1 or parts[1] == '':
+            if method == 'GET':
+                return '\r\n'.join(sorted(contents.keys()))
+            contentid = one(form, 'id')
+            if not contentid or contentid in contents:
+                raise ProvisionError(409, 'Conflict')
+            contents[contentid] = {'meta': one(form, 'meta'),
+                                   'protected': one(form, 'protected') == 'true',
+                                   'type': '',
+                                   'data': '',
+                                   'updated': int(time.time())}
+            return ''
+        content = contents.get(parts[1])
+        if content is None:
+            raise ProvisionError(404, 'Not Found')
+        if method == 'GET':
+            return self._contentInfo(content)
+        if method == 'DELETE':
+            del contents[parts[1]]
+            return ''
+        content['type'] = headers.get('Content-Type', '')
+        content['data'] = body.decode('utf-8')
+        content['updated'] = int(time.time())
+        return ''
+
+
+class _HTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    # many clients connect at once in benchmarks
+    request_queue_size = 1024
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        if self.headers.get('Content-Encoding') == 'gzip':
+            self.server.platform._count('requests_compressed')
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        return body
+
+    def _send(self, code, body, contenttype):
+        if not isinstance(body, bytes):
+            body = body.encode('utf-8')
+        platform = self.server.platform
+        compress = (platform.compress_min_bytes is not None
+                    and len(body) >= platform.compress_min_bytes
+                    and 'gzip' in self.headers.get('Accept-Encoding', ''))
+        if compress:
+            platform._count('responses_compressed')
+            compressor = zlib.compressobj(6, zlib.DEFLATED,
+                                          16 + zlib.MAX_WBITS)
+            body = compressor.compress(body) + compressor.flush()
+        self.send_response(code)
+        self.send_header('Content-Type', contenttype)
+        if compress:
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _handle(self, method):
+        platform = self.server.platform
+        url = urlparse(self.path)
+        body = self._body()
+        if method == 'POST' and url.path == RPC_PATH:
+            code, response = platform._rpc(body)
+            self._send(code, json.dumps(response),
+                       'application/json; charset=utf-8')
+        elif url.path.startswith('/provision/'):
+            code, response = platform._provision(method, url.path, url.query,
+                                                 body, self.headers)
+            self._send(code, response, 'text/plain; charset=utf-8')
+        else:
+            self._send(404, 'Not Found', 'text/plain; charset=utf-8')
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def do_PUT(self):
+        self._handle('PUT')
+
+    def do_DELETE(self):
+        self._handle('DELETE')
@@ -0,0 +1,190 @@
+#==============================================================================
+# instrument.py
+# Timings and sizes of requests to the platform.
+#==============================================================================
+#
+# OnePHTTP (and so OnepV1, Provision and Datastore) takes a list of
+# listeners. Each HTTP request is described by a RequestEvent that is
+# passed to every listener's request_start() before it's sent and
+# request_end() once its response has been read or it has failed:
+#
+#     collector = HistogramCollector()
+#     o = onep.OnepV1(listeners=[collector])
+#     ...
+#     collector.summary()
+#     {'read': {'count': 120, 'errors': 0, 'p50': 0.081, 'p99': 0.412}, ...}
+#
+# Copyright (c) 2014, Exosite LLC
+# All rights reserved.
+#
+import logging
+import math
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+class RequestEvent():
+    '''One HTTP request and its response. Times are in seconds, and are
+    None if they don't apply, e.g. connect_time for a reused connection.
+
+        kind: 'rpc', 'provision' or 'http'
+        procedures: the RPC procedures in the request, or for provisioning
+                    the method and resource, e.g. 'GET /provision/manage/model'
+        calls: the number of calls in the request
+        attempt: 0 for the first request of a call, n for its nth retry
+        connect_time: time to resolve the host and open the connection
+        tls_time: time for the TLS handshake
+        ttfb: time from sending the request to reading the response headers
+        total_time: time from request() until the body has been read
+        request_bytes: size of the body sent, after compression
+        response_bytes: size of the body received, before decompression
+        reused: whether the request was sent on an open connection
+        status: HTTP status of the response
+        error: class name of the exception that failed the request'''
+    def __init__(self, host, method, path, info=None):
+        self.host = host
+        self.method = method
+        self.path = path
+        self.kind = 'http'
+        self.procedures = []
+        self.calls = 0
+        self.attempt = 0
+        self.started = time.time()
+        self.sent = None
+        self.connect_time = None
+        self.tls_time = None
+        self.ttfb = None
+        self.total_time = None
+        self.request_bytes = 0
+        self.response_bytes = 0
+        self.reused = None
+        self.status = None
+        self.error = None
+        if info:
+            for name in info:
+                setattr(self, name, info[name])
+
+    def __repr__(self):
+        return '<RequestEvent %s %s %s>' % (self.method, self.path,
+                                            self.__dict__)
+
+
+class Listener():
+    '''Base class for listeners. Override the methods for the events
+    wanted. They are called from the thread making the request, so must be
+    quick and thread-safe.'''
+    def request_start(self, event):
+        pass
+
+    def request_end(self, event):
+        pass
+
+
+def notify(listeners, name, event):
+    '''Calls method name of each listener with event. A listener that
+    raises is logged, and doesn't fail the request.'''
+    for listener in listeners:
+        try:
+            getattr(listener, name)(event)
+        except Exception:
+            log.exception("Instrumentation listener %r failed" % listener)
+
+
+class Histogram():
+    '''Counts values in buckets whose bounds grow by factor, so it takes
+    little memory however many values are added, and percentiles are
+    within factor of the exact value.'''
+    def __init__(self, factor=1.05, minimum=1e-6):
+        self.factor = factor
+        self.minimum = minimum
+        self._log = math.log(factor)
+        self.buckets = {}
+        self.count = 0
+        self.max = None
+
+    def add(self, value):
+        if value < self.minimum:
+            value = self.minimum
+        bucket = int(math.ceil(math.log(value / self.minimum) / self._log))
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        self.count += 1
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, p):
+        '''Returns the upper bound of the bucket holding the pth percentile
+        (0 to 100), or None if there are no values.'''
+        if not self.count:
+            return None
+        rank = max(1, int(math.ceil(self.count * p / 100.0)))
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return min(self.minimum * self.factor ** bucket, self.max)
+        return self.max
+
+
+def procedure_keys(event):
+    '''Returns the keys HistogramCollector files event under by default:
+    each distinct procedure in it, or its method and path.'''
+    if event.procedures:
+        return sorted(set(event.procedures))
+    return [event.method + ' ' + event.path.split('?')[0]]
+
+
+class HistogramCollector(Listener):
+    '''Collects a Histogram of total_time per key, and counts of errors.
+
+        keys: function returning the keys for an event. The default files
+              a multi-call request under each of its procedures.
+        percentiles: the percentiles summary() reports'''
+    def __init__(self, keys=procedure_keys, percentiles=(50, 99)):
+        self.keys = keys
+        self.percentiles = percentiles
+        self._histograms = {}
+        self._errors = {}
+        self._lock = threading.Lock()
+
+    def request_end(self, event):
+        keys = self.keys(event)
+        self._lock.acquire()
+        try:
+            for key in keys:
+                if event.error is not None or (event.status is not None
+                                               and event.status >= 400):
+                    self._errors[key] = self._errors.get(key, 0) + 1
+                histogram = self._histograms.get(key)
+                if histogram is None:
+                    histogram = Histogram()
+                    self._histograms[key] = histogram
+                histogram.add(event.total_time)
+        finally:
+            self._lock.release()
+
+    def summary(self):
+        '''Returns a dict of key -> {'count', 'errors', 'max', and 'p50'
+        etc. for each of percentiles}.'''
+        self._lock.acquire()
+        try:
+            summary = {}
+            for key, histogram in self._histograms.items():
+                stats = {'count': histogram.count,
+                         'errors': self._errors.get(key, 0),
+                         'max': histogram.max}
+                for p in self.percentiles:
+                    stats['p%s' % p] = histogram.percentile(p)
+                summary[key] = stats
+            return summary
+        finally:
+            self._lock.release()
+
+    def reset(self):
+        self._lock.acquire()
+        try:
+            self._histograms = {}
+            self._errors = {}
+        finally:
+            self._lock.release()
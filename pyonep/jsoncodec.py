@@ -0,0 +1,117 @@
+#==============================================================================
+# jsoncodec.py
+# JSON encoders/decoders for RPC request and response bodies.
+#==============================================================================
+#
+# OnepV1 uses the standard library json module by default. Pass
+# codec='auto' to use the fastest JSON library that's installed, or pass
+# the name of a library or a JsonCodec instance.
+#
+# Copyright (c) 2014, Exosite LLC
+# All rights reserved.
+#
+import sys
+import logging
+
+log = logging.getLogger(__name__)
+
+try:
+    if sys.version_info < (2, 6):
+        json_module = 'python-simplejson'
+        import simplejson as json
+    else:
+        json_module = 'python-json'
+        import json
+except ImportError:
+    log.critical("The package '%s' is required." % json_module)
+    sys.exit(1)
+
+if sys.version_info < (3, 0):
+    string_types = (str, unicode)
+else:
+    string_types = (str,)
+
+
+class JsonCodec():
+    '''Encodes request bodies and decodes response bodies with the standard
+    library json module. To use another library, override dumps() and
+    loads(). dumps() may return str or bytes, and loads() must accept
+    either.'''
+    name = 'json'
+
+    def dumps(self, obj):
+        return json.dumps(obj)
+
+    def loads(self, data):
+        if isinstance(data, bytes) and sys.version_info >= (3, 0) \
+                and sys.version_info < (3, 6):
+            data = data.decode('utf_8')
+        return json.loads(data)
+
+
+class SimplejsonCodec(JsonCodec):
+    name = 'simplejson'
+
+    def __init__(self):
+        import simplejson
+        self._simplejson = simplejson
+
+    def dumps(self, obj):
+        return self._simplejson.dumps(obj)
+
+    def loads(self, data):
+        return self._simplejson.loads(data)
+
+
+class UjsonCodec(JsonCodec):
+    name = 'ujson'
+
+    def __init__(self):
+        import ujson
+        self._ujson = ujson
+
+    def dumps(self, obj):
+        return self._ujson.dumps(obj)
+
+    def loads(self, data):
+        return self._ujson.loads(data)
+
+
+class OrjsonCodec(JsonCodec):
+    '''orjson encodes to bytes and decodes directly from bytes.'''
+    name = 'orjson'
+
+    def __init__(self):
+        import orjson
+        self._orjson = orjson
+
+    def dumps(self, obj):
+        return self._orjson.dumps(obj)
+
+    def loads(self, data):
+        return self._orjson.loads(data)
+
+
+# fastest first
+codecs = [OrjsonCodec, UjsonCodec, SimplejsonCodec, JsonCodec]
+
+
+def get_codec(codec=None):
+    '''Returns a JsonCodec instance.
+
+        codec: None for the standard library json module, 'auto' for the
+               fastest library that's installed, the name of a library
+               ('json', 'simplejson', 'ujson', 'orjson') or a JsonCodec
+               instance, which is returned as is.'''
+    if codec is None:
+        return JsonCodec()
+    if not isinstance(codec, string_types):
+        return codec
+    for cls in codecs:
+        if codec == 'auto' or codec == cls.name:
+            try:
+                return cls()
+            except ImportError:
+                if codec != 'auto':
+                    raise
+    raise ValueError("Unknown JSON codec: %s" % codec)
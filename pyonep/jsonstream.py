@@ -0,0 +1,128 @@
+#==============================================================================
+# jsonstream.py
+# Incremental decoding of large JSON RPC responses.
+#==============================================================================
+#
+# A JsonStream is fed a response body a chunk at a time, and decodes the
+# elements of the arrays at a given path as soon as each one is complete,
+# e.g. the calls of a multi-call response (path '[') or the points of a
+# read result (path '[{[', an array in a call object in the response
+# array). Only the unfinished element is kept in memory, so a large body
+# can be processed in about the memory of one chunk. Everything else in
+# the document is kept, with the streamed arrays left empty, and decoded
+# at the end.
+#
+# Copyright (c) 2014, Exosite LLC
+# All rights reserved.
+#
+import codecs
+import json
+import re
+
+_structural = re.compile(r'[\[\]{}"]')
+# the rest of a string after its opening quote
+_string = re.compile(r'(?:[^"\\]|\\.)*"', re.DOTALL)
+_separator = re.compile(r'[\s,]*')
+
+
+class JsonStream():
+    '''Decodes the elements of arrays at path in a JSON document fed to it
+    in chunks. path is the brackets of the containers the arrays are
+    nested in, ending with the array's own, e.g. '[{[' for the arrays in
+    the objects of a top level array.
+
+        for chunk in chunks:
+            for element in stream.feed(chunk):
+                ...
+        rest = stream.finish()
+
+    finish() returns the rest of the document, with the streamed arrays
+    empty. It raises ValueError if the document is incomplete or invalid.'''
+    def __init__(self, path='['):
+        self.path = list(path)
+        self._decoder = codecs.getincrementaldecoder('utf_8')()
+        self._json = json.JSONDecoder()
+        self._buffer = ''
+        self._pos = 0
+        # open brackets of the containers we are in
+        self._stack = []
+        self._skeleton = []
+
+    def _streaming(self):
+        return self._stack == self.path
+
+    def feed(self, chunk, final=False):
+        '''Adds a chunk of the document (bytes or str) and returns a list of
+        the elements it completed.'''
+        if isinstance(chunk, bytes):
+            chunk = self._decoder.decode(chunk, final)
+        self._buffer = self._buffer[self._pos:] + chunk
+        self._pos = 0
+        elements = []
+        buf = self._buffer
+        while self._pos < len(buf):
+            if self._streaming():
+                match = _separator.match(buf, self._pos)
+                self._pos = match.end()
+                if self._pos == len(buf):
+                    break
+                if buf[self._pos] == ']':
+                    self._stack.pop()
+                    self._skeleton.append(']')
+                    self._pos += 1
+                    continue
+                try:
+                    element, end = self._json.raw_decode(buf, self._pos)
+                except ValueError:
+                    if final:
+                        raise
+                    # incomplete, wait for more
+                    break
+                if end == len(buf) and not final:
+                    # a number may continue in the next chunk
+                    break
+                elements.append(element)
+                self._pos = end
+                continue
+            match = _structural.search(buf, self._pos)
+            if match is None:
+                self._skeleton.append(buf[self._pos:])
+                self._pos = len(buf)
+                break
+            char = match.group()
+            if char == '"':
+                string = _string.match(buf, match.end())
+                if string is None:
+                    # incomplete, keep from the quote
+                    self._skeleton.append(buf[self._pos:match.start()])
+                    self._pos = match.start()
+                    if final:
+                        raise ValueError("Unterminated string")
+                    break
+                self._skeleton.append(buf[self._pos:string.end()])
+                self._pos = string.end()
+                continue
+            self._skeleton.append(buf[self._pos:match.end()])
+            self._pos = match.end()
+            if char in '[{':
+                self._stack.append(char)
+            elif not self._stack:
+                raise ValueError("Unexpected %s" % char)
+            else:
+                self._stack.pop()
+        return elements
+
+    def finish(self):
+        '''Returns the rest of the document, decoded.'''
+        self.feed(b'', final=True)
+        if self._stack:
+            raise ValueError("Incomplete JSON document")
+        return json.loads(''.join(self._skeleton))
+
+
+def iter_elements(chunks, stream):
+    '''Yields the elements stream decodes from chunks, an iterable of bytes.
+    Call stream.finish() afterwards for the rest of the document.'''
+    for chunk in chunks:
+        for element in stream.feed(chunk):
+            yield element
@@ -10,10 +10,14 @@
 import sys
 import logging
 import random
+import threading
+import time
+import json
 
 from pyonep import onephttp
 from .exceptions import OneException, OnePlatformException
 from .exceptions import JsonRPCRequestException, JsonRPCResponseException
+from .exceptions import CircuitOpenException
 
 log = logging.getLogger(__name__)
 
@@ -22,16 +26,12 @@ h = logging.StreamHandler()
 h.setLevel(logging.ERROR)
 log.addHandler(h)
 
-try:
-    if sys.version_info < (2, 6):
-        json_module = 'python-simplejson'
-        import simplejson as json
-    else:
-        json_module = 'python-json'
-        import json
-except ImportError:
-    log.critical("The package '%s' is required." % json_module)
-    sys.exit(1)
+from .jsoncodec import get_codec
+from .columnar import to_columns
+from .jsonstream import JsonStream, iter_elements
+from .singleflight import SingleFlight
+from .workerpool import WorkerPool
+from .retry import RetryPolicy, breaker_for, transient_statuses
 
 
 class DeferredRequests():
@@ -79,8 +79,59 @@ class DeferredRequests():
         return self._notimeouts[self._authstr(auth)]
 
 
+class ResponseMatcher():
+    '''Matches the call responses of a JSON RPC response to their requests
+    by id, one at a time.'''
+    def __init__(self, callrequests):
+        self.callrequests = callrequests
+        # index requests by id so that each response is matched to its
+        # request in constant time.
+        self.requests = dict((call['id'], call) for call in callrequests)
+        self.seen = set()
+        self.duplicated = []
+        self.unexpected = []
+
+    def match(self, r):
+        '''Returns (request, success, response) for the call response r,
+        or None if it has no status.'''
+        # first, find the matching request so we can return it along with
+        # the response.
+        callid = r.get('id')
+        request = self.requests.get(callid)
+        if request is None:
+            self.unexpected.append(callid)
+        elif callid in self.seen:
+            self.duplicated.append(callid)
+        self.seen.add(callid)
+        if 'status' in r:
+            if 'ok' == r['status']:
+                if 'result' in r:
+                    return (request, True, r['result'])
+                else:
+                    return (request, True, 'ok')
+            else:
+                return (request, False, r['status'])
+        elif 'error' in r:
+            raise OnePlatformException(str(r['error']))
+        return None
+
+    def check(self):
+        '''Raises JsonRPCResponseException unless every request got
+        exactly one response.'''
+        missing = [call['id'] for call in self.callrequests
+                   if call['id'] not in self.seen]
+        if missing or self.duplicated or self.unexpected:
+            raise JsonRPCResponseException(
+                "Response ids do not match request ids. "
+                "Missing: %s, duplicated: %s, unexpected: %s" % (
+                    missing, self.duplicated, self.unexpected))
+
+
 class OnepV1():
     headers = {'Content-Type': 'application/json; charset=utf-8'}
+    # procedures that may share a request when singleflight is on
+    singleflight_procedures = set(['read', 'info', 'listing', 'lookup',
+                                   'usage'])
 
     def __init__(self,
                  host='m2.exosite.com',
@@ -91,11 +142,66 @@ class OnepV1():
                  agent=None,
                  reuseconnection=False,
                  logrequests=False,
-                 curldebug=False):
+                 curldebug=False,
+                 pool=None,
+                 codec=None,
+                 aliascache=None,
+                 singleflight=False,
+                 retry=None,
+                 circuitbreaker=None,
+                 compression=True,
+                 compress_min_bytes=None,
+                 listeners=None,
+                 workerpool=None):
+        '''codec is the JSON codec for request and response bodies. See
+        jsoncodec.get_codec() for the values it may take.
+
+        aliascache is an aliascache.AliasCache used by lookup() to resolve
+        aliases without a call to the platform. It may be shared with
+        other instances.
+
+        If singleflight is True (or a SingleFlight to share with other
+        instances), concurrent identical calls to read-only procedures
+        (see singleflight_procedures) from different threads share one
+        request and get the same result object.
+
+        retry is a retry.RetryPolicy (or True for the default policy) for
+        requests that fail to get a response or get a transient HTTP
+        status. Only requests of idempotent calls are retried.
+
+        circuitbreaker is a retry.CircuitBreaker, or True for the one
+        shared by every instance that talks to this host. While it's open,
+        calls raise CircuitOpenException without making a request.
+
+        compression and compress_min_bytes are passed to OnePHTTP, to
+        request compressed responses and to gzip request bodies of at least
+        compress_min_bytes (e.g. large record or writegroup calls).
+
+        listeners is a list of instrument.Listener told about each
+        request, with the procedures in it.
+
+        workerpool is a workerpool.WorkerPool whose threads send split
+        requests concurrently (see send_deferred()). It may be shared with
+        other instances. By default, one is created on first use, with a
+        thread for each request sent at once after the first.'''
         self.url = url
+        self.codec = get_codec(codec)
+        self.aliascache = aliascache
+        if singleflight is True:
+            singleflight = SingleFlight()
+        self.singleflight = singleflight or None
+        if retry is True:
+            retry = RetryPolicy()
+        self.retry = retry or None
+        self.host = host + ':' + str(port)
+        if circuitbreaker is True:
+            circuitbreaker = breaker_for((https, self.host))
+        self.circuitbreaker = circuitbreaker or None
         self._clientid = None
         self._resourceid = None
         self.deferred = DeferredRequests()
+        self.workerpool = workerpool
+        self._workerlock = threading.Lock()
         if agent is not None:
             self.headers['User-Agent'] = agent
         self.logrequests = logrequests
@@ -105,7 +211,11 @@ class OnepV1():
                                           headers=self.headers,
                                           reuseconnection=reuseconnection,
                                           log=log,
-                                          curldebug=curldebug)
+                                          curldebug=curldebug,
+                                          pool=pool,
+                                          compression=compression,
+                                          compress_min_bytes=compress_min_bytes,
+                                          listeners=listeners)
 
     def close(self):
         '''Closes any open connection. This should only need to be called if
@@ -130,13 +240,41 @@ class OnepV1():
             notimeout, if true, ignores reuseconnection setting, creating
             a new connection with no timeout.
                 '''
-        # get full auth (auth could be a CIK str)
-        auth = self._getAuth(auth)
-        jsonreq = {"auth": auth, "calls": callrequests}
-        if self.logrequests:
-            self._loggedrequests.append(jsonreq)
-        body = json.dumps(jsonreq)
-
+        body = self._composeBody(auth, callrequests)
+        attempt = 0
+        while True:
+            self._checkCircuit()
+            try:
+                resbody, response = self._post(
+                    body, notimeout, self._eventInfo(callrequests, attempt))
+            except (JsonRPCRequestException, JsonRPCResponseException):
+                delay = self._retryDelay(callrequests, attempt, None)
+                if delay is None:
+                    raise
+            else:
+                delay = self._retryDelay(callrequests, attempt,
+                                         response.status)
+                if delay is None:
+                    return self._parseResponse(resbody, callrequests,
+                                               returnreq)
+            log.debug("Retrying request in %.3f seconds" % delay)
+            time.sleep(delay)
+            attempt += 1
+
+    def _eventInfo(self, callrequests, attempt=0):
+        '''Returns the instrument.RequestEvent attributes for a request of
+        callrequests, or None if there are no listeners.'''
+        if not self.onephttp.listeners:
+            return None
+        return {'kind': 'rpc',
+                'procedures': [call['procedure'] for call in callrequests],
+                'calls': len(callrequests),
+                'attempt': attempt}
+
+    def _post(self, body, notimeout=False, info=None):
+        '''Sends a request body and returns the response's (body, response).
+        Raises JsonRPCRequestException or JsonRPCResponseException if the
+        request fails.'''
         def handle_request_exception(exception):
             raise JsonRPCRequestException(
                 "Failed to make http request: %s" % str(exception))
@@ -146,42 +284,119 @@ class OnepV1():
                               body,
                               self.headers,
                               exception_fn=handle_request_exception,
-                              notimeout=notimeout)
+                              notimeout=notimeout,
+                              info=info)
 
         def handle_response_exception(exception):
             raise JsonRPCResponseException(
                 "Failed to get response for request: %s" % str(exception))
 
-        body, response = self.onephttp.getresponse(
-            exception_fn=handle_response_exception)
+        # the codec decodes the raw bytes, without an intermediate str
+        return self.onephttp.getresponse(
+            exception_fn=handle_response_exception,
+            decode=False)
+
+    def _streamJsonRPC(self, auth, callrequests, stream, chunk_size=65536):
+        '''Sends callrequests and yields the elements stream decodes from the
+        response as it arrives (see jsonstream.JsonStream). Afterwards,
+        stream.finish() returns the rest of the response. Requests that
+        are streamed are not retried.'''
+        body = self._composeBody(auth, callrequests)
+        self._checkCircuit()
+
+        def handle_request_exception(exception):
+            raise JsonRPCRequestException(
+                "Failed to make http request: %s" % str(exception))
+
+        def handle_response_exception(exception):
+            raise JsonRPCResponseException(
+                "Failed to get response for request: %s" % str(exception))
+
+        try:
+            self.onephttp.request('POST',
+                                  self.url,
+                                  body,
+                                  self.headers,
+                                  exception_fn=handle_request_exception,
+                                  info=self._eventInfo(callrequests))
+            chunks, response = self.onephttp.getresponse_stream(
+                exception_fn=handle_response_exception,
+                chunk_size=chunk_size)
+        except (JsonRPCRequestException, JsonRPCResponseException):
+            self._retryDelay(callrequests, 0, None)
+            raise
+        self._retryDelay(callrequests, 0, response.status)
+        try:
+            for element in iter_elements(chunks, stream):
+                yield element
+        except ValueError:
+            ex = sys.exc_info()[1]
+            raise OnePlatformException(
+                "Exception while parsing JSON response: %s" % ex)
+
+    def _finishStream(self, stream):
+        '''Returns the rest of a streamed response, decoded.'''
+        try:
+            return stream.finish()
+        except ValueError:
+            ex = sys.exc_info()[1]
+            raise OnePlatformException(
+                "Exception while parsing JSON response: %s" % ex)
+
+    def _checkCircuit(self):
+        if (self.circuitbreaker is not None
+                and not self.circuitbreaker.allow()):
+            raise CircuitOpenException(
+                "Circuit open for %s, request not sent" % self.host)
+
+    def _retryDelay(self, callrequests, attempt, status):
+        '''Records the outcome of a request for callrequests with the
+        circuit breaker. status is the HTTP status of the response, or None
+        if there was none. Returns the number of seconds to wait before
+        sending the request again, or None if it's not to be retried.'''
+        if self.circuitbreaker is not None:
+            if status is None or status >= 500:
+                self.circuitbreaker.failure()
+            else:
+                self.circuitbreaker.success()
+        if self.retry is None or not (status is None
+                                      or status in transient_statuses):
+            return None
+        return self.retry.delay(callrequests, attempt)
+
+    def _composeBody(self, auth, callrequests):
+        '''Returns the JSON body of a request for callrequests.'''
+        # get full auth (auth could be a CIK str)
+        auth = self._getAuth(auth)
+        jsonreq = {"auth": auth, "calls": callrequests}
+        if self.logrequests:
+            self._loggedrequests.append(jsonreq)
+        return self.codec.dumps(jsonreq)
 
+    def _parseResponse(self, body, callrequests, returnreq=False):
+        '''Parses a JSON RPC response body. Returns as described for
+        _callJsonRPC.'''
         try:
-            res = json.loads(body)
+            res = self.codec.loads(body)
         except:
             ex = sys.exc_info()[1]
             raise OnePlatformException(
                 "Exception while parsing JSON response: %s\n%s" % (body, ex))
+        return self._matchResponse(res, callrequests, returnreq)
+
+    def _matchResponse(self, res, callrequests, returnreq=False):
+        '''Matches a decoded JSON RPC response to callrequests. Returns as
+        described for _callJsonRPC.'''
         if isinstance(res, dict) and 'error' in res:
             raise OnePlatformException(str(res['error']))
         if isinstance(res, list):
+            matcher = ResponseMatcher(callrequests)
             ret = []
             for r in res:
-                # first, find the matching request so we can return it
-                # along with the response.
-                request = None
-                for call in callrequests:
-                    if call['id'] == r['id']:
-                        request = call
-                if 'status' in r:
-                    if 'ok' == r['status']:
-                        if 'result' in r:
-                            ret.append((request, True, r['result']))
-                        else:
-                            ret.append((request, True, 'ok'))
-                    else:
-                        ret.append((request, False, r['status']))
-                elif 'error' in r:
-                    raise OnePlatformException(str(r['error']))
+                result = matcher.match(r)
+                if result is not None:
+                    ret.append(result)
+            matcher.check()
             if returnreq:
                 return ret
             else:
@@ -204,6 +419,8 @@ class OnepV1():
             return {"cik": auth}
 
     def _composeCalls(self, method_args_pairs):
+        '''Returns a list of calls with consecutive ids, so the ids are
+        unique within the request.'''
         calls = []
         i = random.randint(1, 99)
         for method, args in method_args_pairs:
@@ -217,15 +434,40 @@ class OnepV1():
         if defer:
             self.deferred.add(auth, method, arg, notimeout=notimeout)
             return True
+        elif (self.singleflight is not None
+                and method in self.singleflight_procedures):
+            key = (self.deferred._authstr(self._getAuth(auth)),
+                   method,
+                   json.dumps(arg, sort_keys=True))
+            return self.singleflight.do(key, self._callSingle,
+                                        method, auth, arg, notimeout)
         else:
-            calls = self._composeCalls([(method, arg)])
-            return self._callJsonRPC(auth, calls, notimeout=notimeout)
+            return self._callSingle(method, auth, arg, notimeout)
+
+    def _callSingle(self, method, auth, arg, notimeout=False):
+        calls = self._composeCalls([(method, arg)])
+        return self._callJsonRPC(auth, calls, notimeout=notimeout)
 
     def has_deferred(self, auth):
         return self.deferred.has_requests(auth)
 
-    def send_deferred(self, auth):
-        '''Send all deferred requests for a particular CIK/auth.'''
+    def send_deferred(self, auth, max_calls=None, max_bytes=None,
+                      concurrency=1):
+        '''Send all deferred requests for a particular CIK/auth.
+
+            The calls are split into several requests if there are more
+            than max_calls of them, or if the request body would be larger
+            than max_bytes. If concurrency is more than 1, up to that many
+            requests are sent at once, which requires that this OnepV1 was
+            created with a connection pool. Results are returned as a
+            list of (request, success, response) tuples in the order the
+            calls were deferred.
+
+            If the calls are split and one of the requests fails, the
+            others are still sent, and each call of the failed request is
+            returned as (request, False, exception). Those calls may or may
+            not have taken effect. If they aren't split, a failed request
+            raises the exception as before.'''
         if self.deferred.has_requests(auth):
             method_arg_pairs = self.deferred.get_method_args_pairs(auth)
             calls = self._composeCalls(method_arg_pairs)
@@ -233,13 +475,139 @@ class OnepV1():
             # wait())
             notimeout = self.deferred.get_notimeout(auth)
             try:
-                r = self._callJsonRPC(auth, calls, returnreq=True, notimeout=notimeout)
+                r = self._sendCalls(auth,
+                                    calls,
+                                    notimeout=notimeout,
+                                    max_calls=max_calls,
+                                    max_bytes=max_bytes,
+                                    concurrency=concurrency)
             finally:
                 # remove deferred calls
                 self.deferred.reset(auth)
+                self._invalidateAliases(auth, calls)
             return r
         raise JsonRPCRequestException('No deferred requests to send.')
 
+    def send_deferred_stream(self, auth, chunk_size=65536):
+        '''Sends all deferred requests for auth in one request, like
+        send_deferred(), but yields each (request, success, response) as
+        soon as that call's response has arrived, in the order the platform
+        sends them. The response is read chunk_size bytes at a time, so it
+        is never held in memory whole.'''
+        if not self.deferred.has_requests(auth):
+            raise JsonRPCRequestException('No deferred requests to send.')
+        calls = self._composeCalls(self.deferred.get_method_args_pairs(auth))
+        self.deferred.reset(auth)
+        matcher = ResponseMatcher(calls)
+        stream = JsonStream('[')
+        try:
+            for r in self._streamJsonRPC(auth, calls, stream, chunk_size):
+                result = matcher.match(r)
+                if result is not None:
+                    yield result
+            self._matchResponse(self._finishStream(stream), [], True)
+            matcher.check()
+        finally:
+            self._invalidateAliases(auth, calls)
+
+    def _invalidateAliases(self, auth, calls):
+        '''Drops the aliases changed by map and unmap calls from the alias
+        cache, once the calls have been sent.'''
+        if self.aliascache is None:
+            return
+        for call in calls:
+            if call['procedure'] in ('map', 'unmap'):
+                self.aliascache.invalidate(self._getAuth(auth),
+                                           call['arguments'][-1])
+
+    def _splitCalls(self, auth, calls, max_calls=None, max_bytes=None):
+        '''Splits calls into a list of batches, each with at most max_calls
+        calls and a request body of at most max_bytes, if possible. A call
+        that is bigger than max_bytes by itself is sent alone.'''
+        if max_calls is None and max_bytes is None:
+            return [calls]
+        if max_bytes is not None:
+            overhead = len(self.codec.dumps({"auth": self._getAuth(auth),
+                                             "calls": []}))
+        batches = []
+        batch = []
+        size = 0
+        for call in calls:
+            if max_bytes is not None:
+                # length of the call plus the separator that precedes it
+                callsize = len(self.codec.dumps(call)) + 2
+            else:
+                callsize = 0
+            full = ((max_calls is not None and len(batch) >= max_calls)
+                    or (max_bytes is not None
+                        and overhead + size + callsize > max_bytes))
+            if batch and full:
+                batches.append(batch)
+                batch = []
+                size = 0
+            batch.append(call)
+            size += callsize
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def _mergeResults(self, calls, batchresults):
+        '''Merges lists of (request, success, response) tuples from several
+        batches into one list ordered like calls.'''
+        position = dict((call['id'], i) for i, call in enumerate(calls))
+        merged = []
+        for results in batchresults:
+            merged.extend(results)
+        merged.sort(key=lambda r: position.get(
+            r[0]['id'] if r[0] is not None else None, len(calls)))
+        return merged
+
+    def _failedBatch(self, batch, exception):
+        '''Returns (request, False, exception) for each call of a batch
+        whose request failed.'''
+        return [(call, False, exception) for call in batch]
+
+    def _sendCalls(self, auth, calls, notimeout=False, max_calls=None,
+                   max_bytes=None, concurrency=1):
+        '''Sends calls in one or more requests as described for
+        send_deferred() and returns a list of (request, success, response)
+        tuples.'''
+        batches = self._splitCalls(auth, calls, max_calls, max_bytes)
+        if len(batches) == 1:
+            return self._callJsonRPC(auth, calls, returnreq=True,
+                                     notimeout=notimeout)
+        if concurrency > 1 and self.onephttp.pool is None:
+            log.warning("concurrency requires a connection pool, "
+                        "sending %d requests one at a time" % len(batches))
+            concurrency = 1
+
+        def send(batch):
+            try:
+                return self._callJsonRPC(auth, batch, returnreq=True,
+                                         notimeout=notimeout)
+            except Exception:
+                # the other batches may have been applied, so report
+                # this one's calls as failed rather than raising
+                return self._failedBatch(batch, sys.exc_info()[1])
+
+        if concurrency <= 1:
+            batchresults = [send(batch) for batch in batches]
+        else:
+            batchresults = self._workerPool(concurrency).map(send, batches,
+                                                             concurrency)
+        return self._mergeResults(calls, batchresults)
+
+    def _workerPool(self, concurrency):
+        '''Returns self.workerpool, creating it for concurrency requests
+        at once if there isn't one.'''
+        self._workerlock.acquire()
+        try:
+            if self.workerpool is None:
+                self.workerpool = WorkerPool(workers=concurrency - 1)
+            return self.workerpool
+        finally:
+            self._workerlock.release()
+
     def connect_as(self, clientid):
         self._clientid = clientid
         self._resourceid = None
@@ -292,13 +660,131 @@ class OnepV1():
                                   defer)
 
     def lookup(self, auth, type, mapping, defer=False):
+        if self.aliascache is not None and type == 'alias' and not defer:
+            return self.aliascache.resolve(self, self._getAuth(auth), mapping)
         return self._call('lookup', auth, [type, mapping], defer)
 
     def map(self, auth, rid, alias, defer=False):
-        return self._call('map', auth, ['alias', rid, alias], defer)
-
-    def read(self, auth, rid, options, defer=False):
-        return self._call('read', auth, [rid, options], defer)
+        result = self._call('map', auth, ['alias', rid, alias], defer)
+        if self.aliascache is not None and not defer:
+            # deferred calls are invalidated by send_deferred()
+            self.aliascache.invalidate(self._getAuth(auth), alias)
+        return result
+
+    def read(self, auth, rid, options, defer=False, columnar=False):
+        '''If columnar is True, a successful result is returned as a
+        columnar.ColumnarPoints instead of a list of [timestamp, value]
+        lists. This does not apply to deferred reads.'''
+        result = self._call('read', auth, [rid, options], defer)
+        if columnar and not defer and result[0]:
+            return True, to_columns(result[1])
+        return result
+
+    def iter_read(self, auth, rid, starttime, endtime, page_size=1000,
+                  options=None, prefetch=False):
+        '''Generator that yields the [timestamp, value] points of rid between
+        starttime and endtime, oldest first, reading page_size points per
+        request. Only one page is held in memory at a time.
+
+            options: other read options, e.g. {'selection': 'all'}
+            prefetch: if True, the next page is read in a background thread
+                      while the caller processes the current one. If this
+                      OnepV1 is used by other threads at the same time, it
+                      should have a connection pool.'''
+        readoptions = {}
+        if options is not None:
+            readoptions.update(options)
+        readoptions.update({'endtime': endtime, 'sort': 'asc'})
+
+        def fetch(start, limit):
+            opts = dict(readoptions)
+            opts.update({'starttime': start, 'limit': limit})
+            status, points = self.read(auth, rid, opts)
+            if not status:
+                raise OnePlatformException(
+                    "Error message from one platform (read): %s" % points)
+            return points
+
+        def fetch_in_background(start, limit):
+            result = {}
+
+            def run():
+                try:
+                    result['points'] = fetch(start, limit)
+                except Exception:
+                    result['error'] = sys.exc_info()[1]
+            t = threading.Thread(target=run)
+            t.daemon = True
+            t.start()
+
+            def wait():
+                t.join()
+                if 'error' in result:
+                    raise result['error']
+                return result['points']
+            return wait
+
+        start = starttime
+        limit = page_size
+        # number of points at timestamp == start that were already yielded
+        skip = 0
+        pending = None
+        while True:
+            if pending is not None:
+                points = pending()
+            else:
+                points = fetch(start, limit)
+            pending = None
+            page, following = self._nextPage(points, start, limit, skip,
+                                             page_size)
+            if following is None:
+                for point in page:
+                    yield point
+                return
+            start, limit, skip = following
+            if prefetch:
+                pending = fetch_in_background(start, limit)
+            for point in page:
+                yield point
+
+    def _nextPage(self, points, start, limit, skip, page_size):
+        '''For iter_read(): points were read from start with limit, and
+        the first skip of them were already yielded. Returns the points to
+        yield, and the (start, limit, skip) of the next page, or None if
+        this is the last page.'''
+        page = points[skip:]
+        if len(points) < limit:
+            return page, None
+        lasttime = points[-1][0]
+        if lasttime == start:
+            # a full page of points with the same timestamp. Read more at
+            # once so that the next page gets past them.
+            return page, (start, limit * 2, max(skip, len(points)))
+        # the next page starts at the last timestamp in case there are
+        # more points with that timestamp. Skip the ones that were
+        # already yielded.
+        skip = 0
+        for point in reversed(points):
+            if point[0] != lasttime:
+                break
+            skip += 1
+        return page, (lasttime, page_size + skip, skip)
+
+    def read_stream(self, auth, rid, options, chunk_size=65536):
+        '''Yields the [timestamp, value] points of a read as the response
+        arrives, reading it chunk_size bytes at a time, so that a large
+        result is never held in memory whole. Raises OnePlatformException
+        if the read fails. The response is decoded with the standard
+        library json module, whatever the codec.'''
+        calls = self._composeCalls([('read', [rid, options])])
+        stream = JsonStream('[{[')
+        for point in self._streamJsonRPC(auth, calls, stream, chunk_size):
+            yield point
+        isok, response = self._matchResponse(
+            self._finishStream(stream), calls)
+        if not isok:
+            raise OnePlatformException(
+                "Error message from one platform (read): %s" % response)
 
     def record(self, auth, rid, entries, options={}, defer=False):
         return self._call('record', auth, [rid, entries, options], defer)
@@ -316,7 +802,10 @@ class OnepV1():
         return self._call('tag', auth, [rid, action, tag], defer)
 
     def unmap(self, auth, alias, defer=False):
-        return self._call('unmap', auth, ['alias', alias], defer)
+        result = self._call('unmap', auth, ['alias', alias], defer)
+        if self.aliascache is not None and not defer:
+            self.aliascache.invalidate(self._getAuth(auth), alias)
+        return result
 
     def update(self, auth, rid, desc={}, defer=False):
         return self._call('update', auth, [rid, desc], defer)
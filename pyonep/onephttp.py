@@ -9,15 +9,55 @@
        2. call request()
        3. call getresponse() to get a HTTPResponse object
 
+   To share persistent connections between threads, create a
+   ConnectionPool and pass it to each OnePHTTP instance.
+
+   Listeners (see instrument.py) are told the timings and sizes of each
+   request.
+
+   Responses are requested with gzip or deflate encoding and decompressed
+   as they're read. Request bodies may be gzipped too, see
+   compress_min_bytes.
+
    Copyright (c) 2014, Exosite LLC'''
 
+import logging
+import random
 import sys
+import select
+import socket
+import threading
+import time
+import zlib
 try:
     import httplib
 except:
     # python 3
     from http import client as httplib
 
+from .exceptions import ConnectionPoolException
+from . import instrument
+
+
+def _is_readable(sock):
+    '''Returns True if sock has data or an EOF to read, without waiting.
+    poll() is used where it's available, since select() fails for file
+    descriptors above FD_SETSIZE.'''
+    if hasattr(select, 'poll'):
+        poller = select.poll()
+        poller.register(sock, select.POLLIN | select.POLLPRI)
+        return bool(poller.poll(0))
+    readable, _, _ = select.select([sock], [], [], 0)
+    return bool(readable)
+
+
+def _is_stale(ex):
+    '''Returns True if ex is from a kept-alive connection that the server
+    closed before sending any of the response, rather than a timeout.'''
+    if isinstance(ex, socket.timeout):
+        return False
+    return isinstance(ex, (httplib.BadStatusLine, socket.error))
+
 class ConnectionFactory():
     '''Builds the correct kind of HTTPConnection object.'''
     @staticmethod
@@ -39,6 +79,198 @@ class ConnectionFactory():
 
         return conn
 
+
+def body_for_log(body, log_body_bytes=1024, log_body_rate=1):
+    '''Returns body cut to log_body_bytes (None for no limit), or None if
+    it's not in the log_body_rate fraction of bodies to log.'''
+    if body is None or (log_body_rate < 1 and
+                        random.random() >= log_body_rate):
+        return None
+    truncated = (log_body_bytes is not None and
+                 len(body) > log_body_bytes)
+    if truncated:
+        body = body[:log_body_bytes]
+    if isinstance(body, bytes):
+        body = body.decode('utf_8', 'replace')
+    if truncated:
+        body += '...'
+    return body
+
+
+class ConnectionPool():
+    '''Thread-safe pool of persistent HTTPConnection/HTTPSConnection
+    objects, keyed by scheme, host:port and timeout.
+
+          maxsize: maximum number of connections checked out at once per key
+          idle_timeout: seconds an idle connection is kept before it's closed
+          block: if True, get() waits for a connection to be returned when
+                 maxsize is reached. If False, it raises
+                 ConnectionPoolException.
+          block_timeout: seconds get() waits before raising
+                         ConnectionPoolException. None waits forever.'''
+    def __init__(self,
+                 maxsize=10,
+                 idle_timeout=60,
+                 block=True,
+                 block_timeout=None):
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self.block = block
+        self.block_timeout = block_timeout
+        self._cond = threading.Condition(threading.Lock())
+        # key -> list of (connection, time it was returned to the pool)
+        self._idle = {}
+        # key -> number of connections currently checked out
+        self._active = {}
+
+    def _key(self, hostport, https, timeout):
+        return ('https' if https else 'http', hostport, timeout)
+
+    def _is_healthy(self, conn):
+        '''Returns False if an idle connection has been closed by the
+        server. An idle keep-alive socket should never be readable, so a
+        readable one has either hit EOF or has unexpected data on it.'''
+        sock = getattr(conn, 'sock', None)
+        if sock is None:
+            # not connected yet, httplib connects on the next request
+            return True
+        try:
+            return not _is_readable(sock)
+        except Exception:
+            return False
+
+    def _evict_idle(self, now):
+        '''Closes connections that have been idle longer than
+        idle_timeout. Must be called with self._cond held.'''
+        if self.idle_timeout is None:
+            return
+        for key in list(self._idle.keys()):
+            keep = []
+            for conn, returned in self._idle[key]:
+                if now - returned > self.idle_timeout:
+                    conn.close()
+                else:
+                    keep.append((conn, returned))
+            if keep:
+                self._idle[key] = keep
+            else:
+                del self._idle[key]
+
+    def get(self, hostport, https, timeout=None):
+        '''Checks out a healthy connection to hostport, making a new one
+        if none is idle and maxsize allows it.'''
+        key = self._key(hostport, https, timeout)
+        deadline = None
+        if self.block_timeout is not None:
+            deadline = time.time() + self.block_timeout
+        self._cond.acquire()
+        try:
+            while True:
+                now = time.time()
+                self._evict_idle(now)
+                idle = self._idle.get(key, [])
+                while idle:
+                    # most recently used first, since it's the least
+                    # likely to have been closed by the server
+                    conn, returned = idle.pop()
+                    if self._is_healthy(conn):
+                        self._active[key] = self._active.get(key, 0) + 1
+                        return conn
+                    conn.close()
+                if self._active.get(key, 0) < self.maxsize:
+                    self._active[key] = self._active.get(key, 0) + 1
+                    break
+                if not self.block:
+                    raise ConnectionPoolException(
+                        "No connection available for %s" % hostport)
+                if deadline is None:
+                    self._cond.wait()
+                else:
+                    remaining = deadline - now
+                    if remaining <= 0:
+                        raise ConnectionPoolException(
+                            "Timed out waiting for a connection to %s" %
+                            hostport)
+                    self._cond.wait(remaining)
+        finally:
+            self._cond.release()
+        # HTTPConnection connects on its first request, outside the lock
+        return ConnectionFactory.make_conn(hostport, https, timeout)
+
+    def put(self, conn, hostport, https, timeout=None, reusable=True):
+        '''Returns a connection checked out with get(). If reusable is
+        False the connection is closed rather than kept.'''
+        key = self._key(hostport, https, timeout)
+        self._cond.acquire()
+        try:
+            self._active[key] = max(self._active.get(key, 0) - 1, 0)
+            if reusable and conn.sock is not None:
+                self._idle.setdefault(key, []).append((conn, time.time()))
+            else:
+                conn.close()
+            self._cond.notify()
+        finally:
+            self._cond.release()
+
+    def close(self):
+        '''Closes all idle connections. Connections that are checked out
+        are kept until they're returned.'''
+        self._cond.acquire()
+        try:
+            for key in self._idle:
+                for conn, returned in self._idle[key]:
+                    conn.close()
+            self._idle = {}
+        finally:
+            self._cond.release()
+
+
+def compress(body):
+    '''Returns body (bytes or str) gzipped.'''
+    if not isinstance(body, bytes):
+        body = body.encode('utf_8')
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(body) + compressor.flush()
+
+
+class Decompressor():
+    '''Decompresses a body with Content-Encoding encoding (gzip or
+    deflate) a chunk at a time.'''
+    encodings = ('gzip', 'x-gzip', 'deflate')
+
+    def __init__(self, encoding):
+        self.encoding = encoding
+        # 32 + MAX_WBITS accepts a gzip or zlib header
+        self._obj = zlib.decompressobj(32 + zlib.MAX_WBITS)
+        # the start of the body, until there's enough of it to tell
+        # whether it has a header
+        self._head = b''
+        self._started = False
+
+    def decompress(self, chunk):
+        if not self._started:
+            self._head += chunk
+            if len(self._head) < 2:
+                return b''
+            chunk, self._head = self._head, b''
+            self._started = True
+            try:
+                return self._obj.decompress(chunk)
+            except zlib.error:
+                if self.encoding != 'deflate':
+                    raise
+                # some servers send deflate without the zlib header
+                self._obj = zlib.decompressobj(-zlib.MAX_WBITS)
+        return self._obj.decompress(chunk)
+
+    def flush(self):
+        if not self._started and self._head:
+            # a body shorter than a header
+            self._started = True
+            return self._obj.decompress(self._head) + self._obj.flush()
+        return self._obj.flush()
+
+
 class OnePHTTPResponse:
     def __init__(self, exception=None, code=None, reason=None, body=None):
         self.exception = exception
@@ -55,7 +287,25 @@ class OnePHTTP:
                     headers={},
                     reuseconnection=False,
                     log=None,
-                    curldebug=False):
+                    curldebug=False,
+                    pool=None,
+                    compression=True,
+                    compress_min_bytes=None,
+                    log_body_bytes=1024,
+                    log_body_rate=1,
+                    listeners=None):
+        '''If compression is True, responses are requested with gzip or
+        deflate encoding. Request bodies of at least compress_min_bytes
+        are sent gzipped. The default, None, never compresses them, since
+        not every server accepts it. See compression_stats() for the bytes
+        saved.
+
+        Requests and responses are only formatted for the log when it's
+        enabled for debug. Then bodies are cut to log_body_bytes (None for
+        no limit), and only a log_body_rate fraction of them are logged.
+
+        listeners is a list of instrument.Listener to tell about each
+        request. Nothing is timed or counted when there are none.'''
         self.host = host
         self.https = https
         self.httptimeout = httptimeout
@@ -64,6 +314,169 @@ class OnePHTTP:
         self.conn = None
         self.log = log
         self.curldebug = curldebug
+        self.log_body_bytes = log_body_bytes
+        self.log_body_rate = log_body_rate
+        self.listeners = list(listeners or [])
+        # with a pool, each thread checks out its own connection, so
+        # one instance may be shared between threads.
+        self.pool = pool
+        self._local = threading.local()
+        self.compression = compression
+        self.compress_min_bytes = compress_min_bytes
+        self._statslock = threading.Lock()
+        self._stats = {'requests_compressed': 0,
+                       'request_bytes': 0,
+                       'request_bytes_sent': 0,
+                       'responses_compressed': 0,
+                       'response_bytes': 0,
+                       'response_bytes_received': 0}
+
+    def _count(self, **counts):
+        self._statslock.acquire()
+        try:
+            for name in counts:
+                self._stats[name] += counts[name]
+        finally:
+            self._statslock.release()
+
+    def compression_stats(self):
+        '''Returns a dict of counts of compressed requests and responses,
+        their bytes before and after compression, and bytes_saved, the
+        total difference.'''
+        self._statslock.acquire()
+        try:
+            stats = dict(self._stats)
+        finally:
+            self._statslock.release()
+        stats['bytes_saved'] = (
+            stats['request_bytes'] - stats['request_bytes_sent'] +
+            stats['response_bytes'] - stats['response_bytes_received'])
+        return stats
+
+    def _start_event(self, method, path, info):
+        '''Returns a RequestEvent for a request if there are listeners.'''
+        if not self.listeners:
+            self._local.event = None
+            return None
+        event = instrument.RequestEvent(self.host, method, path, info)
+        self._local.event = event
+        instrument.notify(self.listeners, 'request_start', event)
+        return event
+
+    def _end_event(self, event, error=None):
+        if event is None:
+            return
+        if error is not None and event.error is None:
+            event.error = error.__class__.__name__
+        event.total_time = time.time() - event.started
+        instrument.notify(self.listeners, 'request_end', event)
+
+    def _send(self, conn, method, path, body, allheaders, event):
+        '''Sends a request on conn. With an event, connects first to time
+        the TCP connection and TLS handshake separately.'''
+        if event is None:
+            conn.request(method, path, body, allheaders)
+            return
+        event.reused = conn.sock is not None
+        if not event.reused:
+            connected = []
+            # wraps the socket creation, which HTTPSConnection.connect()
+            # follows with the handshake
+            create = getattr(conn, '_create_connection', None)
+            if create is not None:
+                def timed_create(*args, **kwargs):
+                    sock = create(*args, **kwargs)
+                    connected.append(time.time())
+                    return sock
+                conn._create_connection = timed_create
+            start = time.time()
+            try:
+                conn.connect()
+            finally:
+                if create is not None:
+                    conn._create_connection = create
+            end = time.time()
+            if connected:
+                event.connect_time = connected[0] - start
+                if self.https:
+                    event.tls_time = end - connected[0]
+            else:
+                event.connect_time = end - start
+        event.request_bytes = len(body) if body is not None else 0
+        conn.request(method, path, body, allheaders)
+        event.sent = time.time()
+
+    def _encode_body(self, body, allheaders):
+        '''Returns body gzipped if it's at least compress_min_bytes long,
+        and adds its Content-Encoding header.'''
+        if (body is None or self.compress_min_bytes is None
+                or len(body) < self.compress_min_bytes):
+            return body
+        if not isinstance(body, bytes):
+            body = body.encode('utf_8')
+        compressed = compress(body)
+        self._count(requests_compressed=1,
+                    request_bytes=len(body),
+                    request_bytes_sent=len(compressed))
+        allheaders['Content-Encoding'] = 'gzip'
+        return compressed
+
+    def _decompressor(self, response):
+        '''Returns a Decompressor for response, or None if it's not
+        compressed.'''
+        encoding = (response.getheader('Content-Encoding') or '').lower()
+        if encoding in Decompressor.encodings:
+            return Decompressor(encoding)
+        return None
+
+    def _iter_body(self, response, chunk_size, event=None):
+        '''Yields the body of response, decompressed, up to chunk_size
+        bytes of it at a time as it's read.'''
+        decompressor = self._decompressor(response)
+        received = 0
+        decompressed = 0
+        try:
+            while True:
+                chunk = response.read(chunk_size)
+                if not chunk:
+                    break
+                if event is not None:
+                    event.response_bytes += len(chunk)
+                if decompressor is not None:
+                    received += len(chunk)
+                    chunk = decompressor.decompress(chunk)
+                    decompressed += len(chunk)
+                if chunk:
+                    yield chunk
+            if decompressor is not None:
+                chunk = decompressor.flush()
+                decompressed += len(chunk)
+                if chunk:
+                    yield chunk
+        finally:
+            if decompressor is not None:
+                self._count(responses_compressed=1,
+                            response_bytes=decompressed,
+                            response_bytes_received=received)
+
+    def _checkout(self, notimeout):
+        '''Gets a connection from the pool for this thread's request.'''
+        timeout = None if notimeout else self.httptimeout
+        conn = self.pool.get(self.host, self.https, timeout)
+        self._local.conn = conn
+        self._local.timeout = timeout
+        return conn
+
+    def _release(self, reusable=True):
+        '''Returns this thread's connection to the pool.'''
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            self._local.conn = None
+            self.pool.put(conn,
+                          self.host,
+                          self.https,
+                          self._local.timeout,
+                          reusable=reusable)
 
     def request(self,
                 method,
@@ -71,15 +484,26 @@ class OnePHTTP:
                 body=None,
                 headers={},
                 exception_fn=None,
-                notimeout=False):
+                notimeout=False,
+                info=None):
         '''Wraps HTTPConnection.request. On exception it calls exception_fn
         with the exception object. If exception_fn is None, it re-raises the
         exception. If notimeout is True, create a new connection (regardless of
         self.reuseconnection setting) that uses the global default timeout for
-        sockets (usually None).'''
+        sockets (usually None). info is a dict of attributes for the
+        instrument.RequestEvent, e.g. procedures.'''
         allheaders = {}
         allheaders.update(self.headers)
         allheaders.update(headers)
+        if self.compression and 'Accept-Encoding' not in allheaders:
+            allheaders['Accept-Encoding'] = 'gzip, deflate'
+        self._log_request(method, path, body, allheaders)
+        body = self._encode_body(body, allheaders)
+        event = self._start_event(method, path, info)
+        if self.pool is not None:
+            self._pooled_request(method, path, body, allheaders,
+                                 exception_fn, notimeout, event)
+            return
         if self.conn is None or not self.reuseconnection or notimeout:
             self.close()
             if notimeout:
@@ -92,30 +516,94 @@ class OnePHTTP:
                     self.https,
                     self.httptimeout)
         try:
-            if self.curldebug:
-                # output request as a curl call
-                def escape(s):
-                    '''escape single quotes for bash'''
-                    return s.replace("'", "'\\''")
-                self.log.debug(
-                    "curl {0}://{1}{2} -X {3} -m {4} {5} {6}".format(
-                        'https' if self.https else 'http',
-                        self.host,
-                        path,
-                        method,
-                        self.httptimeout,
-                        ' '.join(['-H \'{0}: {1}\''.format(escape(h), escape(allheaders[h]))
-                                  for h in allheaders]),
-                        '' if body is None else '-d \'' + escape(body) + '\''))
+            self._send(self.conn, method, path, body, allheaders, event)
+        except Exception:
+            self.close()
+            ex = sys.exc_info()[1]
+            self._end_event(event, ex)
+            if exception_fn is not None:
+                exception_fn(ex)
             else:
-                self.log.debug("%s %s\nHost: %s\nHeaders: %s" % (
-                    method,
-                    path,
+                raise ex
+
+    def _pooled_request(self, method, path, body, allheaders,
+                        exception_fn, notimeout, event):
+        '''request() for instances that use a ConnectionPool. If sending
+        on a reused connection fails, retry once on a new connection, since
+        the server may have closed it after the health check. The request
+        is kept until getresponse(), to send it again the same way if the
+        server closes the connection instead of responding.'''
+        self._local.resend = None
+        try:
+            conn = self._checkout(notimeout)
+            reused = conn.sock is not None
+            try:
+                self._send(conn, method, path, body, allheaders, event)
+            except Exception:
+                if not reused:
+                    raise
+                self._release(reusable=False)
+                conn = self._checkout(notimeout)
+                reused = False
+                self._send(conn, method, path, body, allheaders, event)
+            if reused:
+                self._local.resend = (method, path, body, allheaders,
+                                      notimeout)
+        except Exception:
+            self._release(reusable=False)
+            ex = sys.exc_info()[1]
+            self._end_event(event, ex)
+            if exception_fn is not None:
+                exception_fn(ex)
+            else:
+                raise ex
+
+    def _debug(self):
+        return self.log is not None and self.log.isEnabledFor(logging.DEBUG)
+
+    def _body_for_log(self, body):
+        return body_for_log(body, self.log_body_bytes, self.log_body_rate)
+
+    def _log_request(self, method, path, body, allheaders):
+        '''Logs a request at debug level, as a curl call if curldebug.'''
+        if not self._debug():
+            return
+        body = self._body_for_log(body)
+        if self.curldebug:
+            # output request as a curl call. Set log_body_bytes to None
+            # for the whole body.
+            def escape(s):
+                '''escape single quotes for bash'''
+                if isinstance(s, bytes) and not isinstance(s, str):
+                    s = s.decode('utf_8')
+                return s.replace("'", "'\\''")
+            self.log.debug(
+                "curl {0}://{1}{2} -X {3} -m {4} {5} {6}".format(
+                    'https' if self.https else 'http',
                     self.host,
-                    allheaders))
-                if body is not None:
-                    self.log.debug("Body: %s" % body)
-            self.conn.request(method, path, body, allheaders)
+                    path,
+                    method,
+                    self.httptimeout,
+                    ' '.join(['-H \'{0}: {1}\''.format(escape(h), escape(allheaders[h]))
+                              for h in allheaders]),
+                    '' if body is None else '-d \'' + escape(body) + '\''))
+        else:
+            self.log.debug("%s %s\nHost: %s\nHeaders: %s" % (
+                method,
+                path,
+                self.host,
+                allheaders))
+            if body is not None:
+                self.log.debug("Body: %s" % body)
+
+    def getresponse(self, exception_fn=None, decode=True):
+        '''Wraps HTTPLib.getresponse. Exceptions handled as in request()
+        If decode is True, a body with charset=utf-8 is decoded to str.
+        Otherwise the body is returned as bytes.'''
+        if self.pool is not None:
+            return self._pooled_getresponse(exception_fn, decode)
+        try:
+            return self._read_response(self.conn, decode)
         except Exception:
             self.close()
             ex = sys.exc_info()[1]
@@ -123,11 +611,144 @@ class OnePHTTP:
                 exception_fn(ex)
             else:
                 raise ex
+        finally:
+            if not self.reuseconnection:
+                self.close()
 
-    def getresponse(self, exception_fn=None):
-        '''Wraps HTTPLib.getresponse. Exceptions handled as in request()'''
+    def _pooled_getresponse(self, exception_fn, decode):
+        '''getresponse() for instances that use a ConnectionPool. The
+        connection goes back to the pool once the body has been read,
+        unless the server asked to close it.'''
+        reusable = False
         try:
-            response = self.conn.getresponse()
+            body, response = self._read_response(self._local.conn, decode,
+                                                  self._takeResend())
+            reusable = not response.will_close
+            return body, response
+        except Exception:
+            ex = sys.exc_info()[1]
+            if exception_fn is not None:
+                exception_fn(ex)
+            else:
+                raise ex
+        finally:
+            self._release(reusable=reusable)
+
+    def getresponse_stream(self, exception_fn=None, chunk_size=65536):
+        '''Like getresponse(), but returns (chunks, response) without
+        reading the body. chunks is a generator of the body's bytes,
+        decompressed, read chunk_size at a time. Exceptions from reading it
+        are handled as in getresponse(). The connection is released once
+        the generator is exhausted, or closed if it's abandoned before
+        then.'''
+        event = getattr(self._local, 'event', None)
+        self._local.event = None
+        if self.pool is not None:
+            try:
+                conn, response = self._getresponse(self._local.conn, event,
+                                                   self._takeResend())
+            except Exception:
+                self._release(reusable=False)
+                ex = sys.exc_info()[1]
+                self._end_event(event, ex)
+                if exception_fn is not None:
+                    exception_fn(ex)
+                else:
+                    raise ex
+            timeout = self._local.timeout
+            self._local.conn = None
+
+            def done(reusable):
+                self.pool.put(conn, self.host, self.https, timeout,
+                              reusable=reusable)
+        else:
+            def done(reusable):
+                if not (reusable and self.reuseconnection):
+                    self.close()
+            try:
+                response = self.conn.getresponse()
+            except Exception:
+                done(False)
+                ex = sys.exc_info()[1]
+                self._end_event(event, ex)
+                if exception_fn is not None:
+                    exception_fn(ex)
+                else:
+                    raise ex
+        if self._debug():
+            self.log.debug("HTTP %s %s\nHeaders: %s\nBody: (streamed)" % (
+                response.status,
+                response.reason,
+                response.getheaders()))
+
+        self._response_event(event, response)
+
+        def chunks():
+            complete = False
+            error = None
+            try:
+                for chunk in self._iter_body(response, chunk_size, event):
+                    yield chunk
+                complete = True
+            except Exception:
+                ex = sys.exc_info()[1]
+                error = ex
+                if exception_fn is not None:
+                    exception_fn(ex)
+                else:
+                    raise ex
+            finally:
+                done(complete and not response.will_close)
+                self._end_event(event, error)
+        return chunks(), response
+
+    def _response_event(self, event, response):
+        if event is not None:
+            event.ttfb = time.time() - (event.sent or event.started)
+            event.status = response.status
+
+    def _takeResend(self):
+        '''Returns and forgets the request kept by _pooled_request() to
+        send again, or None.'''
+        resend = getattr(self._local, 'resend', None)
+        self._local.resend = None
+        return resend
+
+    def _getresponse(self, conn, event, resend=None):
+        '''Returns (conn, response). If resend is a request sent on a
+        reused connection, and the server closed the connection without
+        responding, sends it once more on a new connection from the pool,
+        which becomes this thread's connection.'''
+        try:
+            return conn, conn.getresponse()
+        except Exception:
+            ex = sys.exc_info()[1]
+            if resend is None or not _is_stale(ex):
+                raise
+        method, path, body, allheaders, notimeout = resend
+        self._release(reusable=False)
+        conn = self._checkout(notimeout)
+        self._send(conn, method, path, body, allheaders, event)
+        return conn, conn.getresponse()
+
+    def _read_response(self, conn, decode=True, resend=None):
+        '''Reads a whole response from conn and logs it. resend is as for
+        _getresponse().'''
+        event = getattr(self._local, 'event', None)
+        self._local.event = None
+        try:
+            body, response = self._read_body(conn, decode, event, resend)
+        except Exception:
+            self._end_event(event, sys.exc_info()[1])
+            raise
+        self._end_event(event)
+        return body, response
+
+    def _read_body(self, conn, decode, event, resend=None):
+        conn, response = self._getresponse(conn, event, resend)
+        self._response_event(event, response)
+        debug = self._debug()
+        if debug:
             if response.version == 10:
                 version = 'HTTP/1.0'
             elif response.version == 11:
@@ -139,27 +760,28 @@ class OnePHTTP:
                 response.status,
                 response.reason,
                 response.getheaders()))
-            if response.getheader('Content-Type', '').endswith('charset=utf-8'):
-                body = response.read().decode('utf_8')
-            else:
-                body = response.read()
-            self.log.debug("Body: %s" % body)
-            return body, response
-        except Exception:
-            self.close()
-            ex = sys.exc_info()[1]
-            if exception_fn is not None:
-                exception_fn(ex)
-            else:
-                raise ex
-        finally:
-            if not self.reuseconnection:
-                self.close()
+        if self._decompressor(response) is None:
+            body = response.read()
+            if event is not None:
+                event.response_bytes = len(body)
+        else:
+            body = b''.join(self._iter_body(response, 65536, event))
+        if (decode and
+                response.getheader('Content-Type', '').endswith('charset=utf-8')):
+            body = body.decode('utf_8')
+        if debug:
+            logbody = self._body_for_log(body)
+            if logbody is not None:
+                self.log.debug("Body: %s" % logbody)
+        return body, response
 
     def close(self):
         '''Closes any open connection. This should only need to be called if
         reuseconnection is set to True. Once it's closed, the connection may be
-        reopened by making another API called.'''
+        reopened by making another API called. With a pool, this closes the
+        calling thread's connection if it has a request in progress.'''
+        if self.pool is not None:
+            self._release(reusable=False)
         if self.conn is not None:
             self.conn.close()
             self.conn = None
@@ -70,7 +70,11 @@ class Provision(object):
                  reuseconnection=False,
                  raise_api_exceptions=False,
                  curldebug=False,
-                 manage_by_sharecode=False):
+                 manage_by_sharecode=False,
+                 pool=None,
+                 compression=True,
+                 compress_min_bytes=None,
+                 listeners=None):
         # backward compatibility
         protocol = 'http://'
         if host.startswith(protocol):
@@ -83,7 +87,11 @@ class Provision(object):
                                            httptimeout=int(httptimeout),
                                            reuseconnection=reuseconnection,
                                            log=log,
-                                           curldebug=curldebug)
+                                           curldebug=curldebug,
+                                           pool=pool,
+                                           compression=compression,
+                                           compress_min_bytes=compress_min_bytes,
+                                           listeners=listeners)
         self._raise_api_exceptions = raise_api_exceptions
 
     def _filter_options(self, aliases=True, comments=True, historical=True):
@@ -117,10 +125,18 @@ class Provision(object):
         headers['Accept'] = 'text/plain, text/csv, application/x-www-form-urlencoded'
         headers.update(extra_headers)
 
+        info = None
+        if self._onephttp.listeners:
+            # e.g. 'GET /provision/manage/model', without the names of
+            # models and serial numbers
+            info = {'kind': 'provision',
+                    'procedures': [method + ' ' + '/'.join(path.split('/')[:4])],
+                    'calls': 1}
         self._onephttp.request(method,
                                url,
                                body,
-                               headers)
+                               headers,
+                               info=info)
         body, response = self._onephttp.getresponse()
         pr = ProvisionResponse(body, response)
         if self._raise_api_exceptions and not pr.isok:
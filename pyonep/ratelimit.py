@@ -0,0 +1,69 @@
+#==============================================================================
+# ratelimit.py
+# Token bucket rate limiting of calls to the platform.
+#==============================================================================
+#
+# Copyright (c) 2014, Exosite LLC
+# All rights reserved.
+#
+import threading
+import time
+import weakref
+
+
+class TokenBucket():
+    '''Allows rate calls per second on average, and bursts of up to burst
+    calls. acquire() only waits when the bucket is empty.'''
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = max(burst, 1)
+        self._tokens = float(self.burst)
+        self._updated = time.time()
+        self._lock = threading.Lock()
+
+    def _reserve(self, tokens):
+        '''Takes tokens from the bucket, and returns the number of seconds
+        the caller must wait before it may make its calls.'''
+        self._lock.acquire()
+        try:
+            now = time.time()
+            self._tokens = min(self.burst,
+                               self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            # going negative reserves tokens for this caller, so callers
+            # waiting at the same time are spaced out rather than woken
+            # together.
+            self._tokens -= tokens
+            if self._tokens >= 0:
+                return 0
+            return -self._tokens / self.rate
+        finally:
+            self._lock.release()
+
+    def acquire(self, tokens=1):
+        '''Waits until tokens calls may be made. Returns the number of
+        seconds waited.'''
+        wait = self._reserve(tokens)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+
+# (key, rate, burst) -> TokenBucket, for as long as someone holds it
+_buckets = weakref.WeakValueDictionary()
+_buckets_lock = threading.Lock()
+
+
+def bucket_for(key, rate, burst=1):
+    '''Returns the TokenBucket for key (e.g. a CIK and the kind of call)
+    with rate and burst, creating it if needed. Every user of the same key
+    and limits shares one bucket, while it's held by any of them.'''
+    _buckets_lock.acquire()
+    try:
+        bucket = _buckets.get((key, rate, burst))
+        if bucket is None:
+            bucket = TokenBucket(rate, burst)
+            _buckets[(key, rate, burst)] = bucket
+        return bucket
+    finally:
+        _buckets_lock.release()
@@ -0,0 +1,168 @@
+#==============================================================================
+# readcache.py
+# Bounded LRU cache of read results for Datastore.
+#==============================================================================
+#
+# Copyright (c) 2014, Exosite LLC
+# All rights reserved.
+#
+import threading
+import time
+from collections import deque
+try:
+    from collections import OrderedDict
+except ImportError:
+    # Python 2.6
+    OrderedDict = None
+
+
+class _InsertionOrderedDict():
+    '''The parts of OrderedDict ReadCache uses, for Python 2.6. Keys are
+    kept in a deque in insertion order; a deleted or reinserted key's old
+    place is skipped when popping, and the deque is compacted when
+    skipped places outnumber live keys.'''
+    def __init__(self):
+        # key -> (value, sequence number of its place in _order)
+        self._items = {}
+        self._order = deque()
+        self._seq = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def get(self, key, default=None):
+        item = self._items.get(key)
+        if item is None:
+            return default
+        return item[0]
+
+    def __setitem__(self, key, value):
+        self._seq += 1
+        self._items[key] = (value, self._seq)
+        self._order.append((key, self._seq))
+        if len(self._order) > 2 * len(self._items) + 16:
+            self._order = deque([place for place in self._order
+                                 if self._items.get(place[0],
+                                                    (None, None))[1]
+                                 == place[1]])
+
+    def __delitem__(self, key):
+        del self._items[key]
+
+    def pop(self, key, default=None):
+        item = self._items.pop(key, None)
+        if item is None:
+            return default
+        return item[0]
+
+    def popitem(self, last=True):
+        if not self._items:
+            raise KeyError('dictionary is empty')
+        while True:
+            if last:
+                key, seq = self._order.pop()
+            else:
+                key, seq = self._order.popleft()
+            item = self._items.get(key)
+            if item is not None and item[1] == seq:
+                del self._items[key]
+                return key, item[0]
+
+    def clear(self):
+        self._items.clear()
+        self._order.clear()
+
+
+if OrderedDict is None:
+    OrderedDict = _InsertionOrderedDict
+
+
+class ReadCache():
+    '''Thread-safe cache of read results by alias, evicting the least
+    recently used alias when full.
+
+        maxsize: maximum number of aliases cached
+        ttl: seconds a result stays valid
+
+    Results are stored with the count they were read with. Since
+    Datastore reads newest first, a cached result also serves any smaller
+    count.'''
+    def __init__(self, maxsize=1024, ttl=5):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # alias -> (data, count, expiry time)
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, alias, count):
+        '''Returns the newest count points of alias, or None if they
+        aren't cached.'''
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(alias)
+            if entry is None:
+                self.misses += 1
+                return None
+            data, cachedcount, expiry = entry
+            if expiry < time.time():
+                del self._entries[alias]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            # a smaller read than the platform returned means there are
+            # no more points, so it answers any count.
+            if count > cachedcount and len(data) >= cachedcount:
+                self.misses += 1
+                return None
+            # most recently used last
+            del self._entries[alias]
+            self._entries[alias] = entry
+            self.hits += 1
+            if count >= len(data):
+                return data
+            return data[:count]
+        finally:
+            self._lock.release()
+
+    def put(self, alias, count, data):
+        '''Caches data, the result of reading count points of alias.'''
+        self._lock.acquire()
+        try:
+            if alias in self._entries:
+                del self._entries[alias]
+            elif len(self._entries) >= self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+            self._entries[alias] = (data, count, time.time() + self.ttl)
+        finally:
+            self._lock.release()
+
+    def invalidate(self, alias=None):
+        '''Removes alias from the cache, or everything if alias is None.'''
+        self._lock.acquire()
+        try:
+            if alias is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(alias, None)
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        '''Returns a dict of cache counters.'''
+        self._lock.acquire()
+        try:
+            return {'size': len(self._entries),
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'expirations': self.expirations}
+        finally:
+            self._lock.release()
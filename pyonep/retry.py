@@ -0,0 +1,126 @@
+#==============================================================================
+# retry.py
+# Retries with backoff, and circuit breakers, for requests to the platform.
+#==============================================================================
+#
+# Copyright (c) 2014, Exosite LLC
+# All rights reserved.
+#
+import random
+import threading
+import time
+
+# HTTP statuses that mean a request may succeed if it's sent again
+transient_statuses = set([429, 500, 502, 503, 504])
+
+
+class RetryPolicy():
+    '''Retries requests that fail to get a response, or get a transient
+    HTTP status, if every call in them is to an idempotent procedure.
+
+        retries: maximum number of retries of a request
+        backoff: the nth retry waits a random time of up to
+                 backoff * 2 ** n seconds
+        max_backoff: longest wait before a retry
+        procedures: procedures that are safe to call twice. Defaults to
+                    idempotent_procedures.'''
+    idempotent_procedures = set(['read', 'info', 'listing', 'lookup',
+                                 'usage'])
+
+    def __init__(self, retries=3, backoff=0.1, max_backoff=10,
+                 procedures=None):
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        if procedures is None:
+            procedures = self.idempotent_procedures
+        self.procedures = procedures
+
+    def delay(self, callrequests, attempt):
+        '''Returns the number of seconds to wait before sending a request
+        for callrequests again after attempt retries, or None if it
+        shouldn't be retried.'''
+        if attempt >= self.retries:
+            return None
+        for call in callrequests:
+            if call['procedure'] not in self.procedures:
+                return None
+        # a random wait spreads out the retries of clients that failed
+        # at the same time
+        return random.uniform(0, min(self.max_backoff,
+                                     self.backoff * 2 ** attempt))
+
+
+class CircuitBreaker():
+    '''Fails requests to a host fast while it's down, rather than letting
+    each one wait for a timeout.
+
+        failure_threshold: consecutive failures that open the circuit
+        reset_timeout: seconds the circuit stays open before a single
+                       request is let through to test the host. If it
+                       succeeds the circuit closes, otherwise it opens
+                       again.'''
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self._openedAt = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        '''Returns True if a request may be sent now.'''
+        self._lock.acquire()
+        try:
+            if self.state == self.CLOSED:
+                return True
+            if time.time() - self._openedAt < self.reset_timeout:
+                return False
+            # let one request through. If it never reports back, another
+            # is let through after reset_timeout.
+            self.state = self.HALF_OPEN
+            self._openedAt = time.time()
+            return True
+        finally:
+            self._lock.release()
+
+    def success(self):
+        self._lock.acquire()
+        try:
+            self.state = self.CLOSED
+            self.failures = 0
+        finally:
+            self._lock.release()
+
+    def failure(self):
+        self._lock.acquire()
+        try:
+            self.failures += 1
+            if (self.state == self.HALF_OPEN
+                    or self.failures >= self.failure_threshold):
+                self.state = self.OPEN
+                self._openedAt = time.time()
+        finally:
+            self._lock.release()
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def breaker_for(key, failure_threshold=5, reset_timeout=30):
+    '''Returns the CircuitBreaker for key (e.g. a host), creating it with
+    failure_threshold and reset_timeout if needed.'''
+    _breakers_lock.acquire()
+    try:
+        breaker = _breakers.get(key)
+        if breaker is None:
+            breaker = CircuitBreaker(failure_threshold, reset_timeout)
+            _breakers[key] = breaker
+        return breaker
+    finally:
+        _breakers_lock.release()
@@ -0,0 +1,56 @@
+#==============================================================================
+# singleflight.py
+# Coalescing of concurrent identical calls.
+#==============================================================================
+#
+# Copyright (c) 2014, Exosite LLC
+# All rights reserved.
+#
+import sys
+import threading
+
+
+class _Call():
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.exception = None
+
+
+class SingleFlight():
+    '''Makes concurrent calls with the same key share one call. The first
+    thread to call do() with a key runs the function. Threads that call
+    do() with that key while it's running wait for it and get the same
+    result (the same object, so callers shouldn't modify it), or the same
+    exception.'''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn, *args):
+        self._lock.acquire()
+        try:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+        finally:
+            self._lock.release()
+        if leader:
+            try:
+                call.result = fn(*args)
+            except Exception:
+                call.exception = sys.exc_info()[1]
+            finally:
+                self._lock.acquire()
+                try:
+                    del self._calls[key]
+                finally:
+                    self._lock.release()
+                call.done.set()
+        else:
+            call.done.wait()
+        if call.exception is not None:
+            raise call.exception
+        return call.result
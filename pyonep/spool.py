@@ -0,0 +1,95 @@
+#==============================================================================
+# spool.py
+# Durable on-disk buffer for Datastore writes and records.
+#==============================================================================
+#
+# A Datastore created with a spool appends every write() and record() to
+# it rather than keeping them in memory. The flush thread reads the oldest
+# points in large batches, sends them, and removes them from the spool
+# only after the platform has acknowledged them, so buffered data survives
+# a restart and memory use doesn't grow during an outage.
+#
+# Copyright (c) 2014, Exosite LLC
+# All rights reserved.
+#
+import json
+import sqlite3
+import threading
+
+
+class SqliteSpool():
+    '''Append-only spool of (alias, timestamp, value) points, stored in a
+    SQLite database in write-ahead log mode.
+
+        path: database file. It's created if it doesn't exist, and points
+              left in it by an earlier process are sent first.'''
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        # a committed append survives a process crash. (FULL would also
+        # survive power loss, at the cost of an fsync per append.)
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS spool ('
+                         'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                         'alias TEXT NOT NULL, '
+                         'timestamp INTEGER NOT NULL, '
+                         'value TEXT NOT NULL)')
+        self._db.commit()
+
+    def append(self, alias, entries):
+        '''Appends a list of [timestamp, value] entries for alias.'''
+        rows = [(alias, int(t), json.dumps(value)) for (t, value) in entries]
+        self._lock.acquire()
+        try:
+            self._db.executemany(
+                'INSERT INTO spool (alias, timestamp, value) VALUES (?, ?, ?)',
+                rows)
+            self._db.commit()
+        finally:
+            self._lock.release()
+
+    def peek(self, limit, exclude=()):
+        '''Returns up to limit of the oldest points as a list of
+        (id, alias, timestamp, value), without removing them. Points of
+        the aliases in exclude are skipped.'''
+        exclude = list(exclude)
+        where = ''
+        if exclude:
+            where = 'WHERE alias NOT IN (%s) ' % ','.join('?' * len(exclude))
+        self._lock.acquire()
+        try:
+            rows = self._db.execute(
+                'SELECT id, alias, timestamp, value FROM spool ' + where +
+                'ORDER BY id LIMIT ?', exclude + [limit]).fetchall()
+        finally:
+            self._lock.release()
+        return [(rowid, alias, t, json.loads(value))
+                for (rowid, alias, t, value) in rows]
+
+    def ack(self, ids):
+        '''Removes the points with these ids, once they have been written
+        to the platform.'''
+        self._lock.acquire()
+        try:
+            self._db.executemany('DELETE FROM spool WHERE id = ?',
+                                 [(rowid,) for rowid in ids])
+            self._db.commit()
+        finally:
+            self._lock.release()
+
+    def count(self):
+        '''Returns the number of points in the spool.'''
+        self._lock.acquire()
+        try:
+            return self._db.execute('SELECT COUNT(*) FROM spool').fetchone()[0]
+        finally:
+            self._lock.release()
+
+    def close(self):
+        self._lock.acquire()
+        try:
+            self._db.close()
+        finally:
+            self._lock.release()
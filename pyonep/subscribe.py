@@ -0,0 +1,287 @@
+#==============================================================================
+# subscribe.py
+# Subscriptions to new points of many resources over a few long-polls.
+#==============================================================================
+#
+# OnepV1.wait() blocks the calling thread until a point arrives. A
+# SubscriptionManager long-polls its subscriptions in turn on a fixed
+# number of worker threads. wait() only returns the newest point, so when
+# it's more than a second newer than the last one delivered, the points
+# in between are read, and every point is delivered in order. The
+# platform answers the calls of a request one after another, so by
+# default each long-poll is a request of a single wait.
+#
+# Copyright (c) 2014, Exosite LLC
+# All rights reserved.
+#
+import sys
+import threading
+import time
+import logging
+from collections import deque
+
+log = logging.getLogger(__name__)
+
+
+class Subscription():
+    '''A subscription to new points of one resource. Use
+    SubscriptionManager.subscribe() to create one.
+
+        since: timestamp of the last point delivered. Only newer points
+               are delivered.'''
+    def __init__(self, manager, auth, rid, callback=None, queue=None,
+                 since=None):
+        self.auth = auth
+        self.rid = rid
+        self.callback = callback
+        self.queue = queue
+        self.since = since
+        self.active = True
+        self._manager = manager
+
+    def deliver(self, point):
+        '''Passes a [timestamp, value] point to the callback, as
+        callback(rid, point), and puts (rid, point) on the queue.'''
+        self.since = point[0]
+        if self.callback is not None:
+            try:
+                self.callback(self.rid, point)
+            except Exception:
+                log.exception("Exception in subscription callback")
+        if self.queue is not None:
+            self.queue.put((self.rid, point))
+
+    def unsubscribe(self):
+        self._manager.unsubscribe(self)
+
+
+class SubscriptionManager():
+    '''Waits for new points of many resources with a few threads.
+
+        onep: OnepV1 to make wait calls with. Unless it was created with a
+              ConnectionPool, only one worker is used, since its
+              connection can't be shared between threads.
+        workers: number of worker threads, and so of long-polls in
+                 progress at once. With more subscriptions than workers,
+                 the others wait their turn, each poll taking up to
+                 timeout, so a point may be delivered about
+                 subscriptions / workers * timeout late. It isn't lost,
+                 since the next poll of its subscription returns at once.
+        timeout: milliseconds the platform holds each long-poll open. A
+                 shorter timeout takes turns faster.
+        max_waits: maximum number of wait calls per request, for
+                   subscriptions with the same auth. The platform answers
+                   them one after another, so a point isn't delivered
+                   until the waits before it in the request have returned.
+                   Raise it only to save connections where latency
+                   doesn't matter.
+        retry_delay: seconds to wait before polling again after a failure
+
+    Call start() to start the workers, then subscribe().'''
+    def __init__(self,
+                 onep,
+                 workers=4,
+                 timeout=30000,
+                 max_waits=1,
+                 retry_delay=5):
+        if workers != 1 and onep.onephttp.pool is None:
+            log.info("workers requires a connection pool, "
+                        "using a single worker")
+            workers = 1
+        self._onep = onep
+        self._workers = workers
+        self.timeout = timeout
+        self.max_waits = max(max_waits, 1)
+        self.retry_delay = retry_delay
+        self._cond = threading.Condition(threading.Lock())
+        # subscriptions waiting for a worker to poll them
+        self._ready = deque()
+        self._running = False
+        self._threads = []
+
+    def __latest(self, auth, rid):
+        '''Returns the timestamp to deliver points of rid after: that of
+        its latest point, 0 if it has none, or the current time if it
+        can't be read.'''
+        try:
+            isok, points = self._onep.read(auth, rid,
+                                           {'limit': 1, 'sort': 'desc'})
+        except Exception:
+            isok = False
+        if not isok:
+            log.warning("Couldn't read latest point of %s, "
+                        "delivering points from now" % rid)
+            return int(time.time())
+        if points:
+            return points[0][0]
+        return 0
+
+    def subscribe(self, auth, rid, callback=None, queue=None, since=None):
+        '''Subscribes to new points of rid, which are passed to
+        callback(rid, point) and put on queue as (rid, point), from a
+        worker thread. Points newer than the timestamp since are delivered.
+        If since is None, it's the timestamp of rid's latest point, read
+        before returning, so that no point written after subscribe() is
+        missed. Returns a Subscription.'''
+        if since is None:
+            since = self.__latest(auth, rid)
+        sub = Subscription(self, auth, rid, callback, queue, since)
+        sub._authkey = self._onep.deferred._authstr(self._onep._getAuth(auth))
+        self._cond.acquire()
+        try:
+            self._ready.append(sub)
+            self._cond.notify()
+        finally:
+            self._cond.release()
+        return sub
+
+    def unsubscribe(self, sub):
+        '''Stops delivering points for sub. A long-poll in progress for it
+        is left to expire.'''
+        self._cond.acquire()
+        try:
+            sub.active = False
+            try:
+                self._ready.remove(sub)
+            except ValueError:
+                # being polled
+                pass
+            self._cond.notify_all()
+        finally:
+            self._cond.release()
+
+    def start(self, daemon=True):
+        self._cond.acquire()
+        try:
+            self._running = True
+            self._threads = []
+            for n in range(self._workers):
+                thread = threading.Thread(target=self.__work)
+                thread.daemon = daemon
+                self._threads.append(thread)
+                thread.start()
+        finally:
+            self._cond.release()
+
+    def stop(self, wait=False, timeout=None):
+        '''Stops the workers. Long-polls in progress are left to expire, so
+        waiting may take up to the manager's timeout.'''
+        self._cond.acquire()
+        try:
+            self._running = False
+            self._cond.notify_all()
+        finally:
+            self._cond.release()
+        if wait:
+            for thread in list(self._threads):
+                thread.join(timeout)
+
+    def __take(self):
+        '''Waits for a ready subscription and takes it, with up to
+        max_waits - 1 others that have the same auth. Returns an empty
+        list once stopped.'''
+        self._cond.acquire()
+        try:
+            while True:
+                if not self._running:
+                    return []
+                if self._ready:
+                    break
+                self._cond.wait()
+            batch = [self._ready.popleft()]
+            for sub in list(self._ready):
+                if len(batch) >= self.max_waits:
+                    break
+                if sub._authkey == batch[0]._authkey:
+                    self._ready.remove(sub)
+                    batch.append(sub)
+            return batch
+        finally:
+            self._cond.release()
+
+    def __requeue(self, batch, delay=0):
+        '''Puts the active subscriptions of batch back in line, after delay
+        seconds unless the manager is stopped first.'''
+        deadline = time.time() + delay
+        self._cond.acquire()
+        try:
+            while self._running:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            for sub in batch:
+                if sub.active:
+                    self._ready.append(sub)
+            self._cond.notify_all()
+        finally:
+            self._cond.release()
+
+    def __poll(self, batch):
+        '''Sends one request of wait calls for batch and delivers the
+        points. Returns False if anything failed.'''
+        pairs = []
+        for sub in batch:
+            options = {'timeout': self.timeout}
+            if sub.since is not None:
+                options['since'] = sub.since
+            pairs.append(('wait', [sub.rid, options]))
+        calls = self._onep._composeCalls(pairs)
+        subs = dict((call['id'], sub) for call, sub in zip(calls, batch))
+        try:
+            results = self._onep._callJsonRPC(batch[0].auth,
+                                              calls,
+                                              returnreq=True,
+                                              notimeout=True)
+        except Exception:
+            e = sys.exc_info()[1]
+            log.error("Exception while waiting: %s" % e)
+            return False
+        ok = True
+        for request, status, res in results:
+            sub = subs[request['id']]
+            if status:
+                if not sub.active:
+                    continue
+                # a single [timestamp, value], or a list of them
+                if res and isinstance(res[0], list):
+                    points = res
+                else:
+                    points = [res]
+                ok = self.__deliver(sub, points) and ok
+            elif res != 'expire':
+                log.error("Error message from one platform (wait): %s" % res)
+                ok = False
+        return ok
+
+    def __deliver(self, sub, points):
+        '''Delivers the points a wait returned for sub, and any written
+        since sub.since that the wait didn't return. Returns False if
+        those couldn't be read.'''
+        points = sorted(points, key=lambda p: p[0])
+        if sub.since is not None and points[-1][0] > sub.since + 1:
+            try:
+                points = list(self._onep.iter_read(sub.auth,
+                                                   sub.rid,
+                                                   sub.since + 1,
+                                                   points[-1][0]))
+            except Exception:
+                e = sys.exc_info()[1]
+                log.error("Exception while reading points of %s: %s" % (
+                    sub.rid, e))
+                # the next wait returns at once and tries again
+                return False
+        for point in points:
+            if sub.since is None or point[0] > sub.since:
+                sub.deliver(point)
+        return True
+
+    def __work(self):
+        while True:
+            batch = self.__take()
+            if not batch:
+                return
+            if self.__poll(batch):
+                self.__requeue(batch)
+            else:
+                self.__requeue(batch, self.retry_delay)
@@ -0,0 +1,130 @@
+#==============================================================================
+# workerpool.py
+# Fixed set of threads for sending requests concurrently.
+#==============================================================================
+#
+# OnepV1.send_deferred() and Datastore send the requests of a split batch
+# concurrently with a WorkerPool, so the number of threads doesn't grow
+# with the number of batches, clients or Datastores. Pass one WorkerPool
+# to many OnepV1 instances (or to a DatastoreHub) to share its threads.
+#
+# Copyright (c) 2014, Exosite LLC
+# All rights reserved.
+#
+import sys
+import threading
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+
+class _Job():
+    '''One call of WorkerPool.map(). Whichever thread claims an item
+    runs it, so the caller can always finish the job itself.'''
+    def __init__(self, fn, items):
+        self.fn = fn
+        self.items = items
+        self.results = [None] * len(items)
+        self.exception = None
+        self._next = 0
+        self._running = 0
+        self._cond = threading.Condition(threading.Lock())
+
+    def work(self):
+        while True:
+            self._cond.acquire()
+            try:
+                i = self._next
+                if i >= len(self.items):
+                    return
+                self._next += 1
+                self._running += 1
+            finally:
+                self._cond.release()
+            try:
+                self.results[i] = self.fn(self.items[i])
+            except Exception:
+                if self.exception is None:
+                    self.exception = sys.exc_info()[1]
+            self._cond.acquire()
+            try:
+                self._running -= 1
+                self._cond.notify_all()
+            finally:
+                self._cond.release()
+
+    def wait(self):
+        self._cond.acquire()
+        try:
+            while self._running:
+                self._cond.wait()
+        finally:
+            self._cond.release()
+
+
+class WorkerPool():
+    '''Runs functions on up to workers threads, started when first needed
+    and kept until shutdown().
+
+        workers: number of threads'''
+    def __init__(self, workers=4):
+        self.workers = workers
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def __start(self):
+        self._lock.acquire()
+        try:
+            self._threads = [t for t in self._threads if t.is_alive()]
+            while len(self._threads) < self.workers:
+                t = threading.Thread(target=self.__run)
+                t.daemon = True
+                t.start()
+                self._threads.append(t)
+        finally:
+            self._lock.release()
+
+    def __run(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            job.work()
+
+    def map(self, fn, items, concurrency=None):
+        '''Returns [fn(item) for item in items], calling fn for up to
+        concurrency items at once (by default, workers + 1). The calling
+        thread runs items too, so map() finishes even when every worker is
+        busy, e.g. when it's called from a worker. If fn raises, the other
+        items are still run, then the first exception is raised.'''
+        items = list(items)
+        if concurrency is None:
+            concurrency = self.workers + 1
+        helpers = min(concurrency, len(items)) - 1
+        job = _Job(fn, items)
+        if helpers > 0:
+            self.__start()
+            for n in range(helpers):
+                self._queue.put(job)
+        job.work()
+        job.wait()
+        if job.exception is not None:
+            raise job.exception
+        return job.results
+
+    def shutdown(self, wait=False):
+        '''Stops the threads once they finish what they're running. The
+        pool starts them again if it's used after this.'''
+        self._lock.acquire()
+        try:
+            threads = self._threads
+            self._threads = []
+            for t in threads:
+                self._queue.put(None)
+        finally:
+            self._lock.release()
+        if wait:
+            for t in threads:
+                t.join()
@@ -0,0 +1,819 @@
+# -*- coding: utf-8 -*-
+'''Test pyonep against the in-process fake One Platform.'''
+from __future__ import unicode_literals
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+import zlib
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+from unittest import TestCase
+
+from pyonep import onep
+from pyonep import onephttp
+from pyonep import provision
+from pyonep.aliascache import AliasCache
+from pyonep.datastore import Datastore, DatastoreHub, datastore_config
+from pyonep.exceptions import OnePlatformException, CircuitOpenException
+from pyonep.exceptions import JsonRPCResponseException
+from pyonep.fakeserver import FakeOnePlatform, RPC_PATH
+from pyonep.onephttp import ConnectionPool, Decompressor
+from pyonep.readcache import ReadCache, _InsertionOrderedDict
+from pyonep.subscribe import SubscriptionManager
+from pyonep.instrument import HistogramCollector, Listener
+from pyonep.jsoncodec import get_codec
+from pyonep.ratelimit import TokenBucket, bucket_for
+from pyonep.retry import RetryPolicy, CircuitBreaker
+from pyonep.singleflight import SingleFlight
+from pyonep.spool import SqliteSpool
+from pyonep.workerpool import WorkerPool
+
+
+class TestFakeServer(TestCase):
+    def setUp(self):
+        self.server = FakeOnePlatform(seed=1)
+        self.server.start()
+        self.cik = self.server.create_client('testclient')
+        self.onep = onep.OnepV1(self.server.host, self.server.port)
+
+    def tearDown(self):
+        self.server.stop()
+
+    def makeDataport(self, alias):
+        isok, rid = self.onep.create(
+            self.cik,
+            'dataport',
+            {'format': 'integer', 'retention': {'count': 'infinity',
+                                                'duration': 'infinity'}})
+        self.assertTrue(isok, 'created dataport')
+        isok, response = self.onep.map(self.cik, rid, alias)
+        self.assertTrue(isok, 'mapped alias')
+        return rid
+
+    def test_dataport(self):
+        rid = self.makeDataport('temp')
+        self.assertEqual(self.onep.lookup(self.cik, 'alias', 'temp'),
+                         (True, rid))
+        self.assertTrue(self.onep.write(self.cik, rid, 1)[0])
+        self.assertTrue(self.onep.record(self.cik, rid, [[100, 2], [101, 3]])[0])
+        isok, points = self.onep.read(self.cik, {'alias': 'temp'},
+                                      {'starttime': 0, 'limit': 10,
+                                       'sort': 'asc'})
+        self.assertTrue(isok)
+        self.assertEqual([p[1] for p in points], [2, 3, 1])
+        isok, info = self.onep.info(self.cik, {'alias': ''}, {'aliases': True})
+        self.assertEqual(info['aliases'], {rid: ['temp']})
+        isok, listing = self.onep.listing(self.cik, ['dataport'], {},
+                                          {'alias': ''})
+        self.assertEqual(listing, {'dataport': [rid]})
+        self.assertTrue(self.onep.drop(self.cik, rid)[0])
+        isok, response = self.onep.lookup(self.cik, 'alias', 'temp')
+        self.assertFalse(isok)
+
+    def test_deferred(self):
+        rids = [self.makeDataport(alias) for alias in ('a', 'b')]
+        self.onep.writegroup(self.cik, [[rids[0], 1], [rids[1], 2]],
+                             defer=True)
+        self.onep.read(self.cik, rids[1], {}, defer=True)
+        responses = self.onep.send_deferred(self.cik)
+        self.assertEqual([isok for (call, isok, response) in responses],
+                         [True, True])
+        self.assertEqual(responses[1][2][0][1], 2)
+
+    def test_deferred_split_failure(self):
+        rid = self.makeDataport('d')
+        for t in range(1, 9):
+            self.onep.record(self.cik, rid, [[t, t]], defer=True)
+        self.server.error_rate = 0.5
+        responses = self.onep.send_deferred(self.cik, max_calls=2)
+        self.server.error_rate = 0
+        self.assertEqual([call['arguments'][1][0][0]
+                          for (call, isok, response) in responses],
+                         list(range(1, 9)))
+        failed = [call['arguments'][1][0][0]
+                  for (call, isok, response) in responses if not isok]
+        self.assertTrue(0 < len(failed) < 8)
+        for (call, isok, response) in responses:
+            if not isok:
+                self.assertTrue(isinstance(response, OnePlatformException))
+        isok, points = self.onep.read(self.cik, rid, {'limit': 10,
+                                                      'sort': 'asc'})
+        self.assertEqual([p[0] for p in points],
+                         [t for t in range(1, 9) if t not in failed])
+
+    def test_workerpool(self):
+        pool = WorkerPool(workers=1)
+        self.assertEqual(pool.map(lambda n: n * 2, range(5)),
+                         [0, 2, 4, 6, 8])
+        # a map() from the pool's only worker finishes on that thread
+        self.assertEqual(pool.map(lambda n: sum(pool.map(abs, [n, -n])),
+                                  [1, 2, 3]),
+                         [2, 4, 6])
+        self.assertRaises(ZeroDivisionError, pool.map, lambda n: 1 / n,
+                          [1, 0, 2])
+        # split requests are sent by the caller and the pool's thread
+        threads = set()
+
+        class ThreadListener(Listener):
+            def request_start(self, event):
+                threads.add(threading.current_thread())
+        o = onep.OnepV1(self.server.host, self.server.port,
+                        pool=ConnectionPool(), workerpool=pool,
+                        listeners=[ThreadListener()])
+        rid = self.makeDataport('w')
+        for n in range(3):
+            for t in range(1, 7):
+                o.record(self.cik, rid, [[t + n * 6, t]], defer=True)
+            responses = o.send_deferred(self.cik, max_calls=1, concurrency=4)
+            self.assertEqual([isok for (call, isok, response) in responses],
+                             [True] * 6)
+        self.assertTrue(len(threads) <= 2)
+        pool.shutdown(wait=True)
+
+    def test_wait(self):
+        rid = self.makeDataport('w')
+        start = time.time()
+        isok, response = self.onep.wait(self.cik, rid, {'timeout': 100})
+        self.assertEqual((isok, response), (False, 'expire'))
+        self.assertTrue(time.time() - start >= 0.1)
+        self.onep.record(self.cik, rid, [[100, 5]])
+        isok, point = self.onep.wait(self.cik, rid,
+                                     {'timeout': 1000, 'since': 99})
+        self.assertEqual(point, [100, 5])
+
+    def test_injected_failures(self):
+        self.server.error_rate = 1
+        self.assertRaises(OnePlatformException,
+                          self.onep.info, self.cik, {'alias': ''})
+        self.server.error_rate = 0
+        self.server.rate_limit = 1
+        self.onep.info(self.cik, {'alias': ''})
+        self.assertRaises(OnePlatformException,
+                          self.onep.info, self.cik, {'alias': ''})
+        stats = self.server.stats()
+        self.assertEqual(stats['errors_injected'], 1)
+        self.assertTrue(stats['rate_limited'] >= 1)
+
+    def test_retry(self):
+        rid = self.makeDataport('r')
+        o = onep.OnepV1(self.server.host, self.server.port,
+                        retry=RetryPolicy(retries=20, backoff=0.001))
+        self.server.error_rate = 0.5
+        for i in range(10):
+            self.assertTrue(o.read(self.cik, rid, {})[0])
+        # writes aren't retried
+        self.server.error_rate = 1
+        requests = self.server.stats()['requests']
+        self.assertRaises(OnePlatformException, o.write, self.cik, rid, 1)
+        self.assertEqual(self.server.stats()['requests'], requests + 1)
+
+    def test_circuitbreaker(self):
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.2)
+        o = onep.OnepV1(self.server.host, self.server.port,
+                        circuitbreaker=breaker)
+        self.server.error_rate = 1
+        for i in range(2):
+            self.assertRaises(OnePlatformException,
+                              o.info, self.cik, {'alias': ''})
+        requests = self.server.stats()['requests']
+        self.assertRaises(CircuitOpenException,
+                          o.info, self.cik, {'alias': ''})
+        self.assertEqual(self.server.stats()['requests'], requests)
+        self.server.error_rate = 0
+        time.sleep(0.2)
+        self.assertTrue(o.info(self.cik, {'alias': ''})[0])
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+    def test_provision(self):
+        p = provision.Provision(self.server.host, self.server.port,
+                                manage_by_cik=True)
+        self.assertTrue(p.vendor_register(self.cik, 'vendor').isok)
+        self.assertTrue(p.model_create(self.cik, 'model', 'rid').isok)
+        self.assertTrue(p.serialnumber_add(self.cik, 'model', 'sn1').isok)
+        self.assertEqual(p.serialnumber_list(self.cik, 'model').body, 'sn1')
+        response = p.serialnumber_activate('model', 'sn1', 'vendor')
+        self.assertTrue(response.isok)
+        devicecik = response.body
+        self.assertEqual(p.serialnumber_activate('model', 'sn1',
+                                                 'vendor').status(), 409)
+        self.assertTrue(
+            p.serialnumber_info(self.cik, 'model', 'sn1').body.startswith(
+                'activated,'))
+        isok, info = onep.OnepV1(self.server.host, self.server.port).info(
+            devicecik, {'alias': ''}, {'key': True})
+        self.assertEqual(info['key'], devicecik)
+
+    def makeDatastore(self, config={}, **kwargs):
+        config = dict(datastore_config, read_rate=None, write_rate=None,
+                      **config)
+        transport = {'host': self.server.host,
+                     'port': str(self.server.port),
+                     'url': '/onep:v1/rpc/process',
+                     'https': False,
+                     'timeout': 3}
+        return Datastore(self.cik, 30, config=config, transport=transport,
+                         **kwargs)
+
+    def test_hub(self):
+        ciks = [self.cik] + [self.server.create_client('hub%d' % n)
+                             for n in range(3)]
+        rids = []
+        for cik in ciks:
+            isok, rid = self.onep.create(cik, 'dataport',
+                                         {'format': 'integer'})
+            self.onep.map(cik, rid, 'h')
+            rids.append(rid)
+        config = dict(datastore_config, read_rate=None, write_rate=None)
+        transport = {'host': self.server.host,
+                     'port': str(self.server.port),
+                     'url': '/onep:v1/rpc/process',
+                     'https': False,
+                     'timeout': 3}
+        hub = DatastoreHub(1, config=config, transport=transport, workers=2)
+        for cik in ciks:
+            hub.add(cik)
+        hub.start(daemon=True)
+        try:
+            for n, cik in enumerate(ciks):
+                self.assertTrue(hub.get(cik).write('h', n))
+            # flushed when the interval elapses, without flush()
+            deadline = time.time() + 5
+            while time.time() < deadline:
+                counts = [len(self.onep.read(cik, rid, {})[1])
+                          for cik, rid in zip(ciks, rids)]
+                if counts == [1] * len(ciks):
+                    break
+                time.sleep(0.1)
+            self.assertEqual(counts, [1] * len(ciks))
+            # one scheduled check per Datastore
+            self.assertTrue(len(hub._scheduled) <= len(ciks))
+        finally:
+            self.assertTrue(hub.stop(wait=True, timeout=5))
+        self.assertFalse(hub.isThreadAlive())
+
+    def test_aliascache(self):
+        cache = AliasCache()
+        o = onep.OnepV1(self.server.host, self.server.port,
+                        aliascache=cache)
+        rid = self.makeDataport('x')
+        self.assertEqual(o.lookup(self.cik, 'alias', 'x'), (True, rid))
+        # a Datastore sharing the cache resolves x without a request
+        datastore = self.makeDatastore(aliascache=cache)
+        calls = self.server.stats()['calls']
+        self.assertEqual(datastore.warmup_aliases(['x']), {'x': rid})
+        self.assertEqual(self.server.stats()['calls'], calls)
+        # a deferred unmap invalidates once it has been sent
+        o.unmap(self.cik, 'x', defer=True)
+        self.assertEqual(cache.get(self.cik, 'x'), rid)
+        o.send_deferred(self.cik)
+        self.assertEqual(cache.get(self.cik, 'x'), None)
+        self.assertFalse(o.lookup(self.cik, 'alias', 'x')[0])
+        self.assertFalse(cache.get({'cik': self.cik}, 'x'))
+        # Datastores don't share a cache unless given one
+        self.assertFalse(self.makeDatastore()._aliases is
+                         self.makeDatastore()._aliases)
+
+    def test_readcache(self):
+        for entries in (None, _InsertionOrderedDict()):
+            cache = ReadCache(maxsize=2)
+            if entries is not None:
+                # as on Python 2.6
+                cache._entries = entries
+            cache.put('a', 2, [[3, 3], [2, 2]])
+            cache.put('b', 1, [[5, 5]])
+            self.assertEqual(cache.get('a', 1), [[3, 3]])
+            # a was used more recently, so b is evicted
+            cache.put('c', 1, [[1, 1]])
+            self.assertEqual(cache.get('b', 1), None)
+            self.assertEqual(cache.get('a', 3), None)
+            self.assertEqual(cache.get('c', 1), [[1, 1]])
+            self.assertEqual(cache.stats()['evictions'], 1)
+            cache.invalidate('c')
+            self.assertEqual(cache.stats()['size'], 1)
+
+    def test_spool(self):
+        rid = self.makeDataport('good')
+        # records to a client fail, without being a missing alias
+        isok, clientrid = self.onep.create(self.cik, 'client', {})
+        self.onep.map(self.cik, clientrid, 'bad')
+        tmp = tempfile.mkdtemp()
+        try:
+            spool = SqliteSpool(os.path.join(tmp, 'spool.db'))
+            datastore = self.makeDatastore({'spool_batch_size': 2},
+                                           spool=spool)
+            self.assertTrue(datastore.record('bad', [[1, 1], [2, 2], [3, 3]]))
+            self.assertTrue(datastore.record('good', [[1, 1], [2, 2]]))
+            self.assertFalse(datastore.flush())
+            # the failing alias at the head of the spool doesn't hold back
+            # the others
+            isok, points = self.onep.read(self.cik, rid, {'limit': 5})
+            self.assertEqual(len(points), 2)
+            self.assertEqual(set(alias for (rowid, alias, t, value)
+                                 in spool.peek(10)), set(['bad']))
+            self.assertEqual(spool.count(), 3)
+            spool.close()
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_lossless(self):
+        rid = self.makeDataport('l')
+        datastore = self.makeDatastore({'lossless': True})
+        # start just after a second begins, so both writes are in it
+        time.sleep(1.02 - time.time() % 1)
+        self.assertTrue(datastore.write('l', 1))
+        # the latest sample in a second is kept
+        self.assertFalse(datastore.write('l', 2))
+        time.sleep(1.02 - time.time() % 1)
+        self.assertTrue(datastore.write('l', 3))
+        self.assertTrue(datastore.flush())
+        # even once the earlier one has been flushed
+        self.assertFalse(datastore.write('l', 4))
+        self.assertTrue(datastore.flush())
+        isok, points = self.onep.read(self.cik, rid, {'limit': 5,
+                                                      'sort': 'asc'})
+        self.assertEqual([p[1] for p in points], [2, 4])
+        self.assertEqual(points[1][0] - points[0][0], 1)
+
+    def test_datastore(self):
+        self.makeDataport('x')
+        datastore = self.makeDatastore()
+        self.assertTrue(datastore.write('x', 7))
+        self.assertTrue(datastore.flush())
+        self.assertEqual(datastore.read('x', forcequery=True)[0][1], 7)
+
+    def test_stream(self):
+        rid = self.makeDataport('s')
+        points = [[t, t * 2] for t in range(1, 2001)]
+        self.assertTrue(self.onep.record(self.cik, rid, points)[0])
+        streamed = list(self.onep.read_stream(
+            self.cik, rid, {'starttime': 0, 'limit': 5000, 'sort': 'asc'},
+            chunk_size=100))
+        self.assertEqual(streamed, points)
+        self.assertRaises(OnePlatformException, list,
+                          self.onep.read_stream(self.cik, 'badrid', {}))
+        self.onep.write(self.cik, rid, 1, defer=True)
+        self.onep.read(self.cik, rid, {'limit': 1}, defer=True)
+        responses = list(self.onep.send_deferred_stream(self.cik,
+                                                        chunk_size=7))
+        self.assertEqual([(call['procedure'], isok)
+                          for (call, isok, response) in responses],
+                         [('write', True), ('read', True)])
+        self.assertFalse(self.onep.deferred.has_requests(self.cik))
+
+    def test_compression(self):
+        rid = self.makeDataport('c')
+        o = onep.OnepV1(self.server.host, self.server.port,
+                        compress_min_bytes=100)
+        points = [[t, 1] for t in range(1, 1001)]
+        self.assertTrue(o.record(self.cik, rid, points)[0])
+        isok, response = o.read(self.cik, rid, {'limit': 1000,
+                                                'sort': 'asc'})
+        self.assertEqual(response, points)
+        streamed = list(o.read_stream(self.cik, rid, {'limit': 1000,
+                                                      'sort': 'asc'},
+                                      chunk_size=10))
+        self.assertEqual(streamed, points)
+        stats = self.server.stats()
+        self.assertEqual(stats['requests_compressed'], 3)
+        self.assertEqual(stats['responses_compressed'], 2)
+        stats = o.onephttp.compression_stats()
+        self.assertEqual(stats['responses_compressed'], 2)
+        self.assertTrue(stats['bytes_saved'] > 10000)
+
+    def test_decompressor(self):
+        data = b'{"result": [[1, 1], [2, 2]]}' * 20
+        raw = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS)
+        for encoding, body in (('deflate', zlib.compress(data)),
+                               ('deflate', raw.compress(data) + raw.flush())):
+            # a byte at a time, so the first chunk is shorter than a header
+            decompressor = Decompressor(encoding)
+            decoded = b''.join([decompressor.decompress(body[i:i + 1])
+                                for i in range(len(body))])
+            self.assertEqual(decoded + decompressor.flush(), data)
+
+    def test_instrument(self):
+        class Events(Listener):
+            def __init__(self):
+                self.events = []
+
+            def request_end(self, event):
+                self.events.append(event)
+
+        events = Events()
+        collector = HistogramCollector()
+        o = onep.OnepV1(self.server.host, self.server.port,
+                        reuseconnection=True,
+                        listeners=[events, collector])
+        rid = self.makeDataport('i')
+        for i in range(3):
+            o.read(self.cik, rid, {}, defer=True)
+            o.info(self.cik, rid, defer=True)
+            o.send_deferred(self.cik)
+        self.server.error_rate = 1
+        self.assertRaises(OnePlatformException, o.info, self.cik, rid)
+        self.server.error_rate = 0
+        first, second = events.events[:2]
+        self.assertEqual((first.kind, first.calls, first.procedures),
+                         ('rpc', 2, ['read', 'info']))
+        self.assertEqual((first.reused, second.reused), (False, True))
+        self.assertTrue(first.connect_time is not None)
+        self.assertTrue(first.request_bytes > 0 and first.response_bytes > 0)
+        self.assertTrue(0 < first.ttfb <= first.total_time)
+        self.assertEqual(events.events[-1].status, 500)
+        summary = collector.summary()
+        self.assertEqual((summary['read']['count'], summary['read']['errors']),
+                         (3, 0))
+        self.assertEqual((summary['info']['count'], summary['info']['errors']),
+                         (4, 1))
+        self.assertTrue(summary['read']['p50'] <= summary['read']['p99'])
+
+        p = provision.Provision(self.server.host, self.server.port,
+                                manage_by_cik=True, listeners=[collector])
+        p.serialnumber_list(self.cik, 'nomodel')
+        self.assertEqual(collector.summary()[
+            'GET /provision/manage/model']['count'], 1)
+
+    def test_subscriptions(self):
+        rids = [self.makeDataport('s%d' % i) for i in range(3)]
+        self.onep.record(self.cik, rids[1], [[50, 0]])
+        o = onep.OnepV1(self.server.host, self.server.port,
+                        pool=ConnectionPool())
+        manager = SubscriptionManager(o, workers=3, timeout=1500)
+        points = queue.Queue()
+        subs = [manager.subscribe(self.cik, rid, queue=points)
+                for rid in rids]
+        self.assertEqual([sub.since for sub in subs], [0, 50, 0])
+        # written before any wait reaches the platform
+        self.onep.record(self.cik, rids[1], [[60, 1]])
+        manager.start()
+        try:
+            self.assertEqual(points.get(timeout=2), (rids[1], [60, 1]))
+            # with a worker for each subscription, a point isn't held up
+            # by the others' waits
+            time.sleep(0.2)
+            start = time.time()
+            self.onep.record(self.cik, rids[0], [[100, 2]])
+            self.assertEqual(points.get(timeout=2), (rids[0], [100, 2]))
+            self.assertTrue(time.time() - start < 0.5)
+            subs[2].unsubscribe()
+            self.onep.record(self.cik, rids[2], [[100, 3]])
+            self.assertRaises(queue.Empty, points.get, timeout=0.3)
+        finally:
+            manager.stop(wait=True, timeout=5)
+
+    def test_subscription_burst(self):
+        rids = [self.makeDataport('b%d' % i) for i in range(6)]
+        o = onep.OnepV1(self.server.host, self.server.port,
+                        pool=ConnectionPool())
+        manager = SubscriptionManager(o, workers=2, timeout=300)
+        points = queue.Queue()
+        for rid in rids:
+            manager.subscribe(self.cik, rid, queue=points)
+        # wait() only returns the latest of these
+        self.onep.record(self.cik, rids[0], [[100, 1], [101, 2], [102, 3]])
+        manager.start()
+        try:
+            self.assertEqual(len(manager._threads), 2)
+            self.assertEqual([points.get(timeout=3) for i in range(3)],
+                             [(rids[0], [100, 1]),
+                              (rids[0], [101, 2]),
+                              (rids[0], [102, 3])])
+            self.onep.record(self.cik, rids[0], [[103, 4]])
+            self.assertEqual(points.get(timeout=3), (rids[0], [103, 4]))
+        finally:
+            manager.stop(wait=True, timeout=5)
+
+    def test_watch(self):
+        rid = self.makeDataport('w')
+        self.onep.record(self.cik, rid, [[100, 1]])
+        datastore = self.makeDatastore({'read_cache_expire_time': 600})
+        manager = SubscriptionManager(
+            onep.OnepV1(self.server.host, self.server.port,
+                        pool=ConnectionPool()),
+            timeout=1500)
+        self.assertEqual(datastore.read('w')[0][1], 1)
+        self.assertTrue(datastore.watch(manager, 'w'))
+        manager.start()
+        try:
+            self.onep.record(self.cik, rid, [[101, 2]])
+            deadline = time.time() + 2
+            while datastore.read('w')[0][1] != 2:
+                self.assertTrue(time.time() < deadline, 'cache invalidated')
+                time.sleep(0.05)
+        finally:
+            manager.stop(wait=True, timeout=5)
+
+    def test_async_columnar(self):
+        if sys.version_info < (3, 5):
+            self.skipTest('asynconep requires Python 3.5')
+        import asyncio
+        from pyonep.asynconep import AsyncOnepV1
+        rid = self.makeDataport('a')
+        self.onep.record(self.cik, rid, [[100, 1], [101, 2]])
+        o = AsyncOnepV1(self.server.host, self.server.port)
+        loop = asyncio.new_event_loop()
+        try:
+            isok, points = loop.run_until_complete(o.read(
+                self.cik, rid, {'limit': 2, 'sort': 'asc'}, columnar=True))
+            self.assertTrue(isok)
+            self.assertEqual(list(points.timestamps), [100, 101])
+            self.assertEqual(list(points.values), [1, 2])
+            isok, response = loop.run_until_complete(o.read(
+                self.cik, 'badrid', {}, columnar=True))
+            self.assertEqual((isok, response), (False, 'invalid'))
+            self.assertTrue(o.read(self.cik, rid, {}, defer=True,
+                                   columnar=True))
+            responses = loop.run_until_complete(o.send_deferred(self.cik))
+            self.assertEqual(responses[0][2], [[101, 2]])
+            o.onephttp.close()
+        finally:
+            loop.close()
+
+    def test_duplicate_timestamps(self):
+        rid = self.makeDataport('dup')
+        self.onep.record(self.cik, rid, [[5, 1], [6, 1]])
+        self.onep.record(self.cik, rid, [[5, 2]])
+        isok, points = self.onep.read(self.cik, rid, {'limit': 5,
+                                                      'sort': 'asc'})
+        self.assertEqual(points, [[5, 2], [6, 1]])
+
+    def test_pool(self):
+        events = []
+
+        class EventListener(Listener):
+            def request_end(self, event):
+                events.append(event)
+        o = onep.OnepV1(self.server.host, self.server.port,
+                        pool=ConnectionPool(), listeners=[EventListener()])
+        o.info(self.cik, {'alias': ''})
+        o.info(self.cik, {'alias': ''})
+        self.assertEqual([event.reused for event in events], [False, True])
+        # the server closes the idle connection as the request is sent on
+        # it, so it's sent again on a new one
+        pool = o.onephttp.pool
+        (conn, returned), = list(pool._idle.values())[0]
+        getresponse = conn.getresponse
+
+        def closed():
+            conn.getresponse = getresponse
+            conn.close()
+            raise onephttp.httplib.BadStatusLine('')
+        conn.getresponse = closed
+        requests = self.server.stats()['requests']
+        self.assertTrue(o.info(self.cik, {'alias': ''})[0])
+        self.assertEqual(self.server.stats()['requests'] - requests, 2)
+        # a connection the server closed isn't checked out
+        (conn, returned), = list(pool._idle.values())[0]
+        conn.sock.shutdown(socket.SHUT_RDWR)
+        self.assertFalse(pool._is_healthy(conn))
+
+    def test_async_client(self):
+        if sys.version_info < (3, 5):
+            self.skipTest('asynconep requires Python 3.5')
+        import asyncio
+        from pyonep.asynconep import AsyncOnepV1
+        rids = [self.makeDataport('a%d' % n) for n in range(4)]
+        o = AsyncOnepV1(self.server.host, self.server.port, maxconcurrency=2)
+        loop = asyncio.new_event_loop()
+        # for gather()
+        asyncio.set_event_loop(loop)
+        try:
+            results = loop.run_until_complete(asyncio.gather(
+                *[o.write(self.cik, rid, n) for n, rid in enumerate(rids)]))
+            self.assertEqual(results, [(True, 'ok')] * 4)
+            for n, rid in enumerate(rids):
+                o.read(self.cik, rid, {}, defer=True)
+            responses = loop.run_until_complete(
+                o.send_deferred(self.cik, max_calls=1))
+            self.assertEqual([response[0][1]
+                              for (call, isok, response) in responses],
+                             [0, 1, 2, 3])
+            o.onephttp.close()
+        finally:
+            asyncio.set_event_loop(None)
+            loop.close()
+
+    def test_deferred_order(self):
+        rid = self.makeDataport('o')
+        self.onep.record(self.cik, rid, [[t, t] for t in range(1, 7)])
+        o = onep.OnepV1(self.server.host, self.server.port,
+                        pool=ConnectionPool())
+        for t in range(1, 7):
+            o.read(self.cik, rid, {'starttime': t, 'endtime': t},
+                   defer=True)
+        responses = o.send_deferred(self.cik, max_calls=2, concurrency=3)
+        self.assertEqual([response for (call, isok, response) in responses],
+                         [[[t, t]] for t in range(1, 7)])
+        self.assertEqual([call['id'] for (call, isok, response) in responses],
+                         sorted(call['id'] for (call, isok, response)
+                                in responses))
+
+    def test_id_mismatch(self):
+        calls = self.onep._composeCalls([('info', [{'alias': ''}, {}]),
+                                         ('info', [{'alias': ''}, {}])])
+        ok = [{'id': calls[0]['id'], 'status': 'ok', 'result': 1},
+              {'id': calls[1]['id'], 'status': 'ok', 'result': 2}]
+        self.assertEqual(
+            [res for (call, status, res)
+             in self.onep._matchResponse(ok, calls, returnreq=True)],
+            [1, 2])
+        for res in (ok[:1], ok + ok[1:], ok + [{'id': -1, 'status': 'ok'}]):
+            self.assertRaises(JsonRPCResponseException,
+                              self.onep._matchResponse, res, calls, True)
+
+    def test_codecs(self):
+        rid = self.makeDataport('c')
+        self.onep.write(self.cik, rid, 5)
+        for name in (None, 'json', 'auto'):
+            o = onep.OnepV1(self.server.host, self.server.port, codec=name)
+            isok, points = o.read(self.cik, rid, {})
+            self.assertTrue(isok)
+            self.assertEqual(points[0][1], 5)
+        self.assertRaises(ValueError, get_codec, 'nosuchcodec')
+
+    def test_iter_read(self):
+        rid = self.makeDataport('i')
+        # pages must not repeat or skip points
+        self.onep.record(self.cik, rid, [[t, t * 10] for t in range(1, 26)])
+        for prefetch in (False, True):
+            points = list(self.onep.iter_read(self.cik, rid, 1, 25,
+                                              page_size=10,
+                                              prefetch=prefetch))
+            self.assertEqual(points, [[t, t * 10] for t in range(1, 26)])
+
+    def test_columnar(self):
+        rid = self.makeDataport('col')
+        self.onep.record(self.cik, rid, [[1, 10], [2, 20]])
+        isok, points = self.onep.read(self.cik, rid,
+                                      {'limit': 2, 'sort': 'asc'},
+                                      columnar=True)
+        self.assertTrue(isok)
+        self.assertEqual(len(points), 2)
+        self.assertEqual(list(points.timestamps), [1, 2])
+        self.assertEqual(list(points.values), [10, 20])
+        self.assertEqual([list(p) for p in points], [[1, 10], [2, 20]])
+        datastore = self.makeDatastore()
+        data = datastore.read('col', 2, columnar=True)
+        self.assertEqual(list(data.values), [20, 10])
+
+    def test_ratelimit(self):
+        bucket = TokenBucket(20, burst=2)
+        self.assertEqual(bucket.acquire(), 0)
+        self.assertEqual(bucket.acquire(), 0)
+        start = time.time()
+        self.assertTrue(bucket.acquire() > 0)
+        self.assertTrue(time.time() - start >= 0.04)
+        shared = bucket_for(('x', 'read'), 1)
+        self.assertTrue(bucket_for(('x', 'read'), 1) is shared)
+        # a different rate gets its own bucket
+        self.assertEqual(bucket_for(('x', 'read'), 5).rate, 5)
+
+    def test_singleflight(self):
+        flights = SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def slow(n):
+            calls.append(n)
+            started.set()
+            release.wait(5)
+            return [n]
+        results = queue.Queue()
+        leader = threading.Thread(
+            target=lambda: results.put(flights.do('k', slow, 1)))
+        leader.start()
+        started.wait(5)
+        follower = threading.Thread(
+            target=lambda: results.put(flights.do('k', slow, 2)))
+        follower.start()
+        time.sleep(0.1)
+        release.set()
+        leader.join()
+        follower.join()
+        first, second = results.get(), results.get()
+        self.assertEqual(calls, [1])
+        self.assertTrue(first is second)
+
+    def test_read_many(self):
+        for alias in ('m1', 'm2'):
+            rid = self.makeDataport(alias)
+            self.onep.record(self.cik, rid, [[1, 1], [2, 2]])
+        datastore = self.makeDatastore()
+        # resolved and read with one request on a cold cache
+        requests = self.server.stats()['requests']
+        self.assertEqual(datastore.read_many(['m1', 'm2', 'missing'], 2),
+                         {'m1': [[2, 2], [1, 1]], 'm2': [[2, 2], [1, 1]],
+                          'missing': False})
+        self.assertEqual(self.server.stats()['requests'] - requests, 1)
+        self.assertEqual(datastore.warmup_aliases(['m1', 'missing']),
+                         {'m1': self.onep.lookup(self.cik, 'alias', 'm1')[1],
+                          'missing': False})
+        # served from the cache
+        requests = self.server.stats()['requests']
+        self.assertEqual(datastore.read_many(['m1', 'm2'], 1),
+                         {'m1': [[2, 2]], 'm2': [[2, 2]]})
+        self.assertEqual(self.server.stats()['requests'], requests)
+
+    def test_flush_high_water(self):
+        rids = [self.makeDataport(alias) for alias in ('f1', 'f2')]
+        datastore = self.makeDatastore({'flush_high_water': 2})
+        datastore.start(daemon=True)
+        try:
+            datastore.write('f1', 1)
+            datastore.write('f2', 2)
+            # the interval is 30 seconds, so this is the high-water flush
+            deadline = time.time() + 5
+            while time.time() < deadline:
+                counts = [len(self.onep.read(self.cik, rid, {})[1])
+                          for rid in rids]
+                if counts == [1, 1]:
+                    break
+                time.sleep(0.05)
+            self.assertEqual(counts, [1, 1])
+        finally:
+            self.assertTrue(datastore.stop(wait=True, timeout=5))
+
+    def test_record_many(self):
+        aliases = ['r%d' % n for n in range(5)]
+        rids = [self.makeDataport(alias) for alias in aliases]
+        datastore = self.makeDatastore({'batch_max_calls': 2,
+                                        'record_workers': 2})
+        datastore.warmup_aliases(aliases)
+        for n, alias in enumerate(aliases):
+            self.assertTrue(datastore.record(alias, [[1, n], [2, n]]))
+        requests = self.server.stats()['requests']
+        self.assertTrue(datastore.flush())
+        # one record call per alias, two calls per request
+        self.assertEqual(self.server.stats()['requests'] - requests, 3)
+        for n, rid in enumerate(rids):
+            isok, points = self.onep.read(self.cik, rid, {'limit': 5,
+                                                          'sort': 'asc'})
+            self.assertEqual(points, [[1, n], [2, n]])
+
+    def test_async_logging(self):
+        if sys.version_info < (3, 5):
+            self.skipTest('asynconep requires Python 3.5')
+        import asyncio
+        import logging
+        from pyonep.asynconep import AsyncOnePHTTP
+        records = []
+
+        class Handler(logging.Handler):
+            def emit(self, record):
+                records.append(record)
+        log = logging.getLogger('test_async_logging')
+        log.propagate = False
+        log.addHandler(Handler())
+        http = AsyncOnePHTTP('%s:%s' % (self.server.host, self.server.port),
+                             https=False, log=log, log_body_bytes=10)
+        body = '{"auth": {"cik": "%s"}, "calls": []}' % self.cik
+        loop = asyncio.new_event_loop()
+        try:
+            log.setLevel(logging.INFO)
+            loop.run_until_complete(http.request('POST', RPC_PATH, body))
+            self.assertEqual(records, [])
+            log.setLevel(logging.DEBUG)
+            loop.run_until_complete(http.request('POST', RPC_PATH, body))
+            bodies = [record.getMessage() for record in records
+                      if record.getMessage().startswith('Body: ')]
+            self.assertEqual(bodies[0], 'Body: ' + body[:10] + '...')
+            http.close()
+        finally:
+            loop.close()
+
+    def test_async_iter_read(self):
+        if sys.version_info < (3, 5):
+            self.skipTest('asynconep requires Python 3.5')
+        import asyncio
+        from pyonep.asynconep import AsyncOnepV1
+        from pyonep.exceptions import OneException
+        rid = self.makeDataport('ai')
+        self.onep.record(self.cik, rid, [[t, t] for t in range(1, 26)])
+        o = AsyncOnepV1(self.server.host, self.server.port)
+        loop = asyncio.new_event_loop()
+        try:
+            for prefetch in (False, True):
+                points = o.iter_read(self.cik, rid, 1, 25, page_size=10,
+                                     prefetch=prefetch)
+                got = []
+                while True:
+                    try:
+                        got.append(loop.run_until_complete(
+                            points.__anext__()))
+                    except StopAsyncIteration:
+                        break
+                self.assertEqual(got, [[t, t] for t in range(1, 26)])
+            self.assertRaises(OneException, o.read_stream, self.cik, rid, {})
+            o.read(self.cik, rid, {}, defer=True)
+            self.assertRaises(OneException, o.send_deferred_stream, self.cik)
+            o.onephttp.close()
+        finally:
+            loop.close()